@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import os
+from datetime import timedelta
 
 from celery.schedules import crontab
 
@@ -29,13 +30,101 @@ INSTALLED_APPS = [
 # Celery
 BROKER_URL = 'redis://127.0.0.1:6379/0'
 BROKER_TRANSPORT = 'redis'
+CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
+CELERY_TASK_RESULT_EXPIRES = 3600
 CELERYBEAT_SCHEDULE = {
     "send_email": {
         'task': "dashboard.tasks.send_email",
         'schedule': crontab(minute=1, hour=0),
-    }
+    },
+    "roll_up_daily_stats": {
+        'task': "dashboard.tasks.roll_up_daily_stats",
+        'schedule': crontab(minute=15, hour=0),
+    },
+    "refresh_tenants": {
+        'task': "dashboard.tasks.refresh_tenants",
+        'schedule': crontab(minute='*/10'),
+    },
+    "sync_call_replicas": {
+        'task': "dashboard.tasks.sync_call_replicas",
+        'schedule': timedelta(minutes=1),
+        'options': {'expires': 60},
+    },
+    "poll_current_calls": {
+        'task': "dashboard.tasks.poll_current_calls",
+        'schedule': timedelta(seconds=10),
+        # A poll that could not run in time is replaced by the next one.
+        'options': {'expires': 10},
+    },
+}
+
+# Report cache, kept in the same Redis instance as the Celery broker.
+# Results of ranges that include today expire after REPORT_CACHE_TIMEOUT seconds.
+REPORT_CACHE_URL = 'redis://127.0.0.1:6379/1'
+REPORT_CACHE_TIMEOUT = 300
+
+# Reports that span both databases query them in parallel, on a pool of REPORT_THREADS threads.
+# A database that does not respond within REPORT_DATABASE_TIMEOUT seconds is left out of the report with a warning.
+# Its queries are interrupted at the same time (see REPORT_TIME_BUDGET), so that it does not keep the threads.
+REPORT_THREADS = 4
+REPORT_DATABASE_TIMEOUT = 120
+
+# Reports of at least ASYNC_REPORT_DAYS days are calculated by a Celery task, while the page polls for the result.
+ASYNC_REPORT_DAYS = 31
+
+# The reports calculated while the page waits get REPORT_TIME_BUDGET seconds, or their REPORT_TIME_BUDGETS by
+# name in report_dict. Their MySQL queries are interrupted with max_execution_time (MySQL 5.7.8 or later, or
+# max_statement_time on MariaDB 10.1 or later) and their Python loops stop once past it, and the page offers to
+# calculate the report in the background.
+REPORT_TIME_BUDGET = 30
+REPORT_TIME_BUDGETS = {
+    'Active partipants per call': 60,
+    'Maximum concurrent lines': 60,
+    'Concurrent VidyoGateway ports': 60,
+}
+
+# The addresses of the Prometheus servers that scrape /metrics, which is otherwise only shown to the staff.
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '').split()
+
+# The report pages of date ranges that ended before today are cached by the browsers for REPORT_PAGE_MAX_AGE
+# seconds. They are private, as they depend on the logged-in user.
+REPORT_PAGE_MAX_AGE = 3600
+
+# The calls of each CDR database are copied every minute by sync_call_replicas into a local, indexed replica,
+# and with REPORTS_FROM_REPLICAS the reports read them from there instead of the Vidyo portal databases.
+# The current calls are always read from the portal.
+CALL_REPLICAS = {
+    'ajenta.io': 'ajenta.io-replica',
+    'platformc': 'platformc-replica',
+}
+REPORTS_FROM_REPLICAS = True
+
+# The read-only queries of each CDR database (the replica syncs, the current calls and the reports without a local
+# replica) go to the first of its READ_REPLICAS that is up and at most REPLICA_MAX_LAG seconds behind, else to the
+# database itself. The replicas are checked every REPLICA_CHECK_INTERVAL seconds, which needs the REPLICATION CLIENT
+# privilege for SHOW SLAVE STATUS.
+READ_REPLICAS = {
+    'ajenta.io': ['ajenta.io-read'],
+    'platformc': ['platformc-read'],
+}
+REPLICA_MAX_LAG = 10
+REPLICA_CHECK_INTERVAL = 30
+
+# If NumPy is installed, the concurrent lines, gateway ports and overview reports process ranges of more than
+# COLUMNAR_ROW_THRESHOLD calls as NumPy arrays (see dashboard/columnar.py) instead of one call at a time.
+COLUMNAR_ROW_THRESHOLD = 100000
+
+# The ajenta.io database has no calls after the 2016-09-15 cut-over to platformc, so its calls are exported once
+# by export_archive into a read-only archive, which the reports memory-map instead of querying the database
+# (see dashboard/archive.py). The database itself is then only needed to check the archive against it.
+CALL_ARCHIVES = {
+    'ajenta.io': os.path.join(BASE_DIR, 'archives', 'ajenta.io'),
 }
 
+# The Current Calls pages read the counts that poll_current_calls stores in Redis every CURRENT_CALLS_INTERVAL
+# seconds, at the same interval. Each request returns at once, so that the pages do not hold the sync workers.
+CURRENT_CALLS_INTERVAL = 10
+
 MIDDLEWARE_CLASSES = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -73,6 +162,10 @@ BOOTSTRAP3 = {
 WSGI_APPLICATION = 'ajenta_dashboard.wsgi.application'
 
 # Database
+# The MySQL connections are kept open for CONN_MAX_AGE seconds across requests, Celery tasks and the threads
+# of the reports, which close them only once obsolete or broken.
+CONN_MAX_AGE = 300
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -80,6 +173,7 @@ DATABASES = {
     },
     'ajenta.io': {
         'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
         'NAME': 'portal2',
         'USER': os.environ['AJENTA_DB_USERNAME'],
         'PASSWORD': os.environ['AJENTA_DB_PASSWORD'],
@@ -90,6 +184,7 @@ DATABASES = {
     },
     'platformc': {
         'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
         'NAME': 'portal2',
         'USER': os.environ['OYDIV_DB_USERNAME'],
         'PASSWORD': os.environ['OYDIV_DB_PASSWORD'],
@@ -98,6 +193,52 @@ DATABASES = {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
         },
     },
+    # The MySQL read replicas of the Vidyo portal databases, see READ_REPLICAS.
+    'ajenta.io-read': {
+        'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'NAME': 'portal2',
+        'USER': os.environ['AJENTA_DB_USERNAME'],
+        'PASSWORD': os.environ['AJENTA_DB_PASSWORD'],
+        'HOST': os.environ['AJENTA_DB_READ_HOST'],
+        'OPTIONS': {
+            'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+        },
+    },
+    'platformc-read': {
+        'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'NAME': 'portal2',
+        'USER': os.environ['OYDIV_DB_USERNAME'],
+        'PASSWORD': os.environ['OYDIV_DB_PASSWORD'],
+        'HOST': os.environ['OYDIV_DB_READ_HOST'],
+        'OPTIONS': {
+            'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+        },
+    },
+    # The local replicas of the ConferenceCall2 table of both databases, see CALL_REPLICAS.
+    'ajenta.io-replica': {
+        'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'NAME': 'ajenta_io_replica',
+        'USER': os.environ['REPLICA_DB_USERNAME'],
+        'PASSWORD': os.environ['REPLICA_DB_PASSWORD'],
+        'HOST': '127.0.0.1',
+        'OPTIONS': {
+            'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+        },
+    },
+    'platformc-replica': {
+        'ENGINE': 'django.db.backends.mysql',
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'NAME': 'platformc_replica',
+        'USER': os.environ['REPLICA_DB_USERNAME'],
+        'PASSWORD': os.environ['REPLICA_DB_PASSWORD'],
+        'HOST': '127.0.0.1',
+        'OPTIONS': {
+            'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
+        },
+    },
 }
 
 AUTH_PASSWORD_VALIDATORS = [
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Call
+from .models import Call, DailyRollup
 
 
 class CallAdmin(admin.ModelAdmin):
@@ -8,3 +8,11 @@ class CallAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Call, CallAdmin)
+
+
+class DailyRollupAdmin(admin.ModelAdmin):
+    list_display = ('database', 'tenantname', 'day', 'calls', 'unique_calls', 'concurrent_lines')
+    list_filter = ('database',)
+
+
+admin.site.register(DailyRollup, DailyRollupAdmin)
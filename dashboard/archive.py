@@ -0,0 +1,390 @@
+import heapq
+import json
+import os
+import shutil
+from collections import Counter, OrderedDict
+from datetime import datetime, time, timedelta
+from functools import wraps
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+
+from . import columnar
+from .columnar import numpy
+from .models import Call, UserCountry
+from .utils import concurrent_lines_per_bucket, in_date_range, participants_per_call, to_date, LENGTH_BUCKETS
+
+# The version of the files of an archive, in case their layout changes.
+ARCHIVE_FORMAT = 1
+
+EPOCH = datetime(1970, 1, 1)
+HOUR = 3600 * 10 ** 6
+# NumPy's NaT as int64, which stands for a NULL LeaveTime.
+NULL_TIME = -2 ** 63
+
+# The archives opened by this process, by path. They are memory mapped, so they share the page cache.
+archives = {}
+
+# The implementation of each archived function of queries.py on an archive, by function name.
+archived_functions = {}
+
+
+def to_microseconds(value):
+    return int((value - EPOCH).total_seconds()) * 10 ** 6 + value.microsecond
+
+
+def to_datetime(microseconds):
+    return EPOCH + timedelta(microseconds=int(microseconds))
+
+
+def export_archive(selected_db, path):
+    """
+    Export all the calls of the given database into an archive at the given path, as a directory of .npy files:
+    the times and CallIDs as int64, and the codes of the other fields as int32 with their values in values.json.
+    The calls are sorted by JoinTime, so that a date range is a contiguous slice of each file.
+    """
+    fields = [field.name for field in Call._meta.fields]
+    columns = columnar.CallColumns(Call.objects.using(selected_db).values_list(*fields).iterator(), fields)
+    order = numpy.argsort(columns.times['jointime'], kind='mergesort')
+
+    # The archive is written next to its final path and renamed once complete, so that it is never read half written.
+    partial_path = path + '.partial'
+    if os.path.exists(partial_path):
+        shutil.rmtree(partial_path)
+    os.makedirs(partial_path)
+
+    for field, column in columns.times.items() + columns.numbers.items():
+        numpy.save(os.path.join(partial_path, field + '.npy'), column[order])
+    for field, codes in columns.codes.items():
+        numpy.save(os.path.join(partial_path, field + '.npy'), codes[order].astype(numpy.int32))
+
+    with open(os.path.join(partial_path, 'values.json'), 'w') as values_file:
+        json.dump(dict((field, values.tolist()) for field, values in columns.values.items()), values_file)
+
+    joins, leaves = columns.times['jointime'], columns.times['leavetime']
+    ended = leaves != NULL_TIME
+    meta = {
+        'format': ARCHIVE_FORMAT,
+        'database': selected_db,
+        'exported': datetime.now().isoformat(),
+        'calls': len(joins),
+        'last_callid': int(columns.numbers['callid'].max()) if len(joins) else None,
+        # The longest a call leaves before it joins, to find the calls of a range that ends on their leave time.
+        'max_wrap': int(max((joins[ended] - leaves[ended]).max(), 0)) if ended.any() else 0,
+        # The longest call, to find the calls that joined before a range and are active in it.
+        'max_length': int(max((leaves[ended] - joins[ended]).max(), 0)) if ended.any() else 0,
+    }
+    with open(os.path.join(partial_path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(partial_path, path)
+
+    return meta
+
+
+def open_archive(selected_db):
+    """Return the archive of the given database if CALL_ARCHIVES has one and NumPy is installed, else None."""
+    path = getattr(settings, 'CALL_ARCHIVES', {}).get(selected_db)
+    if path is None or numpy is None or not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+
+    if path not in archives:
+        archives[path] = Archive(path)
+
+    return archives[path]
+
+
+class Archive(object):
+    """The memory-mapped calls of an archive written by export_archive()."""
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        with open(os.path.join(path, 'values.json')) as values_file:
+            values = json.load(values_file)
+
+        self.values = dict((field, numpy.array(field_values, dtype=object)) for field, field_values in values.items())
+        self.value_codes = dict((field, dict((value, code) for code, value in enumerate(field_values)))
+                                for field, field_values in values.items())
+
+        self.times = dict((field, self.load(path, field)) for field in columnar.TIME_FIELDS)
+        self.numbers = dict((field, self.load(path, field)) for field in columnar.INTEGER_FIELDS)
+        self.codes = dict((field, self.load(path, field)) for field in values)
+
+    def load(self, path, field):
+        return numpy.load(os.path.join(path, field + '.npy'), mmap_mode='r')
+
+    def select(self, username, start_date, end_date, fields, end_field='jointime', include=None, exclude=None,
+               overlapping=False):
+        """
+        Return the given fields of the calls that queries.date_range() and the Tenant filter would select,
+        and whose fields have one of the values in include and none of the values in exclude (dicts of lists).
+        If overlapping, the ended calls that queries.overlapping_range() would select instead.
+        """
+        start = to_microseconds(datetime.combine(to_date(start_date), time.min))
+        end = to_microseconds(datetime.combine(to_date(end_date), time.min) + timedelta(1))
+
+        # The calls are sorted by JoinTime, so the ones that joined in the range are a slice of the files.
+        joins = self.times['jointime']
+        first = numpy.searchsorted(joins, start)
+        if overlapping:
+            # The archives exported before max_length was kept are searched from their first call.
+            first = numpy.searchsorted(joins, start - self.meta['max_length']) if 'max_length' in self.meta else 0
+            last = numpy.searchsorted(joins, end)
+        elif end_field == 'leavetime':
+            last = numpy.searchsorted(joins, end + self.meta['max_wrap'])
+        else:
+            last = numpy.searchsorted(joins, end)
+
+        selected = numpy.ones(last - first, dtype=bool)
+        if overlapping:
+            leaves = self.times['leavetime'][first:last]
+            selected &= (leaves != NULL_TIME) & ((joins[first:last] >= start) | (leaves >= start))
+        elif end_field == 'leavetime':
+            leaves = self.times['leavetime'][first:last]
+            selected &= (leaves != NULL_TIME) & (leaves < end)
+
+        if username != "All":
+            include = dict(include or {}, tenantname=[username])
+        for field, values in (include or {}).items():
+            selected &= numpy.in1d(self.codes[field][first:last], self.find_codes(field, values))
+        for field, values in (exclude or {}).items():
+            selected &= ~numpy.in1d(self.codes[field][first:last], self.find_codes(field, values))
+
+        return Selection(self, first + numpy.flatnonzero(selected), fields)
+
+    def find_codes(self, field, values):
+        codes = self.value_codes[field]
+        return [codes[value] for value in values if value in codes]
+
+
+class Selection(object):
+    """Some calls of an archive, with the same times, numbers, codes and values as columnar.CallColumns."""
+
+    def __init__(self, archive, rows, fields):
+        self.times = dict((field, archive.times[field][rows]) for field in fields if field in archive.times)
+        self.numbers = dict((field, archive.numbers[field][rows]) for field in fields if field in archive.numbers)
+        self.codes = dict((field, archive.codes[field][rows]) for field in fields if field in archive.codes)
+        self.values = archive.values
+        self.fields = fields
+        self.rows = len(rows)
+
+    def dicts(self):
+        """Return the calls as dicts of their fields, like a values() queryset."""
+        columns = []
+        for field in self.fields:
+            if field in self.times:
+                columns.append([to_datetime(value) if value != NULL_TIME else None for value in self.times[field]])
+            elif field in self.numbers:
+                columns.append(self.numbers[field].tolist())
+            else:
+                columns.append(self.values[field][self.codes[field]].tolist())
+
+        return [dict(zip(self.fields, row)) for row in zip(*columns)]
+
+
+def archived(function):
+    """
+    Answer a function of queries.py from the archive of the database, if there is one, instead of querying it.
+    The archived results are not cached, as they are calculated locally from the memory-mapped files.
+    """
+    @wraps(function)
+    def wrapper(username, selected_db, start_date, end_date, *args, **kwargs):
+        archive = open_archive(selected_db)
+        if archive is None:
+            return function(username, selected_db, start_date, end_date, *args, **kwargs)
+
+        kwargs.pop('refresh', None)
+        return archived_functions[function.__name__](archive, username, start_date, end_date, *args, **kwargs)
+
+    return wrapper
+
+
+def archive_of(name):
+    """Register the decorated function as the implementation on an archive of the given function of queries.py."""
+    def decorator(implementation):
+        archived_functions[name] = implementation
+        return implementation
+
+    return decorator
+
+
+def concurrent_line_filters():
+    return {'include': {'callstate': ["COMPLETED"]}, 'exclude': {'applicationname': ["VidyoReplay", "VidyoGateway"]}}
+
+
+def gateway_port_filters():
+    return {'include': {'callstate': ["COMPLETED"], 'applicationname': ["VidyoGateway"]}}
+
+
+@archive_of('concurrent_line_calls')
+def concurrent_line_calls(archive, username, start_date, end_date):
+    return archive.select(username, start_date, end_date, ['callername', 'jointime', 'leavetime'],
+                          overlapping=True, **concurrent_line_filters()).dicts()
+
+
+@archive_of('gateway_port_calls')
+def gateway_port_calls(archive, username, start_date, end_date):
+    return archive.select(username, start_date, end_date, ['callername', 'jointime', 'leavetime'],
+                          overlapping=True, **gateway_port_filters()).dicts()
+
+
+@archive_of('count_tenant_values')
+def count_tenant_values(archive, username, start_date, end_date, field, values=None, distinct=None):
+    calls = archive.select(username, start_date, end_date, [field] + ([distinct] if distinct else []))
+    if distinct:
+        counts = columnar.distinct_counts(calls.codes[field], len(calls.values[field]),
+                                          calls.codes[distinct], len(calls.values[distinct]))
+    else:
+        counts = columnar.value_counts(calls, field)
+
+    return Counter(dict((calls.values[field][code], int(counts[code])) for code in numpy.flatnonzero(counts)
+                        if values is None or calls.values[field][code] in values))
+
+
+@archive_of('count_application_values')
+def count_application_values(archive, username, start_date, end_date, field):
+    calls = archive.select(username, start_date, end_date, [field])
+    counts = columnar.value_counts(calls, field, exclude=(None, ''))
+
+    return Counter(dict((calls.values[field][code], int(counts[code])) for code in numpy.flatnonzero(counts)))
+
+
+@archive_of('calculate_user_stats')
+def calculate_user_stats(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['callername'])
+
+    return columnar.top_values(calls.values['callername'], columnar.value_counts(calls, 'callername'), 10)
+
+
+@archive_of('calculate_room_stats')
+def calculate_room_stats(archive, username, start_date, end_date):
+    rooms = count_tenant_values(archive, username, start_date, end_date, 'conferencename', distinct='uniquecallid')
+
+    return OrderedDict(heapq.nlargest(10, sorted(rooms.items()), key=itemgetter(1)))
+
+
+@archive_of('calculate_calls_per_day')
+def calculate_calls_per_day(archive, username, start_date, end_date):
+    return columnar.calls_per_day(archive.select(username, start_date, end_date, ['jointime', 'uniquecallid']))
+
+
+@archive_of('calculate_calls_per_hour')
+def calculate_calls_per_hour(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['jointime', 'uniquecallid'])
+    hours = calls.times['jointime'] // HOUR
+    if not len(hours):
+        return OrderedDict()
+
+    first_hour = hours.min()
+    counts = columnar.distinct_counts(hours - first_hour, hours.max() - first_hour + 1,
+                                      calls.codes['uniquecallid'], len(calls.values['uniquecallid']))
+
+    return OrderedDict((to_datetime((first_hour + offset) * HOUR), int(counts[offset]))
+                       for offset in numpy.flatnonzero(counts))
+
+
+@archive_of('calculate_participants_per_call')
+def calculate_participants_per_call(archive, username, start_date, end_date):
+    parties = archive.select(username, start_date, end_date, ['uniquecallid', 'callername', 'jointime', 'leavetime'],
+                             end_field='leavetime', **concurrent_line_filters()).dicts()
+    parties.sort(key=itemgetter('uniquecallid', 'jointime'))
+
+    participants = ((unique_call_id, participants_per_call(call_parties))
+                    for unique_call_id, call_parties in groupby(parties, key=itemgetter('uniquecallid')))
+
+    return OrderedDict(heapq.nlargest(10, participants, key=itemgetter(1)))
+
+
+@archive_of('calculate_meeting_length_totals')
+def calculate_meeting_length_totals(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['uniquecallid', 'jointime', 'leavetime'],
+                           end_field='leavetime', include={'callstate': ["COMPLETED"]})
+    histogram = [0] * (len(LENGTH_BUCKETS) + 1)
+    if not calls.rows:
+        return 0, 0, histogram
+
+    # The length of each UniqueCallID is from its first join to its last leave.
+    order = numpy.argsort(calls.codes['uniquecallid'], kind='mergesort')
+    codes = calls.codes['uniquecallid'][order]
+    first_calls = numpy.flatnonzero(numpy.concatenate([[True], codes[1:] != codes[:-1]]))
+    lengths = (numpy.maximum.reduceat(calls.times['leavetime'][order], first_calls) -
+               numpy.minimum.reduceat(calls.times['jointime'][order], first_calls)) / 10.0 ** 6
+
+    histogram = numpy.bincount(numpy.searchsorted(LENGTH_BUCKETS, lengths), minlength=len(histogram))
+    return float(lengths.sum()), len(lengths), histogram.tolist()
+
+
+@archive_of('calculate_concurrent_lines')
+def calculate_concurrent_lines(archive, username, start_date, end_date):
+    return in_date_range(columnar.concurrent_lines_per_day(archive.select(
+        username, start_date, end_date, ['callername', 'jointime', 'leavetime'], overlapping=True,
+        **concurrent_line_filters())), start_date, end_date)
+
+
+@archive_of('calculate_concurrent_lines_per_hour')
+def calculate_concurrent_lines_per_hour(archive, username, start_date, end_date):
+    return in_date_range(concurrent_lines_per_bucket(concurrent_line_calls(archive, username, start_date, end_date),
+                                                     'hour'), start_date, end_date)
+
+
+@archive_of('calculate_concurrent_gateway_ports')
+def calculate_concurrent_gateway_ports(archive, username, start_date, end_date):
+    return in_date_range(columnar.concurrent_lines_per_day(archive.select(
+        username, start_date, end_date, ['callername', 'jointime', 'leavetime'], overlapping=True,
+        **gateway_port_filters())), start_date, end_date)
+
+
+@archive_of('calculate_calls_by_country')
+def calculate_calls_by_country(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['callerid'], end_field='leavetime',
+                           exclude={'callerid': ['Guest']})
+    counts = columnar.value_counts(calls, 'callerid')
+    countries = dict(UserCountry.objects.values_list('username', 'country'))
+
+    # The users missing from 'UsersExport.csv' are counted as None, like in the database.
+    calls_by_country = Counter()
+    for code in numpy.flatnonzero(counts):
+        calls_by_country[countries.get(calls.values['callerid'][code])] += int(counts[code])
+
+    return calls_by_country
+
+
+@archive_of('calculate_platform_stats')
+def calculate_platform_stats(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['applicationname'])
+    counts = columnar.value_counts(calls, 'applicationname', exclude=(None, ''))
+
+    return columnar.top_values(calls.values['applicationname'], counts, 10, other='Other')
+
+
+@archive_of('calculate_os_stats')
+def calculate_os_stats(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['applicationos'])
+    counts = columnar.value_counts(calls, 'applicationos', exclude=(None, ''))
+
+    return columnar.top_values(calls.values['applicationos'], counts, 10, other='Other')
+
+
+@archive_of('calculate_overview')
+def calculate_overview(archive, username, start_date, end_date):
+    return columnar.overview(archive.select(username, start_date, end_date, ['callername', 'conferencename',
+                                                                             'uniquecallid', 'jointime',
+                                                                             'applicationname', 'applicationos']))
+
+
+@archive_of('calculate_high_water_mark')
+def calculate_high_water_mark(archive, username, start_date, end_date):
+    calls = archive.select(username, start_date, end_date, ['callid', 'jointime', 'leavetime'])
+    leaves = calls.times['leavetime'][calls.times['leavetime'] != NULL_TIME]
+
+    return {
+        'calls': calls.rows,
+        'ended': len(leaves),
+        'last_callid': int(calls.numbers['callid'].max()) if calls.rows else None,
+        'last_join': to_datetime(calls.times['jointime'].max()) if calls.rows else None,
+        'last_leave': to_datetime(leaves.max()) if len(leaves) else None,
+    }
@@ -0,0 +1,281 @@
+import json
+import random
+import resource
+import subprocess
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
+
+from django.db import connections, transaction
+from django.test.utils import CaptureQueriesContext
+
+from . import columnar
+from .models import Call
+from .queries import RANGE_REPORTS, calculate_daily_stats, concurrent_line_calls, gateway_port_calls, \
+    merge_concurrent_lines, tenant_calls
+from .utils import concurrent_lines_per_bucket, concurrent_lines_per_day, participants_per_call, top_counts, \
+    merge_sorted
+
+# Synthetic Tenants with the share of the conferences they host, so that a few Tenants have most of the calls.
+TENANTS = [('ActionAid', 30), ('Jisc', 25), ('Ajenta', 10)] + [('Tenant %02d' % i, 35 / 17.0) for i in range(17)]
+
+USERS_PER_TENANT = 200
+ROOMS_PER_TENANT = 50
+GATEWAYS_PER_TENANT = 5
+
+# Share of the participants that join with each application and the operating systems it runs on.
+APPLICATIONS = [
+    ('VidyoDesktop', 45, ['Windows', 'OS X', 'Linux']),
+    ('VidyoWeb', 20, ['Windows', 'OS X']),
+    ('VidyoMobile', 15, ['iOS', 'Android']),
+    ('VidyoRoom', 8, ['VidyoRoom']),
+    ('VidyoGateway', 10, ['']),
+    ('VidyoReplay', 2, ['']),
+]
+
+BATCH_SIZE = 5000
+
+
+def weighted_choice(rng, choices):
+    """Return the first item of one of the given tuples, chosen with the weight of its second item."""
+    threshold = rng.uniform(0, sum(choice[1] for choice in choices))
+    for choice in choices:
+        threshold -= choice[1]
+        if threshold <= 0:
+            return choice
+    return choices[-1]
+
+
+def synthetic_calls(rows, days=30, seed=0):
+    """
+    Yield the given number of unsaved calls, spread over the given number of days up to yesterday.
+
+    The calls are grouped into conferences of 1 to 8 participants in the working hours, which join and leave
+    a few minutes apart, so that the calls of the same conference and Tenant overlap. Some participants are
+    guests or VidyoGateway ports, and a few calls are still in progress.
+    """
+    rng = random.Random(seed)
+    first_day = datetime.combine(date.today() - timedelta(days), datetime.min.time())
+    unique_call_id = 0
+
+    while rows > 0:
+        unique_call_id += 1
+        tenant = weighted_choice(rng, TENANTS)[0]
+        start = first_day + timedelta(days=rng.randrange(days), hours=rng.triangular(7, 19, 11))
+        length = timedelta(minutes=min(rng.lognormvariate(3.3, 0.7), 8 * 60))
+        room = rng.randrange(ROOMS_PER_TENANT)
+
+        participants = min(rows, int(rng.triangular(1, 9, 2)))
+        rows -= participants
+
+        for _ in range(participants):
+            application, _, operating_systems = weighted_choice(rng, APPLICATIONS)
+            if application == 'VidyoGateway':
+                caller_id = caller_name = '%s gateway %d' % (tenant, rng.randrange(GATEWAYS_PER_TENANT))
+            elif rng.random() < 0.1:
+                caller_id, caller_name = 'Guest', 'Guest %d' % rng.randrange(10 ** 6)
+            else:
+                caller_id = 'user%d.%s' % (rng.randrange(USERS_PER_TENANT), tenant.lower().replace(' ', ''))
+                caller_name = caller_id
+
+            join_time = start + timedelta(seconds=rng.randrange(300))
+            leave_time = start + length - timedelta(seconds=rng.randrange(300))
+            in_progress = rng.random() < 0.005
+
+            yield Call(uniquecallid=str(unique_call_id),
+                       conferencename='%s Room %d' % (tenant, room),
+                       tenantname=tenant,
+                       callerid=caller_id,
+                       callername=caller_name,
+                       jointime=join_time,
+                       leavetime=None if in_progress else max(join_time, leave_time),
+                       callstate='IN PROGRESS' if in_progress else 'COMPLETED',
+                       applicationname=application,
+                       applicationos=rng.choice(operating_systems))
+
+
+def generate_calls(selected_db, rows, days=30, seed=0):
+    """Insert the given number of synthetic calls into the given database, creating the table if needed."""
+    connection = connections[selected_db]
+    if Call._meta.db_table not in connection.introspection.table_names():
+        with connection.schema_editor() as schema_editor:
+            schema_editor.create_model(Call)
+
+    batch = []
+    for call in synthetic_calls(rows, days, seed):
+        batch.append(call)
+        if len(batch) == BATCH_SIZE:
+            with transaction.atomic(using=selected_db):
+                Call.objects.using(selected_db).bulk_create(batch)
+            batch = []
+
+    if batch:
+        with transaction.atomic(using=selected_db):
+            Call.objects.using(selected_db).bulk_create(batch)
+
+
+def report_benchmarks(username, selected_db, start_date, end_date):
+    """Return (name, function) for the calculate_* functions of the range reports and the daily rollups."""
+    benchmarks = [('queries.' + report.__name__, partial(report, username, selected_db, start_date, end_date))
+                  for _, report in RANGE_REPORTS]
+    benchmarks.append(('queries.calculate_daily_stats', partial(calculate_daily_stats, selected_db,
+                                                                start_date, end_date)))
+    return benchmarks
+
+
+# The names of the benchmarks of utils_benchmarks(), so that they can be listed without reading their input.
+UTILS_BENCHMARKS = [
+    'utils.concurrent_lines_per_day',
+    'utils.concurrent_lines_per_bucket',
+    'utils.participants_per_call',
+    'utils.top_counts',
+    'utils.merge_sorted',
+    'queries.merge_concurrent_lines',
+]
+COLUMNAR_BENCHMARKS = ['columnar.concurrent_lines_per_day']
+
+
+def utils_benchmarks(username, selected_db, start_date, end_date):
+    """
+    Return (name, function) for the functions of utils.py and for merging the concurrent lines of two databases,
+    here two copies of the same one. Their input is read from the database beforehand,
+    so that only the Python code is measured.
+    """
+    calls = list(concurrent_line_calls(username, selected_db, start_date, end_date))
+    gateway_calls = list(gateway_port_calls(username, selected_db, start_date, end_date))
+    callers = Counter(tenant_calls(username, selected_db, start_date, end_date).
+                      values_list('callername', flat=True).iterator())
+
+    calls_by_join = sorted(calls, key=lambda call: call['jointime'])
+    halves = [calls_by_join[::2], calls_by_join[1::2]]
+    lines = dict(concurrent_lines_per_day(calls))
+
+    benchmarks = [
+        ('utils.concurrent_lines_per_day', partial(concurrent_lines_per_day, calls)),
+        ('utils.concurrent_lines_per_bucket', partial(concurrent_lines_per_bucket, calls, 'hour')),
+        ('utils.participants_per_call', partial(participants_per_call, gateway_calls + calls)),
+        ('utils.top_counts', partial(top_counts, callers, 10, 'Other')),
+        ('utils.merge_sorted', lambda: list(merge_sorted(halves, key=lambda call: call['jointime']))),
+        ('queries.merge_concurrent_lines', partial(merge_concurrent_lines, [(selected_db, lines), ('copy', lines)],
+                                                   lambda database, first_day, last_day: calls_between(
+                                                       calls, first_day, last_day))),
+    ]
+
+    if columnar.numpy is not None:
+        fields = ['callername', 'jointime', 'leavetime']
+        columns = columnar.CallColumns(concurrent_line_calls(username, selected_db, start_date, end_date).
+                                       values_list(*fields).iterator(), fields)
+        benchmarks.append(('columnar.concurrent_lines_per_day', partial(columnar.concurrent_lines_per_day, columns)))
+
+    return benchmarks
+
+
+def calls_between(calls, first_day, last_day):
+    return [call for call in calls if first_day <= call['jointime'].date() <= last_day]
+
+
+def benchmark_names(username, selected_db, start_date, end_date):
+    """Return the names of the benchmarks of report_benchmarks() and utils_benchmarks(), without running a query."""
+    names = [name for name, _ in report_benchmarks(username, selected_db, start_date, end_date)] + UTILS_BENCHMARKS
+    if columnar.numpy is not None:
+        names += COLUMNAR_BENCHMARKS
+
+    return names
+
+
+def peak_memory():
+    """Return the peak resident memory of this process in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(function, selected_db, repeat=3):
+    """
+    Call the function the given number of times and return its fastest time in seconds,
+    the number of queries of a call and the growth of the peak memory in KB.
+    """
+    memory = peak_memory()
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connections[selected_db]) as context:
+            started = time.time()
+            function()
+            timings.append(time.time() - started)
+
+    return {
+        'seconds': round(min(timings), 6),
+        'queries': len(context.captured_queries),
+        'peak_memory_kb': peak_memory() - memory,
+    }
+
+
+def measure_benchmark(name, username, selected_db, start_date, end_date, repeat):
+    # The input of the utils benchmarks is only read when one of them is measured.
+    functions = dict(report_benchmarks(username, selected_db, start_date, end_date))
+    if name not in functions:
+        functions = dict(utils_benchmarks(username, selected_db, start_date, end_date))
+
+    return measure(functions[name], selected_db, repeat)
+
+
+def run_benchmarks(username, selected_db, start_date, end_date, repeat=3):
+    """
+    Measure every benchmark in a new process, as the peak memory of a process never goes down,
+    and return the results ready to be saved as JSON.
+    """
+    results = []
+
+    for name in benchmark_names(username, selected_db, start_date, end_date):
+        # The forked process must open its own database connections.
+        connections.close_all()
+        pool = Pool(1)
+        try:
+            result = pool.apply(measure_benchmark, (name, username, selected_db, start_date, end_date, repeat))
+        finally:
+            pool.terminate()
+        result['name'] = name
+        results.append(result)
+
+    return {
+        'commit': current_commit(),
+        'created': datetime.now().isoformat(),
+        'database': selected_db,
+        'vendor': connections[selected_db].vendor,
+        'tenant': username,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'calls': tenant_calls(username, selected_db, start_date, end_date).count(),
+        'results': results,
+    }
+
+
+def current_commit():
+    """Return the git commit of the working tree, or None if it is not a git repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(previous, current, threshold=0.2):
+    """
+    Yield (name, previous seconds, current seconds, regressed) for the benchmarks of both results,
+    where regressed is True if the current time is slower by more than the threshold.
+    """
+    previous_seconds = dict((result['name'], result['seconds']) for result in previous['results'])
+
+    for result in current['results']:
+        if result['name'] in previous_seconds:
+            before = previous_seconds[result['name']]
+            yield result['name'], before, result['seconds'], result['seconds'] > before * (1 + threshold)
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def save_results(results, path):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
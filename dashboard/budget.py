@@ -0,0 +1,119 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import connections, DatabaseError
+
+from .replica import call_database
+
+# The session variables that limit the time of each query, in milliseconds on MySQL 5.7.8 or later and in seconds
+# on MariaDB 10.1 or later, with the errors of the queries they interrupt.
+EXECUTION_TIME_VARIABLES = (('max_execution_time', 1), ('max_statement_time', 0.001))
+ER_QUERY_TIMEOUT = 3024
+ER_STATEMENT_TIMEOUT = 1969
+
+# The Python loops of the reports check their budget every CHECK_INTERVAL rows or events, as a check takes
+# about as long as handling a few of them.
+CHECK_INTERVAL = 1000
+
+# The deadline of the report calculated by each thread, as a time.time(), or None without a budget.
+state = threading.local()
+
+
+class ReportOverBudget(Exception):
+    """Raised when a report runs past the deadline of its time budget, in a query or in Python."""
+
+
+def deadline_after(budget):
+    """Return the deadline of a report given a budget of that many seconds, or None without a budget."""
+    return time.time() + budget if budget is not None else None
+
+
+def check_budget():
+    """Raise ReportOverBudget if the report calculated by this thread has run past its deadline."""
+    deadline = getattr(state, 'deadline', None)
+    if deadline is not None and time.time() > deadline:
+        raise ReportOverBudget()
+
+
+def set_execution_time(connection, milliseconds):
+    """
+    Limit the time of each query of the connection to the given milliseconds (0 for no limit) and return True,
+    or return False if the server has neither variable, e.g an older MySQL. The variable that worked is
+    remembered for the connection, so that a server without them is only asked once.
+    """
+    known = getattr(connection, 'execution_time_variables', None)
+    for variable, scale in EXECUTION_TIME_VARIABLES if known is None else known:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SET SESSION %s = %%s' % variable, [milliseconds * scale])
+        except DatabaseError:
+            # The variable worked before, so it is the connection that failed rather than the server without it.
+            if known:
+                return False
+            continue
+
+        connection.execution_time_variables = ((variable, scale),)
+        return True
+
+    connection.execution_time_variables = ()
+    return False
+
+
+def milliseconds_left(deadline):
+    return max(int((deadline - time.time()) * 1000), 1)
+
+
+@contextmanager
+def within_deadline(deadline, databases):
+    """
+    Run the enclosed code of a report until the given deadline, or without a limit if it is None.
+
+    The queries to the given MySQL databases (or to the databases their calls are read from) are interrupted
+    by the server once they take longer than the time left, with max_execution_time (or max_statement_time on
+    MariaDB), while the Python loops of the reports call check_budget(). Both raise ReportOverBudget.
+    On a server without either variable, only the Python loops of the reports stop at the deadline.
+
+    A deadline within another one, e.g the time budget of a report within the timeout of its database in
+    fan_out(), can only bring it forward.
+    """
+    if deadline is None:
+        yield
+        return
+
+    previous = getattr(state, 'deadline', None)
+    if previous is not None:
+        deadline = min(deadline, previous)
+    state.deadline = deadline
+
+    limited = []
+    try:
+        for alias in set(databases) | set(call_database(database) for database in databases):
+            connection = connections[alias]
+            if connection.vendor == 'mysql' and set_execution_time(connection, milliseconds_left(deadline)):
+                limited.append(connection)
+
+        yield
+    except DatabaseError as error:
+        if error.args and error.args[0] in (ER_QUERY_TIMEOUT, ER_STATEMENT_TIMEOUT):
+            raise ReportOverBudget()
+        raise
+    finally:
+        state.deadline = previous
+
+        # The connections are persistent, so the limit is lifted for the next queries,
+        # or set back to the enclosing deadline.
+        for connection in limited:
+            if not set_execution_time(connection, milliseconds_left(previous) if previous is not None else 0):
+                connection.close()
+
+
+def budgeted(function, deadline):
+    """Run a calculate_* function for one database within the given deadline (see within_deadline())."""
+    @wraps(function)
+    def wrapper(username, selected_db, start_date, end_date, **kwargs):
+        with within_deadline(deadline, [selected_db]):
+            return function(username, selected_db, start_date, end_date, **kwargs)
+
+    return wrapper
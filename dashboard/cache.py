@@ -0,0 +1,95 @@
+import pickle
+from datetime import date
+from functools import wraps
+
+import redis
+from django.conf import settings
+
+from .utils import to_date
+
+KEY_PREFIX = 'report'
+
+# The Redis client is created on first use, so that the report cache is disabled
+# when REPORT_CACHE_URL is not set (e.g in development and while testing).
+client = None
+
+
+def get_client():
+    """Return the Redis client of the report cache, or None if the cache is disabled."""
+    global client
+    if client is None and getattr(settings, 'REPORT_CACHE_URL', None):
+        client = redis.StrictRedis.from_url(settings.REPORT_CACHE_URL)
+    return client
+
+
+def report_key(report, username, selected_db, start_date, end_date):
+    key = ':'.join([KEY_PREFIX, report, username, selected_db,
+                    to_date(start_date).isoformat(), to_date(end_date).isoformat()])
+    return key.encode('utf-8')
+
+
+def is_cached(report, username, databases, start_date, end_date):
+    """Tell whether the results of the given report are cached for all the given databases."""
+    cache = get_client()
+    if cache is None:
+        return False
+
+    try:
+        return all(cache.exists(report_key(report, username, selected_db, start_date, end_date))
+                   for selected_db in databases)
+    except redis.RedisError:
+        return False
+
+
+def cached_report(function):
+    """
+    Cache the result of a calculate_* function in Redis, keyed by report, Tenant, database and date range.
+
+    The results of closed date ranges never expire, while the ones of ranges that include today expire after
+    REPORT_CACHE_TIMEOUT seconds. Pass refresh=True to recalculate the result and overwrite the cached one.
+    If Redis is unavailable the result is just calculated.
+    """
+    @wraps(function)
+    def wrapper(username, selected_db, start_date, end_date, refresh=False):
+        cache = get_client()
+        if cache is None:
+            return function(username, selected_db, start_date, end_date)
+
+        key = report_key(function.__name__, username, selected_db, start_date, end_date)
+
+        if not refresh:
+            try:
+                cached = cache.get(key)
+            except redis.RedisError:
+                cached = None
+            if cached is not None:
+                return pickle.loads(cached)
+
+        result = function(username, selected_db, start_date, end_date)
+
+        if to_date(end_date) < date.today():
+            timeout = None
+        else:
+            timeout = getattr(settings, 'REPORT_CACHE_TIMEOUT', 300)
+
+        try:
+            cache.set(key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL), ex=timeout)
+        except redis.RedisError:
+            pass
+
+        return result
+
+    return wrapper
+
+
+def purge_reports(report='*'):
+    """Delete the cached results of the given report (of all the reports by default) and return their number."""
+    cache = get_client()
+    if cache is None:
+        return 0
+
+    keys = list(cache.scan_iter(match='%s:%s:*' % (KEY_PREFIX, report)))
+    if keys:
+        cache.delete(*keys)
+
+    return len(keys)
@@ -0,0 +1,202 @@
+from collections import OrderedDict, defaultdict
+from datetime import date, timedelta
+from itertools import chain, islice
+
+from django.conf import settings
+
+from .budget import check_budget
+
+# NumPy is optional: without it (or without COLUMNAR_ROW_THRESHOLD) the reports process the calls as dicts.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The join and leave times are microseconds since the epoch, in the local time of the database like the calls.
+TIME_FIELDS = ('jointime', 'leavetime')
+# The integer fields are kept as they are, instead of dictionary encoded.
+INTEGER_FIELDS = ('callid',)
+DAY = 24 * 3600 * 10 ** 6
+EPOCH = date(1970, 1, 1)
+
+CHUNK_SIZE = 10000
+
+
+def read_calls(calls, fields):
+    """
+    Read the given fields of a queryset of calls. Return them as CallColumns if NumPy is installed and there are
+    more than COLUMNAR_ROW_THRESHOLD of them, or else as tuples. The rows are counted as they are read, so that
+    choosing how to process them does not take a query of its own.
+    """
+    rows = calls.values_list(*fields).iterator()
+    threshold = getattr(settings, 'COLUMNAR_ROW_THRESHOLD', None)
+    if numpy is None or threshold is None:
+        return rows
+
+    first_rows = list(islice(rows, threshold + 1))
+    if len(first_rows) <= threshold:
+        return first_rows
+
+    return CallColumns(chain(first_rows, rows), fields)
+
+
+class CallColumns(object):
+    """
+    The given fields of some calls as NumPy arrays, from their rows of values_list(*fields). The times are int64
+    microseconds since the epoch and the numbers int64, while the other fields are dictionary encoded: codes[field]
+    has the code of each call and values[field] the sorted distinct values, so that values[field][codes[field]] are
+    the values of the calls.
+    """
+
+    def __init__(self, rows, fields):
+        chunks = dict((field, []) for field in fields)
+
+        # The rows are read in chunks, so that only a chunk of them is held as tuples at once.
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            check_budget()
+            for field, column in zip(fields, zip(*chunk)):
+                if field in TIME_FIELDS:
+                    chunks[field].append(numpy.array(column, dtype='datetime64[us]').astype(numpy.int64))
+                elif field in INTEGER_FIELDS:
+                    chunks[field].append(numpy.array(column, dtype=numpy.int64))
+                else:
+                    chunks[field].append(numpy.array(column, dtype=object))
+
+        self.times = {}
+        self.numbers = {}
+        self.codes = {}
+        self.values = {}
+        for field in fields:
+            if field in TIME_FIELDS or field in INTEGER_FIELDS:
+                column = numpy.concatenate(chunks[field]) if chunks[field] else numpy.zeros(0, dtype=numpy.int64)
+                (self.times if field in TIME_FIELDS else self.numbers)[field] = column
+            else:
+                column = numpy.concatenate(chunks[field]) if chunks[field] else numpy.zeros(0, dtype=object)
+                self.values[field], self.codes[field] = numpy.unique(column, return_inverse=True)
+
+
+def to_day(days):
+    return EPOCH + timedelta(int(days))
+
+
+def top_values(values, counts, limit, other=None):
+    """
+    Return the values with the highest counts like utils.top_counts(), ordered by count and then by value,
+    as the values are sorted and the sort is stable. Values with a count of 0 are left out.
+    """
+    order = numpy.argsort(-counts, kind='mergesort')[:limit]
+    order = order[counts[order] > 0]
+
+    top = OrderedDict((values[index], int(counts[index])) for index in order)
+
+    others = int(counts.sum()) - sum(top.values())
+    if other is not None and others:
+        top[other] = others
+
+    return top
+
+
+def value_counts(columns, field, exclude=()):
+    """Count the calls for each value of the given field, with a count of 0 for the excluded values."""
+    values = columns.values[field]
+    counts = numpy.bincount(columns.codes[field], minlength=len(values))
+    for index, value in enumerate(values):
+        if value in exclude:
+            counts[index] = 0
+
+    return counts
+
+
+def distinct_counts(codes, size, distinct_codes, distinct_size):
+    """Count the distinct distinct_codes of each of the given codes, which are below size."""
+    pairs = numpy.unique(codes.astype(numpy.int64) * max(distinct_size, 1) + distinct_codes)
+
+    return numpy.bincount(pairs // max(distinct_size, 1), minlength=size)
+
+
+def calls_per_day(columns):
+    """Return the distinct UniqueCallIDs of the calls that joined on each day."""
+    days = columns.times['jointime'] // DAY
+    if not len(days):
+        return OrderedDict()
+
+    first_day = days.min()
+    counts = distinct_counts(days - first_day, days.max() - first_day + 1,
+                             columns.codes['uniquecallid'], len(columns.values['uniquecallid']))
+
+    return OrderedDict((to_day(first_day + offset), int(counts[offset])) for offset in numpy.flatnonzero(counts))
+
+
+def overview(columns):
+    """Return the same results as queries.calculate_overview() from the columns of its calls."""
+    rooms = distinct_counts(columns.codes['conferencename'], len(columns.values['conferencename']),
+                            columns.codes['uniquecallid'], len(columns.values['uniquecallid']))
+
+    return {
+        'users': top_values(columns.values['callername'], value_counts(columns, 'callername'), 10),
+        'rooms': top_values(columns.values['conferencename'], rooms, 10),
+        'calls_per_day': calls_per_day(columns),
+        'platforms': top_values(columns.values['applicationname'],
+                                value_counts(columns, 'applicationname', exclude=(None, '')), 10, other='Other'),
+        'operating_systems': top_values(columns.values['applicationos'],
+                                        value_counts(columns, 'applicationos', exclude=(None, '')), 10,
+                                        other='Other'),
+    }
+
+
+def concurrent_lines_per_day(columns):
+    """
+    Return the maximum concurrent lines of each day like utils.concurrent_lines_per_day(), without a sweep.
+
+    The calls of each line (caller name) are merged into the intervals when the line is active, by sorting them
+    by line and join time and keeping the furthest leave time so far of the line with a cumulative maximum.
+    The active lines at the time of each join and leave are then the intervals that started by that time
+    minus the ones that ended before it, found with binary searches.
+    """
+    joins, leaves = columns.times['jointime'], columns.times['leavetime']
+    lines = columns.codes['callername']
+    if not len(joins):
+        return defaultdict(int)
+
+    # A call that leaves before it joins wraps around, so the line is active from the first time until its leave
+    # time and again from its join time until the last time.
+    wrapped = joins > leaves
+    first, last = min(joins.min(), leaves.min()), max(joins.max(), leaves.max())
+    starts = numpy.concatenate([numpy.where(wrapped, first, joins), joins[wrapped]])
+    ends = numpy.concatenate([leaves, numpy.full(wrapped.sum(), last, dtype=numpy.int64)])
+    lines = numpy.concatenate([lines, lines[wrapped]]).astype(numpy.int64)
+
+    # The times are replaced by their rank, so that the offset of each line below cannot overflow.
+    times, ranks = numpy.unique(numpy.concatenate([starts, ends]), return_inverse=True)
+    starts, ends = ranks[:len(starts)], ranks[len(starts):]
+
+    order = numpy.lexsort((starts, lines))
+    starts, ends, lines = starts[order], ends[order], lines[order]
+
+    # Offsetting each line by more than any rank keeps the cumulative maximum within the line.
+    reach = numpy.maximum.accumulate(ends + lines * len(times)) - lines * len(times)
+    new_interval = numpy.ones(len(starts), dtype=bool)
+    new_interval[1:] = (lines[1:] != lines[:-1]) | (starts[1:] > reach[:-1])
+
+    first_calls = numpy.flatnonzero(new_interval)
+    interval_starts = numpy.sort(starts[first_calls])
+    interval_ends = numpy.sort(numpy.maximum.reduceat(ends, first_calls))
+
+    # The lines are counted at the times of the joins and leaves, both inclusive.
+    event_times = numpy.unique(numpy.concatenate([joins, leaves]))
+    event_ranks = numpy.searchsorted(times, event_times)
+    active_lines = numpy.searchsorted(interval_starts, event_ranks, side='right') - \
+        numpy.searchsorted(interval_ends, event_ranks, side='left')
+
+    days, first_events = numpy.unique(event_times // DAY, return_index=True)
+    peaks = numpy.maximum.reduceat(active_lines, first_events)
+
+    max_lines_by_day = defaultdict(int)
+    for day, peak in zip(days, peaks):
+        max_lines_by_day[to_day(day)] = int(peak)
+
+    return max_lines_by_day
@@ -2,43 +2,57 @@ import json
 import plotly
 
 
-def generate_graph(data, title, username, start_date, end_date):
-    graphs = [
-        dict(
-            data=[
-                dict(
-                    x=data.keys(),
-                    y=data.values(),
-                    type='bar',
-                ),
-            ],
-            layout=dict(
-                title=title + ' for ' + username + ' between ' + str(start_date) + ' and ' + str(end_date),
-            )
+def bar_graph(data, title, username, start_date, end_date):
+    return dict(
+        data=[
+            dict(
+                x=data.keys(),
+                y=data.values(),
+                type='bar',
+            ),
+        ],
+        layout=dict(
+            title=title + ' for ' + username + ' between ' + str(start_date) + ' and ' + str(end_date),
+        )
+    )
+
+
+def pie_chart(data, title, username, start_date, end_date):
+    return dict(
+        data=[
+            dict(
+                labels=data.keys(),
+                values=data.values(),
+                type='pie',
+            ),
+        ],
+        layout=dict(
+            title=title + ' for ' + username + ' between ' + str(start_date) + ' and ' + str(end_date)
         )
-    ]
+    )
+
+
+def render_graphs(graphs):
     ids = ['graph-{}'.format(i) for i, _ in enumerate(graphs)]
     graph_json = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
 
     return ids, graph_json
 
 
+def generate_graph(data, title, username, start_date, end_date):
+    return render_graphs([bar_graph(data, title, username, start_date, end_date)])
+
+
 def generate_pie_chart(data, title, username, start_date, end_date):
-    graphs = [
-        dict(
-            data=[
-                dict(
-                    labels=data.keys(),
-                    values=data.values(),
-                    type='pie',
-                ),
-            ],
-            layout=dict(
-                title=title + ' for ' + username + ' between ' + str(start_date) + ' and ' + str(end_date)
-            )
-        )
-    ]
-    ids = ['graph-{}'.format(i) for i, _ in enumerate(graphs)]
-    graph_json = json.dumps(graphs, cls=plotly.utils.PlotlyJSONEncoder)
+    return render_graphs([pie_chart(data, title, username, start_date, end_date)])
 
-    return ids, graph_json
+
+def generate_overview(overview, username, start_date, end_date):
+    """Return the graphs of all the reports of the overview, to be shown on a single page."""
+    return render_graphs([
+        bar_graph(overview['users'], '10 most active users', username, start_date, end_date),
+        bar_graph(overview['rooms'], '10 most active rooms', username, start_date, end_date),
+        bar_graph(overview['calls_per_day'], 'Calls per day', username, start_date, end_date),
+        pie_chart(overview['platforms'], 'Vidyo Platform stats', username, start_date, end_date),
+        pie_chart(overview['operating_systems'], 'OS stats', username, start_date, end_date),
+    ])
@@ -0,0 +1,61 @@
+import redis
+from django.conf import settings
+from django.db.models import Count
+
+from .cache import get_client
+from .models import Call
+from .queries import calculate_current_calls
+from .replica import read_database
+
+# Hash of the number of calls in progress of each Tenant and of 'All', written by the poll_current_calls task.
+COUNTS_KEY = 'current-calls'
+
+
+def count_current_calls():
+    """Return the number of calls in progress of each Tenant and of 'All', with a single query."""
+    calls = Call.objects.using(read_database('platformc')). \
+        filter(callstate="IN PROGRESS"). \
+        values('tenantname'). \
+        annotate(count=Count('callid'))
+
+    counts = dict((call['tenantname'], call['count']) for call in calls)
+    counts['All'] = sum(counts.values())
+
+    return counts
+
+
+def update_current_calls():
+    """
+    Store the current calls in Redis, where the Current Calls pages read them.
+    The counts expire after a few poll intervals, so that a stopped poller is not mistaken for no calls.
+    """
+    client = get_client()
+    counts = dict((tenant, str(count)) for tenant, count in count_current_calls().items())
+
+    pipeline = client.pipeline()
+    pipeline.delete(COUNTS_KEY)
+    pipeline.hmset(COUNTS_KEY, counts)
+    pipeline.expire(COUNTS_KEY, 3 * getattr(settings, 'CURRENT_CALLS_INTERVAL', 10))
+    pipeline.execute()
+
+
+def live_current_calls(username):
+    """
+    Return the number of calls in progress of the given Tenant, as stored by the poller.
+    Without Redis, if it is down or if the poller is not running, the calls are counted in the database.
+    """
+    client = get_client()
+    if client is not None:
+        pipeline = client.pipeline()
+        pipeline.exists(COUNTS_KEY)
+        pipeline.hget(COUNTS_KEY, username)
+        try:
+            polled, count = pipeline.execute()
+        except redis.RedisError:
+            polled = False
+
+        if polled:
+            return int(count or 0)
+
+    return calculate_current_calls(username)
+
@@ -0,0 +1,65 @@
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+
+from dashboard.benchmark import run_benchmarks, compare_results, load_results, save_results
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%d/%m/%Y').date()
+
+
+class Command(BaseCommand):
+    help = 'Time the report functions against the given database and save the timings, query counts ' \
+           'and peak memory as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help='Database alias to run the reports against. Defaults to "default".')
+        parser.add_argument('--tenant', default='All', help='Tenant of the reports. Defaults to "All".')
+        parser.add_argument('--start-date', default=date.today() - timedelta(30), type=parse_date,
+                            help='First day of the reports as dd/mm/yyyy. Defaults to 30 days ago.')
+        parser.add_argument('--end-date', default=date.today() - timedelta(1), type=parse_date,
+                            help='Last day of the reports as dd/mm/yyyy. Defaults to yesterday.')
+        parser.add_argument('--repeat', default=3, type=int,
+                            help='Number of times to run each function, keeping the fastest. Defaults to 3.')
+        parser.add_argument('--output', default='benchmark.json',
+                            help='File to save the results to. Defaults to "benchmark.json".')
+        parser.add_argument('--compare', help='Results file of a previous run to compare the timings with.')
+        parser.add_argument('--threshold', default=0.2, type=float,
+                            help='Slowdown over the previous run that counts as a regression. Defaults to 0.2.')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        if database not in connections.databases:
+            raise CommandError('Unknown database alias "%s".' % database)
+
+        # Measure the calculations, not the report cache.
+        with override_settings(REPORT_CACHE_URL=None):
+            results = run_benchmarks(options['tenant'], database, options['start_date'], options['end_date'],
+                                     options['repeat'])
+        save_results(results, options['output'])
+
+        self.stdout.write(self.style.MIGRATE_HEADING('%d calls in "%s" (%s)' % (results['calls'], database,
+                                                                                 results['vendor'])))
+        for result in results['results']:
+            self.stdout.write('  %(name)-42s %(seconds)10.4fs %(queries)4d queries %(peak_memory_kb)8d KB' % result)
+
+        if options['compare']:
+            regressions = 0
+            self.stdout.write(self.style.MIGRATE_HEADING('Compared with %s' % options['compare']))
+            for name, before, after, regressed in compare_results(load_results(options['compare']), results,
+                                                                  options['threshold']):
+                line = '  %-42s %10.4fs -> %10.4fs' % (name, before, after)
+                if regressed:
+                    regressions += 1
+                    self.stdout.write(self.style.WARNING(line + '  <-- REGRESSION'))
+                else:
+                    self.stdout.write(line)
+
+            if regressions:
+                self.stdout.write(self.style.WARNING('%d regressions found.' % regressions))
+
+        self.stdout.write(self.style.SUCCESS('Results saved to %s.' % options['output']))
@@ -0,0 +1,73 @@
+from datetime import date, datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from dashboard.queries import *
+from dashboard.replica import call_database
+
+# EXPLAIN access types that read every row of the table or of one of its indexes.
+full_scan_types = {
+    'ALL': 'FULL TABLE SCAN',
+    'index': 'FULL INDEX SCAN',
+}
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%d/%m/%Y').date()
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the queries of each report against the given database and flag the full scans.'
+
+    def add_arguments(self, parser):
+        yesterday = (date.today() - timedelta(1)).strftime('%d/%m/%Y')
+
+        parser.add_argument('--database', default='platformc',
+                            help='Database alias to explain the queries against. Defaults to "platformc".')
+        parser.add_argument('--tenant', default='All', help='Tenant of the reports. Defaults to "All".')
+        parser.add_argument('--start-date', default=yesterday, type=parse_date,
+                            help='First day of the reports as dd/mm/yyyy. Defaults to yesterday.')
+        parser.add_argument('--end-date', default=yesterday, type=parse_date,
+                            help='Last day of the reports as dd/mm/yyyy. Defaults to yesterday.')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        if database not in connections.databases:
+            raise CommandError('Unknown database alias "%s".' % database)
+
+        # With REPORTS_FROM_REPLICAS the calls are read from the replica, so its queries are the ones to explain.
+        connection = connections[call_database(database)]
+        if connection.vendor != 'mysql':
+            raise CommandError('EXPLAIN output is only interpreted for MySQL databases.')
+
+        full_scans = 0
+        for title, report in RANGE_REPORTS:
+            # Run the report once to capture the SQL it sends, then explain each statement. The report cache,
+            # the archives and the rollups are bypassed, as the report would not query the calls otherwise.
+            with override_settings(REPORT_CACHE_URL=None, CALL_ARCHIVES={}, READ_ROLLUPS=False), \
+                    CaptureQueriesContext(connection) as context:
+                report(options['tenant'], database, options['start_date'], options['end_date'])
+
+            self.stdout.write(self.style.MIGRATE_HEADING(title))
+            for query in context.captured_queries:
+                self.stdout.write('  ' + query['sql'])
+
+                with connection.cursor() as cursor:
+                    cursor.execute('EXPLAIN ' + query['sql'])
+                    columns = [column[0] for column in cursor.description]
+                    plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+                for step in plan:
+                    line = '    table=%(table)s type=%(type)s key=%(key)s rows=%(rows)s extra=%(Extra)s' % step
+                    if step['type'] in full_scan_types:
+                        full_scans += 1
+                        self.stdout.write(self.style.WARNING(line + '  <-- ' + full_scan_types[step['type']]))
+                    else:
+                        self.stdout.write(line)
+
+        if full_scans:
+            self.stdout.write(self.style.WARNING('%d full scans found.' % full_scans))
+        else:
+            self.stdout.write(self.style.SUCCESS('No full scans found.'))
@@ -0,0 +1,55 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Max
+
+from dashboard.archive import export_archive, open_archive
+from dashboard.columnar import numpy
+from dashboard.models import Call
+
+
+class Command(BaseCommand):
+    help = 'Export the calls of a CDR database into its read-only archive (see CALL_ARCHIVES), ' \
+           'or check the archive against the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='ajenta.io', choices=['ajenta.io', 'platformc'],
+                            help='CDR database to export. Defaults to ajenta.io.')
+        parser.add_argument('--force', action='store_true',
+                            help='Replace the archive if it already exists.')
+        parser.add_argument('--verify', action='store_true',
+                            help='Only check that the archive has the same calls as the database.')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        path = getattr(settings, 'CALL_ARCHIVES', {}).get(database)
+        if path is None:
+            raise CommandError('CALL_ARCHIVES has no archive for the "%s" database.' % database)
+        if numpy is None:
+            raise CommandError('NumPy is required to read and write the archives.')
+
+        if options['verify']:
+            return self.verify(database)
+
+        if os.path.exists(path) and not options['force']:
+            raise CommandError('The archive "%s" already exists. Use --force to replace it.' % path)
+
+        meta = export_archive(database, path)
+        self.stdout.write(self.style.SUCCESS('%d calls of "%s" exported to "%s".' % (meta['calls'], database, path)))
+
+    def verify(self, database):
+        archive = open_archive(database)
+        if archive is None:
+            raise CommandError('The archive of the "%s" database has not been exported yet.' % database)
+
+        live = Call.objects.using(database).aggregate(calls=Count('callid'), last_callid=Max('callid'))
+        archived = dict((key, archive.meta[key]) for key in live)
+        if archived != live:
+            raise CommandError('The archive of "%s" is out of date: it has %d calls up to CallID %s, '
+                               'while the database has %d calls up to CallID %s.' % (
+                                   database, archived['calls'], archived['last_callid'],
+                                   live['calls'], live['last_callid']))
+
+        self.stdout.write(self.style.SUCCESS('The archive of "%s" has all its %d calls, up to CallID %s.' % (
+            database, live['calls'], live['last_callid'])))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from dashboard.benchmark import generate_calls
+
+
+class Command(BaseCommand):
+    help = 'Insert synthetic calls into the ConferenceCall2 table of a local database, to run the benchmarks on.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default',
+                            help='Database alias to insert the calls into. Defaults to "default".')
+        parser.add_argument('--rows', default=10000, type=int,
+                            help='Number of calls to insert (e.g 10000, 100000 or 1000000). Defaults to 10000.')
+        parser.add_argument('--days', default=30, type=int,
+                            help='Number of days up to yesterday to spread the calls over. Defaults to 30.')
+        parser.add_argument('--seed', default=0, type=int,
+                            help='Seed of the random calls, so that the same calls are generated again.')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        if database not in connections.databases:
+            raise CommandError('Unknown database alias "%s".' % database)
+        if database in ('ajenta.io', 'platformc'):
+            raise CommandError('Synthetic calls cannot be inserted into the "%s" CDR database.' % database)
+
+        generate_calls(database, options['rows'], options['days'], options['seed'])
+        self.stdout.write(self.style.SUCCESS('%d calls inserted into "%s".' % (options['rows'], database)))
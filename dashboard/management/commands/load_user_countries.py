@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.models import UserCountry
+from dashboard.queries import sync_user_countries
+
+
+class Command(BaseCommand):
+    help = "Load the country of each user from 'UsersExport.csv' into the UserCountry table."
+
+    def handle(self, *args, **options):
+        sync_user_countries(force=True)
+        self.stdout.write(self.style.SUCCESS('%d users loaded.' % UserCountry.objects.count()))
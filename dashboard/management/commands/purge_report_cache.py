@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from dashboard.cache import purge_reports
+
+
+class Command(BaseCommand):
+    help = 'Delete the cached results of the reports from Redis.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', default='*',
+                            help='Name of the calculate_* function to purge (e.g calculate_user_stats). '
+                                 'Defaults to all the reports.')
+
+    def handle(self, *args, **options):
+        purged = purge_reports(options['report'])
+        self.stdout.write(self.style.SUCCESS('%d cached results deleted.' % purged))
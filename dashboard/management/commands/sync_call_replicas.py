@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from dashboard.replica import replica_of
+from dashboard.tasks import locked_sync
+
+
+class Command(BaseCommand):
+    help = 'Copy the new and updated calls of the CDR databases into their local replicas (see CALL_REPLICAS).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', choices=['ajenta.io', 'platformc'],
+                            help='CDR database to sync, which can be repeated. Defaults to both.')
+
+    def handle(self, *args, **options):
+        for database in options['database'] or ['ajenta.io', 'platformc']:
+            if replica_of(database) is None:
+                raise CommandError('CALL_REPLICAS has no replica for the "%s" database.' % database)
+
+            synced = locked_sync(database)
+            if synced is None:
+                self.stdout.write(self.style.WARNING('%s: skipped, as another sync of it is still running.' % database))
+                continue
+
+            copied, updated = synced
+            self.stdout.write(self.style.SUCCESS('%s: %d new calls copied to "%s" and %d calls updated.' % (
+                database, copied, replica_of(database), updated)))
@@ -0,0 +1,294 @@
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import redis
+from django.db import connections
+
+from .cache import get_client
+from .replica import call_database
+
+KEY_PREFIX = 'metrics'
+
+# Upper bounds in seconds of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The metrics exposed on /metrics, with their Prometheus type and help text.
+# The histograms are the latencies, while the summaries only have a sum and a count.
+METRICS = OrderedDict([
+    ('dashboard_report_seconds', ('histogram', 'Wall time of a calculate_* function for one database.')),
+    ('dashboard_report_sql_seconds', ('histogram', 'Time of a calculate_* function spent in SQL queries.')),
+    ('dashboard_report_python_seconds', ('histogram', 'Time of a calculate_* function spent in Python.')),
+    ('dashboard_report_queries', ('summary', 'SQL queries of a calculate_* function.')),
+    ('dashboard_report_rows', ('summary', 'Rows fetched by a calculate_* function.')),
+    ('dashboard_view_seconds', ('histogram', 'Wall time of a report view, including rendering.')),
+    ('dashboard_view_response_bytes', ('summary', 'Size of the responses of a report view.')),
+    ('dashboard_task_seconds', ('histogram', 'Wall time of a Celery task.')),
+    ('dashboard_task_sql_seconds', ('histogram', 'Time of a Celery task spent in SQL queries.')),
+    ('dashboard_task_python_seconds', ('histogram', 'Time of a Celery task spent in Python.')),
+    ('dashboard_task_queries', ('summary', 'SQL queries of a Celery task.')),
+    ('dashboard_task_rows', ('summary', 'Rows fetched by a Celery task.')),
+])
+
+# The metrics are kept in Redis, so that /metrics shows the ones of every gunicorn and Celery worker.
+# Without Redis (e.g in development and while testing) each process keeps its own.
+local_metrics = {}
+local_lock = threading.Lock()
+
+
+def metric_key(name):
+    return '%s:%s' % (KEY_PREFIX, name)
+
+
+def increment(name, increments):
+    """Add the given {(labels, suffix): value} to the series of the given metric."""
+    increments = dict((json.dumps(field), value) for field, value in increments.items())
+
+    client = get_client()
+    if client is None:
+        with local_lock:
+            local_metrics.setdefault(name, Counter()).update(increments)
+        return
+
+    try:
+        pipeline = client.pipeline(transaction=False)
+        for field, value in increments.items():
+            pipeline.hincrbyfloat(metric_key(name), field, value)
+        pipeline.execute()
+    except redis.RedisError:
+        pass
+
+
+def read_metric(name):
+    """Return {(labels, suffix): value} of the series of the given metric."""
+    client = get_client()
+    if client is None:
+        with local_lock:
+            series = dict(local_metrics.get(name, {}))
+    else:
+        try:
+            series = client.hgetall(metric_key(name))
+        except redis.RedisError:
+            series = {}
+
+    metric = {}
+    for field, value in series.items():
+        labels, suffix = json.loads(field)
+        metric[tuple(tuple(label) for label in labels), suffix] = float(value)
+
+    return metric
+
+
+def observe(name, value, **labels):
+    """Record a value of the given metric, in its latency bucket if it is a histogram."""
+    labels = tuple(sorted(labels.items()))
+    increments = {(labels, 'sum'): value, (labels, 'count'): 1}
+
+    if METRICS[name][0] == 'histogram':
+        bucket = next((bound for bound in LATENCY_BUCKETS if value <= bound), '+Inf')
+        increments[labels, str(bucket)] = 1
+
+    increment(name, increments)
+
+
+def format_labels(labels):
+    return '{%s}' % ','.join('%s="%s"' % (label, unicode(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for label, value in labels)
+
+
+def render_metrics():
+    """Return all the metrics in the Prometheus text format, with the histogram buckets made cumulative."""
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, kind))
+
+        metric = read_metric(name)
+        for labels in sorted(set(labels for labels, _ in metric)):
+            if kind == 'histogram':
+                cumulative = 0
+                for bound in LATENCY_BUCKETS + ('+Inf',):
+                    cumulative += metric.get((labels, str(bound)), 0)
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bound),)), cumulative))
+
+            lines.append('%s_sum%s %r' % (name, format_labels(labels), metric.get((labels, 'sum'), 0)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), metric.get((labels, 'count'), 0)))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Measurement(object):
+    def __init__(self):
+        self.sql_seconds = 0
+        self.queries = 0
+        self.rows = 0
+
+
+class MeasuredCursor(object):
+    """Wrap a database cursor to add up the time of its queries and the number of rows fetched from it."""
+
+    def __init__(self, cursor, measurement):
+        self.cursor = cursor
+        self.measurement = measurement
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.measurement.rows += 1
+            yield row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def timed(self, method, *args):
+        started = time.time()
+        try:
+            return getattr(self.cursor, method)(*args)
+        finally:
+            self.measurement.sql_seconds += time.time() - started
+
+    def execute(self, *args):
+        self.measurement.queries += 1
+        return self.timed('execute', *args)
+
+    def executemany(self, *args):
+        self.measurement.queries += 1
+        return self.timed('executemany', *args)
+
+    def callproc(self, *args):
+        self.measurement.queries += 1
+        return self.timed('callproc', *args)
+
+    def fetchone(self):
+        row = self.timed('fetchone')
+        if row is not None:
+            self.measurement.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.timed('fetchmany', *args)
+        self.measurement.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.timed('fetchall')
+        self.measurement.rows += len(rows)
+        return rows
+
+
+@contextmanager
+def measured_queries(databases):
+    """Measure the queries sent to the given databases by this thread, whose connections are thread local."""
+    measurement = Measurement()
+    patched = []
+
+    for database in databases:
+        connection = connections[database]
+        for attr in ('make_cursor', 'make_debug_cursor'):
+            # Keep the cursor factory of an enclosing measurement, if any, to put it back afterwards.
+            patched.append((connection, attr, connection.__dict__.get(attr)))
+            make_cursor = getattr(connection, attr)
+            setattr(connection, attr, lambda cursor, make_cursor=make_cursor: MeasuredCursor(make_cursor(cursor),
+                                                                                              measurement))
+
+    try:
+        yield measurement
+    finally:
+        for connection, attr, previous in reversed(patched):
+            if previous is None:
+                delattr(connection, attr)
+            else:
+                setattr(connection, attr, previous)
+
+
+@contextmanager
+def instrumented(prefix, databases, **labels):
+    """
+    Record the wall, SQL and Python time, the number of queries and the rows fetched of the enclosed code,
+    as the <prefix>_* metrics with the given labels.
+    """
+    started = time.time()
+    with measured_queries(databases) as measurement:
+        yield
+
+    seconds = time.time() - started
+    observe(prefix + '_seconds', seconds, **labels)
+    observe(prefix + '_sql_seconds', measurement.sql_seconds, **labels)
+    observe(prefix + '_python_seconds', max(seconds - measurement.sql_seconds, 0), **labels)
+    observe(prefix + '_queries', measurement.queries, **labels)
+    observe(prefix + '_rows', measurement.rows, **labels)
+
+
+def measured_databases(selected_db):
+    """
+    Return the aliases that the reports of the given CDR database query: the database, the one its calls are read
+    from (a local or read replica, see call_database()) and 'default', which has the DailyRollup table.
+    """
+    return {selected_db, call_database(selected_db), 'default'}
+
+
+def instrumented_report(function):
+    """Record the dashboard_report_* metrics of a calculate_* function, by report and database."""
+    @wraps(function)
+    def wrapper(username, selected_db, start_date, end_date, **kwargs):
+        databases = measured_databases(selected_db)
+        with instrumented('dashboard_report', databases, report=function.__name__, database=selected_db):
+            return function(username, selected_db, start_date, end_date, **kwargs)
+
+    return wrapper
+
+
+def instrumented_task(*cdr_databases):
+    """
+    Record the dashboard_task_* metrics of a Celery task, measuring the queries of the reports of the given
+    CDR databases (see measured_databases()), wherever they are read from when the task runs.
+    """
+    def decorator(task):
+        @wraps(task)
+        def wrapper(*args, **kwargs):
+            databases = set().union(*[measured_databases(database) for database in cdr_databases])
+            with instrumented('dashboard_task', databases, task=task.__name__):
+                return task(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def instrumented_view(view):
+    """Record the wall time and the response size of a report view, after its streaming content if any."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        started = time.time()
+        response = view(request, *args, **kwargs)
+
+        if response.streaming:
+            response.streaming_content = measured_content(response.streaming_content, view.__name__, started)
+        else:
+            record_response(view.__name__, started, len(response.content))
+
+        return response
+
+    return wrapper
+
+
+def measured_content(content, view, started):
+    size = 0
+    for chunk in content:
+        size += len(chunk)
+        yield chunk
+
+    record_response(view, started, size)
+
+
+def record_response(view, started, size):
+    observe('dashboard_view_seconds', time.time() - started, view=view)
+    observe('dashboard_view_response_bytes', size, view=view)
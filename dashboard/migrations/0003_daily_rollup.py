@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:39
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0002_auto_20161018_1047'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(max_length=32)),
+                ('tenantname', models.CharField(max_length=128)),
+                ('day', models.DateField()),
+                ('calls', models.IntegerField(default=0)),
+                ('unique_calls', models.IntegerField(default=0)),
+                ('total_minutes', models.FloatField(default=0)),
+                ('concurrent_lines', models.IntegerField(default=0)),
+                ('gateway_ports', models.IntegerField(default=0)),
+                ('platforms', models.TextField(default='{}')),
+                ('operating_systems', models.TextField(default='{}')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RollupProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('database', models.CharField(max_length=32, unique=True)),
+                ('last_day', models.DateField(blank=True, null=True)),
+                ('last_callid', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyrollup',
+            unique_together=set([('database', 'tenantname', 'day')]),
+        ),
+    ]
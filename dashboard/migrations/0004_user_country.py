@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.1 on 2026-10-18 12:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0003_daily_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserCountry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=200, unique=True)),
+                ('country', models.CharField(max_length=128)),
+                ('loaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
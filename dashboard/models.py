@@ -35,3 +35,45 @@ class Call(models.Model):
     class Meta:
         managed = True
         db_table = 'ConferenceCall2'
+
+
+class DailyRollup(models.Model):
+    """Daily totals of the reports for each database and Tenant, including 'All'. Filled by roll_up_daily_stats."""
+    database = models.CharField(max_length=32)
+    tenantname = models.CharField(max_length=128)
+    day = models.DateField()
+    calls = models.IntegerField(default=0)
+    unique_calls = models.IntegerField(default=0)
+    total_minutes = models.FloatField(default=0)
+    concurrent_lines = models.IntegerField(default=0)
+    gateway_ports = models.IntegerField(default=0)
+    # JSON objects of the number of calls for each platform and operating system.
+    platforms = models.TextField(default='{}')
+    operating_systems = models.TextField(default='{}')
+
+    class Meta:
+        unique_together = ('database', 'tenantname', 'day')
+
+
+class RollupProgress(models.Model):
+    """The last day and the last CallID of each database that have been rolled up into DailyRollup."""
+    database = models.CharField(max_length=32, unique=True)
+    last_day = models.DateField(blank=True, null=True)
+    last_callid = models.IntegerField(default=0)
+
+
+class UserCountry(models.Model):
+    """The country of each user in 'UsersExport.csv', used by the calls by country report."""
+    username = models.CharField(max_length=200, unique=True)
+    country = models.CharField(max_length=128)
+    loaded_at = models.DateTimeField(auto_now_add=True)
+
+
+class Tenant(models.Model):
+    """The Tenants of each database, with the last CallID seen for them. Filled by refresh_tenants."""
+    database = models.CharField(max_length=32)
+    tenantname = models.CharField(max_length=128)
+    last_callid = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('database', 'tenantname')
@@ -1,35 +1,204 @@
-from collections import OrderedDict, Counter
+import heapq
+import json
+import os
+from datetime import datetime, time, timedelta
+from collections import defaultdict, OrderedDict, Counter
+from itertools import chain, groupby
+from operator import add, itemgetter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q, Max, Min, DurationField, ExpressionWrapper, Case, When, Value, CharField
+from django.db.models.functions import TruncDate, TruncHour
+
+from . import columnar
+from .archive import archived
+from .budget import budgeted, check_budget, deadline_after, within_deadline, CHECK_INTERVAL
+from .cache import cached_report
+from .metrics import instrumented_report
+from .models import Call, DailyRollup, RollupProgress, Tenant, UserCountry
+from .replica import call_database, read_database
+from .utils import read_users_csv, concurrent_lines_per_day, participants_per_call, to_date, top_counts, fan_out, \
+    bucket_days, concurrent_lines_per_bucket, next_bucket, rebucket, length_bucket, histogram_percentile, \
+    in_date_range, LENGTH_BUCKETS, USERS_CSV
+
+# The columns of the CDR report.
+CDR_FIELDS = [field.name for field in Call._meta.fields]
+
+# The DailyRollup fields with the counts of each value of the application columns.
+ROLLUP_FIELDS = {
+    'applicationname': 'platforms',
+    'applicationos': 'operating_systems',
+}
+
+
+def date_range(start_date, end_date, end_field='jointime'):
+    """
+    Return a filter for the calls that joined on or after start_date and whose end_field is on or before end_date.
+
+    The dates are turned into half-open datetime bounds on the raw columns instead of a DATE() of each row,
+    so that MySQL can use an index on them.
+    """
+    start = datetime.combine(start_date, time.min)
+    end = datetime.combine(end_date, time.min) + timedelta(1)
+
+    return Q(jointime__gte=start, **{end_field + '__lt': end})
+
+
+def overlapping_range(start_date, end_date):
+    """
+    Return a filter for the calls that joined in the given date range, or before it and left in or after it.
+
+    These are all the calls that are active during the range, so that the concurrent lines of a day are the same
+    whatever range it is reported or rolled up in.
+    """
+    start = datetime.combine(start_date, time.min)
+    end = datetime.combine(end_date, time.min) + timedelta(1)
+
+    return Q(jointime__gte=start, jointime__lt=end) | Q(jointime__lt=start, leavetime__gte=start)
+
+
+def tenant_calls(username, selected_db, start_date, end_date):
+    """Return the calls of the given Tenant that joined in the given date range."""
+    calls = Call.objects.using(call_database(selected_db)). \
+        filter(date_range(start_date, end_date))
 
-from django.db.models import Count, Q, Max, Min, DurationField, ExpressionWrapper, Avg, Sum, FloatField
+    if username != "All":
+        calls = calls.filter(tenantname=username)
 
-from .models import Call
-from .utils import read_users_csv, concurrent_lines_per_day, participants_per_call
+    return calls
 
 
-def calculate_user_stats(username, selected_db, start_date, end_date):
-    """Return the 10 most active users of the given Tenant for the given date range."""
-    users = Call.objects.using(selected_db). \
-        values_list('callername', flat=True). \
-        filter(jointime__date__range=(start_date, end_date)).all()
+def concurrent_line_calls(username, selected_db, start_date, end_date):
+    """Return the completed calls of the given Tenant active in the given date range that count as concurrent lines."""
+    calls = Call.objects.using(call_database(selected_db)). \
+        values('callername', 'jointime', 'leavetime'). \
+        filter(overlapping_range(start_date, end_date),
+               ~Q(applicationname="VidyoReplay"),
+               ~Q(applicationname="VidyoGateway"),
+               callstate="COMPLETED",
+               leavetime__isnull=False)
+
+    if username != "All":
+        calls = calls.filter(tenantname=username)
+
+    return calls
+
+
+def gateway_port_calls(username, selected_db, start_date, end_date):
+    """Return the completed VidyoGateway calls of the given Tenant active in the given date range."""
+    calls = Call.objects.using(call_database(selected_db)). \
+        values('callername', 'jointime', 'leavetime'). \
+        filter(overlapping_range(start_date, end_date),
+               applicationname="VidyoGateway",
+               callstate="COMPLETED",
+               leavetime__isnull=False)
 
     if username != "All":
-        users = users.filter(tenantname=username)
+        calls = calls.filter(tenantname=username)
+
+    return calls
+
+
+def read_rollups(username, selected_db, start_date, end_date):
+    """
+    Return the DailyRollup rows of the given Tenant for the days of the date range that have been rolled up,
+    and the first day of the range that has to be queried from the calls instead (None if there is none).
+    With READ_ROLLUPS set to False, the whole range is queried from the calls.
+    """
+    start_date, end_date = to_date(start_date), to_date(end_date)
+    if not getattr(settings, 'READ_ROLLUPS', True):
+        return [], start_date
+
+    progress = RollupProgress.objects.filter(database=selected_db).first()
+
+    if progress is None or progress.last_day is None or progress.last_day < start_date:
+        return [], start_date
+
+    last_day = min(progress.last_day, end_date)
+    rollups = DailyRollup.objects. \
+        filter(database=selected_db, tenantname=username, day__range=(start_date, last_day)). \
+        order_by('day')
+
+    if last_day == end_date:
+        return rollups, None
+
+    return rollups, last_day + timedelta(1)
+
+
+def count_top_values(calls, field, limit):
+    """Count the calls for each value of the given field in the database and return the most common ones."""
+    counts = calls.values(field). \
+        annotate(count=Count('callid')). \
+        order_by('-count', field)[:limit]
+
+    return OrderedDict((row[field], row['count']) for row in counts)
+
+
+def count_values(calls, field, count=None, values=None):
+    """
+    Count the calls (or the given Count expression) for each value of the given field in the database.
+    If values is given, only those values are counted.
+    """
+    if values is not None:
+        values = set(values)
+        condition = Q(**{field + '__in': values - {None}})
+        if None in values:
+            condition |= Q(**{field + '__isnull': True})
+        calls = calls.filter(condition)
+
+    counts = calls.values(field).annotate(count=count or Count('callid'))
 
-    top_users = (Counter(users).most_common(10))
-    return OrderedDict(top_users)
+    return Counter(dict((row[field], row['count']) for row in counts))
 
 
+@archived
+def count_tenant_values(username, selected_db, start_date, end_date, field, values=None, distinct=None):
+    """
+    Count the calls of the given Tenant for each value of the given field, or the distinct values of
+    the distinct field if given. If values is given, only those values are counted.
+    """
+    count = Count(distinct, distinct=True) if distinct else None
+
+    return count_values(tenant_calls(username, selected_db, start_date, end_date), field, count=count, values=values)
+
+
+@archived
+def count_application_values(username, selected_db, start_date, end_date, field):
+    """Count the calls of the given Tenant for each value of an application field (platform or OS)."""
+    rollups, start_date = read_rollups(username, selected_db, start_date, end_date)
+
+    counts = Counter()
+    for rollup in rollups:
+        counts.update(json.loads(getattr(rollup, ROLLUP_FIELDS[field])))
+
+    if start_date is not None:
+        calls = tenant_calls(username, selected_db, start_date, end_date). \
+            exclude(**{field + '__isnull': True}). \
+            exclude(**{field: ''})
+
+        counts.update(count_values(calls, field))
+
+    return counts
+
+
+@archived
+@cached_report
+def calculate_user_stats(username, selected_db, start_date, end_date):
+    """Return the 10 most active users of the given Tenant for the given date range."""
+    users = tenant_calls(username, selected_db, start_date, end_date)
+
+    return count_top_values(users, 'callername', 10)
+
+
+@archived
+@cached_report
 def calculate_room_stats(username, selected_db, start_date, end_date):
     """Return the 10 most active rooms of the given Tenant for the given date range."""
-    rooms = Call.objects.using(selected_db). \
+    rooms = tenant_calls(username, selected_db, start_date, end_date). \
         values('conferencename'). \
         annotate(count=Count('uniquecallid', distinct=True)). \
-        filter(jointime__date__range=(start_date, end_date))
-
-    if username != "All":
-        rooms = rooms.filter(tenantname=username)
-
-    rooms = rooms.order_by('-count')[:10]
+        order_by('-count')[:10]
 
     top_rooms = OrderedDict()
     for room in rooms:
@@ -38,177 +207,620 @@ def calculate_room_stats(username, selected_db, start_date, end_date):
     return top_rooms
 
 
+@archived
+@cached_report
 def calculate_calls_per_day(username, selected_db, start_date, end_date):
     """Return the calls made for the given Tenant in the given date range and then group by day."""
-    calls = Call.objects.using(selected_db). \
-        filter(jointime__date__range=(start_date, end_date)). \
-        extra({'date': "date(jointime)"}). \
+    rollups, start_date = read_rollups(username, selected_db, start_date, end_date)
+
+    calls_per_day = OrderedDict()
+    for rollup in rollups:
+        calls_per_day[rollup.day] = rollup.unique_calls
+
+    # Only the days that have not been rolled up yet (usually just today) are queried from the calls.
+    if start_date is None:
+        return calls_per_day
+
+    calls = tenant_calls(username, selected_db, start_date, end_date). \
+        annotate(date=TruncDate('jointime')). \
         values('date'). \
         annotate(count=Count('uniquecallid', distinct=True))
 
-    if username != "All":
-        calls = calls.filter(tenantname=username)
-
-    calls_per_day = OrderedDict()
     for call in calls:
         calls_per_day[call['date']] = call['count']
 
     return calls_per_day
 
 
+@archived
+@cached_report
+def calculate_calls_per_hour(username, selected_db, start_date, end_date):
+    """Return the calls made for the given Tenant in the given date range, grouped by hour in the database."""
+    calls = tenant_calls(username, selected_db, start_date, end_date). \
+        annotate(hour=TruncHour('jointime')). \
+        values('hour'). \
+        annotate(count=Count('uniquecallid', distinct=True)). \
+        order_by('hour')
+
+    return OrderedDict((call['hour'], call['count']) for call in calls)
+
+
+def calculate_calls_per_week(username, selected_db, start_date, end_date, refresh=False):
+    """Return the calls per day of the given Tenant added up by ISO week, starting on Monday."""
+    days = calculate_calls_per_day(username, selected_db, start_date, end_date, refresh=refresh)
+    return rebucket(days, 'week', add)
+
+
+def calculate_calls_per_month(username, selected_db, start_date, end_date, refresh=False):
+    """Return the calls per day of the given Tenant added up by month."""
+    days = calculate_calls_per_day(username, selected_db, start_date, end_date, refresh=refresh)
+    return rebucket(days, 'month', add)
+
+
+@archived
+@cached_report
 def calculate_participants_per_call(username, selected_db, start_date, end_date):
-    """Return the UniqueCallID with maximum number of active participants."""
-    active_parties_dict = {}
-
-    if username == "All":
-        call_ids_list = Call.objects.using(selected_db). \
-            filter(~Q(applicationname="VidyoReplay"),
-                   ~Q(applicationname="VidyoGateway"),
-                   jointime__date__gte=start_date,
-                   leavetime__date__lte=end_date,
-                   callstate="COMPLETED"). \
-            values_list('uniquecallid', flat=True).distinct()
-
-        for id in call_ids_list:
-            parties = Call.objects.using(selected_db). \
-                values('callername', 'jointime', 'leavetime'). \
-                filter(~Q(applicationname="VidyoReplay"),
-                       ~Q(applicationname="VidyoGateway"),
-                       uniquecallid=id,
-                       jointime__date__gte=start_date,
-                       leavetime__date__lte=end_date,
-                       callstate="COMPLETED")
-
-            active_parties_dict[id] = participants_per_call(parties, id)
-    else:
-        call_ids_list = Call.objects.using(selected_db). \
-            filter(~Q(applicationname="VidyoReplay"),
-                   ~Q(applicationname="VidyoGateway"),
-                   tenantname=username,
-                   jointime__date__gte=start_date,
-                   leavetime__date__lte=end_date,
-                   callstate="COMPLETED"). \
-            values_list('uniquecallid', flat=True).distinct()
-
-        for id in call_ids_list:
-            parties = Call.objects.using(selected_db). \
-                values('callername', 'jointime', 'leavetime'). \
-                filter(~Q(applicationname="VidyoReplay"),
-                       ~Q(applicationname="VidyoGateway"),
-                       uniquecallid=id,
-                       tenantname=username,
-                       jointime__date__gte=start_date,
-                       leavetime__date__lte=end_date,
-                       callstate="COMPLETED")
-
-            active_parties_dict[str(id)] = participants_per_call(parties, id)
-
-    return OrderedDict(Counter(active_parties_dict).most_common(10))
+    """Return the 10 UniqueCallIDs with the maximum number of active participants."""
+    parties = Call.objects.using(call_database(selected_db)). \
+        values('uniquecallid', 'callername', 'jointime', 'leavetime'). \
+        filter(date_range(start_date, end_date, end_field='leavetime'),
+               ~Q(applicationname="VidyoReplay"),
+               ~Q(applicationname="VidyoGateway"),
+               callstate="COMPLETED"). \
+        order_by('uniquecallid', 'jointime')
 
+    if username != "All":
+        parties = parties.filter(tenantname=username)
 
-def calculate_average_meeting_length(username, selected_db, start_date, end_date):
-    """Return the average length of the calls made by the given Tenant in the given date range."""
-    length = Call.objects.using(selected_db). \
+    # The parties are grouped by call as they are read, and only the 10 largest calls are kept in a heap rather than
+    # a result per call. The rows themselves are still buffered on the client by MySQLdb.
+    parties_by_call = groupby(parties.iterator(), key=itemgetter('uniquecallid'))
+    participants = ((unique_call_id, participants_per_call(call_parties))
+                    for unique_call_id, call_parties in parties_by_call)
+
+    return OrderedDict(heapq.nlargest(10, participants, key=itemgetter(1)))
+
+
+@archived
+@cached_report
+def calculate_meeting_length_totals(username, selected_db, start_date, end_date):
+    """
+    Return the total length in seconds, the number and the histogram of the lengths (see LENGTH_BUCKETS)
+    of the calls made by the given Tenant in the date range.
+
+    The length of each UniqueCallID is read with a single query and added up as it is read, instead of
+    counting and summing the grouped query in two more queries. The totals of several databases add up.
+    """
+    length = Call.objects.using(call_database(selected_db)). \
         values('uniquecallid'). \
-        filter(jointime__date__gte=start_date,
-               leavetime__date__lte=end_date,
+        filter(date_range(start_date, end_date, end_field='leavetime'),
                callstate="COMPLETED"). \
         annotate(call_length=ExpressionWrapper(Max('leavetime') - Min('jointime'), output_field=DurationField()))
 
     if username != "All":
         length = length.filter(tenantname=username)
 
-    count = length.count()
-    length = length.aggregate(sum=Sum('call_length', output_field=DurationField()))
+    total, count = 0, 0
+    histogram = [0] * (len(LENGTH_BUCKETS) + 1)
+    for call_length in length.values_list('call_length', flat=True).iterator():
+        if not count % CHECK_INTERVAL:
+            check_budget()
+        seconds = call_length.total_seconds()
+        total += seconds
+        count += 1
+        histogram[length_bucket(seconds)] += 1
+
+    return total, count, histogram
+
+
+def calculate_average_meeting_length(username, selected_db, start_date, end_date):
+    """Return the average length of the calls made by the given Tenant in the given date range."""
+    total, count, _ = calculate_meeting_length_totals(username, selected_db, start_date, end_date)
+
+    return average_length(total, count)
+
+
+def length_percentiles(histogram):
+    """Return the median, 90th and 99th percentile in seconds of the meeting lengths of a histogram."""
+    return OrderedDict((percentile, histogram_percentile(histogram, percentile)) for percentile in (50, 90, 99))
+
+
+def average_length(total, count):
     try:
-        return length['sum'].total_seconds() / count
-    except AttributeError:
-        # If there are no calls the length['sum'] will be None. Return 0 instead.
+        return total / count
+    except ZeroDivisionError:
         return 0
 
 
+def count_concurrent_lines(calls):
+    """Return the maximum concurrent lines of each day of the given calls, with NumPy if there are many of them."""
+    fields = ['callername', 'jointime', 'leavetime']
+    rows = columnar.read_calls(calls, fields)
+    if isinstance(rows, columnar.CallColumns):
+        return columnar.concurrent_lines_per_day(rows)
+
+    return concurrent_lines_per_day(dict(zip(fields, row)) for row in rows)
+
+
+@archived
+@cached_report
 def calculate_concurrent_lines(username, selected_db, start_date, end_date):
-    """Return the calls made for the given Tenant in the given date range."""
-    calls = Call.objects.using(selected_db). \
-        values('callername', 'jointime', 'leavetime'). \
-        filter(~Q(applicationname="VidyoReplay"),
-               ~Q(applicationname="VidyoGateway"),
-               jointime__date__gte=start_date,
-               leavetime__date__lte=end_date,
-               callstate="COMPLETED")
+    """Return the maximum concurrent lines of the given Tenant for each day of the given date range."""
+    rollups, start_date = read_rollups(username, selected_db, start_date, end_date)
 
-    if username != "All":
-        calls = calls.filter(tenantname=username)
+    lines = defaultdict(int)
+    for rollup in rollups:
+        if rollup.concurrent_lines:
+            lines[rollup.day] = rollup.concurrent_lines
 
-    return concurrent_lines_per_day(calls)
+    if start_date is None:
+        return lines
 
+    calls = concurrent_line_calls(username, selected_db, start_date, end_date)
 
-def calculate_concurrent_gateway_ports(username, selected_db, start_date, end_date):
-    """Return the calls made for the given Tenant in the given date range."""
-    calls = Call.objects.using(selected_db). \
-        values('callername', 'jointime', 'leavetime'). \
-        filter(applicationname="VidyoGateway",
-               jointime__date__gte=start_date,
-               leavetime__date__lte=end_date,
-               callstate="COMPLETED")
+    lines.update(in_date_range(count_concurrent_lines(calls), start_date, end_date))
+    return lines
 
-    if username != "All":
-        calls = calls.filter(tenantname=username)
 
-    return concurrent_lines_per_day(calls)
+@archived
+@cached_report
+def calculate_concurrent_lines_per_hour(username, selected_db, start_date, end_date):
+    """Return the maximum concurrent lines of the given Tenant for each hour of the given date range."""
+    calls = concurrent_line_calls(username, selected_db, start_date, end_date)
 
+    return in_date_range(concurrent_lines_per_bucket(calls, 'hour'), start_date, end_date)
 
-def calculate_calls_by_country(username, selected_db, start_date, end_date):
-    """Return CallerIDs for the given Tenant in the given date range."""
-    calls = Call.objects.using(selected_db). \
-        values_list('callerid', flat=True). \
-        filter(jointime__date__gte=start_date, leavetime__date__lte=end_date).all()
 
-    if username != "All":
-        calls = calls.filter(tenantname=username)
+def calculate_concurrent_lines_per_week(username, selected_db, start_date, end_date, refresh=False):
+    """Return the maximum concurrent lines of the given Tenant for each ISO week, from its maximum of each day."""
+    days = calculate_concurrent_lines(username, selected_db, start_date, end_date, refresh=refresh)
+    return rebucket(days, 'week', max)
 
-    # Create a dictionary from the 'UsersExport.csv' file
-    users_dict = read_users_csv()
 
-    # Return a count of the countries and filter out Guests with undefined values
-    return Counter([users_dict.get(caller) for caller in calls if caller != 'Guest'])
+def calculate_concurrent_lines_per_month(username, selected_db, start_date, end_date, refresh=False):
+    """Return the maximum concurrent lines of the given Tenant for each month, from its maximum of each day."""
+    days = calculate_concurrent_lines(username, selected_db, start_date, end_date, refresh=refresh)
+    return rebucket(days, 'month', max)
 
 
-def calculate_platform_stats(username, selected_db, start_date, end_date):
-    """Return Vidyo platforms used by the Tenant in the given date range."""
-    platforms = Call.objects.using(selected_db). \
-        values_list('applicationname', flat=True). \
-        filter(jointime__date__range=(start_date, end_date)).all()
+@archived
+@cached_report
+def calculate_concurrent_gateway_ports(username, selected_db, start_date, end_date):
+    """Return the maximum concurrent VidyoGateway ports of the given Tenant for each day of the given date range."""
+    rollups, start_date = read_rollups(username, selected_db, start_date, end_date)
 
-    if username != "All":
-        platforms = platforms.filter(tenantname=username)
+    ports = defaultdict(int)
+    for rollup in rollups:
+        if rollup.gateway_ports:
+            ports[rollup.day] = rollup.gateway_ports
 
-    return Counter(filter(None, platforms))
+    if start_date is None:
+        return ports
 
+    calls = gateway_port_calls(username, selected_db, start_date, end_date)
 
-def calculate_os_stats(username, selected_db, start_date, end_date):
-    """Return Operating Systems used byt the Tenant in the given date range."""
-    os = Call.objects.using(selected_db). \
-        values_list('applicationos', flat=True). \
-        filter(jointime__date__range=(start_date, end_date)).all()
+    ports.update(in_date_range(count_concurrent_lines(calls), start_date, end_date))
+    return ports
+
+
+def sync_user_countries(force=False):
+    """Load 'UsersExport.csv' into the UserCountry table if the file changed since it was last loaded."""
+    modified = datetime.fromtimestamp(os.path.getmtime(USERS_CSV))
+    loaded = UserCountry.objects.aggregate(loaded=Max('loaded_at'))['loaded']
+
+    if not force and loaded is not None and loaded >= modified:
+        return False
+
+    users = read_users_csv()
+    with transaction.atomic():
+        UserCountry.objects.all().delete()
+        UserCountry.objects.bulk_create([UserCountry(username=username, country=country)
+                                         for username, country in users.iteritems() if country is not None])
+
+    return True
+
+
+@archived
+@cached_report
+def calculate_calls_by_country(username, selected_db, start_date, end_date):
+    """
+    Return the number of calls of each country for the given Tenant in the given date range.
+
+    The UserCountry table is in a different database, so the country of each CallerID is sent
+    to the database as a CASE expression and the calls are grouped by it there.
+    The table is kept up to date by sync_user_countries().
+    """
+    users_per_country = defaultdict(list)
+    for user, country in UserCountry.objects.values_list('username', 'country'):
+        users_per_country[country].append(user)
+
+    country = Case(*[When(callerid__in=users, then=Value(country)) for country, users in users_per_country.items()],
+                   default=Value(None), output_field=CharField())
+
+    # Guests are left out, while the users missing from 'UsersExport.csv' are counted as None.
+    calls = Call.objects.using(call_database(selected_db)). \
+        filter(date_range(start_date, end_date, end_field='leavetime')). \
+        exclude(callerid='Guest'). \
+        annotate(country=country)
 
     if username != "All":
-        os = os.filter(tenantname=username)
+        calls = calls.filter(tenantname=username)
 
-    return Counter(filter(None, os))
+    return count_values(calls, 'country')
 
 
-def generate_cdr_report(selected_db, start_date, end_date):
-    """Return a combined report for JISC and Gateway4 tenants."""
-    cdr = Call.objects.using(selected_db). \
-        filter(jointime__date__range=(start_date, end_date)). \
-        filter(Q(tenantname="JISC") | Q(tenantname="Gateway4")).all()
-    return cdr
+@archived
+@cached_report
+def calculate_platform_stats(username, selected_db, start_date, end_date):
+    """Return the 10 Vidyo platforms most used by the Tenant in the given date range and the rest as 'Other'."""
+    platforms = count_application_values(username, selected_db, start_date, end_date, 'applicationname')
+
+    return top_counts(platforms, 10, other='Other')
+
+
+@archived
+@cached_report
+def calculate_os_stats(username, selected_db, start_date, end_date):
+    """Return the 10 Operating Systems most used by the Tenant in the given date range and the rest as 'Other'."""
+    os = count_application_values(username, selected_db, start_date, end_date, 'applicationos')
+
+    return top_counts(os, 10, other='Other')
+
+
+# The reports that make up the overview, with the key of their result in it.
+OVERVIEW_REPORTS = [
+    ('users', calculate_user_stats),
+    ('rooms', calculate_room_stats),
+    ('calls_per_day', calculate_calls_per_day),
+    ('platforms', calculate_platform_stats),
+    ('operating_systems', calculate_os_stats),
+]
+
+
+@archived
+@cached_report
+def calculate_overview(username, selected_db, start_date, end_date):
+    """
+    Return the results of the user, room, calls per day, platform and OS stats of the given Tenant
+    for the given date range, calculated in a single pass over the few columns they need.
+    """
+    fields = ['callername', 'conferencename', 'uniquecallid', 'jointime', 'applicationname', 'applicationos']
+    calls = columnar.read_calls(tenant_calls(username, selected_db, start_date, end_date), fields)
+    if isinstance(calls, columnar.CallColumns):
+        return columnar.overview(calls)
+
+    users = Counter()
+    room_calls = defaultdict(set)
+    day_calls = defaultdict(set)
+    platforms = Counter()
+    operating_systems = Counter()
+
+    for index, (caller_name, conference_name, unique_call_id, join_time, platform, os) in enumerate(calls):
+        if not index % CHECK_INTERVAL:
+            check_budget()
+        users[caller_name] += 1
+        room_calls[conference_name].add(unique_call_id)
+        day_calls[join_time.date()].add(unique_call_id)
+        if platform:
+            platforms[platform] += 1
+        if os:
+            operating_systems[os] += 1
+
+    return {
+        'users': top_counts(users, 10),
+        'rooms': top_counts(Counter(dict((room, len(unique_call_ids))
+                                         for room, unique_call_ids in room_calls.iteritems())), 10),
+        'calls_per_day': OrderedDict(sorted((day, len(unique_call_ids))
+                                            for day, unique_call_ids in day_calls.iteritems())),
+        'platforms': top_counts(platforms, 10, other='Other'),
+        'operating_systems': top_counts(operating_systems, 10, other='Other'),
+    }
+
+
+# The time buckets of the time series reports, and the function of each report for each of them.
+GRANULARITIES = ['hour', 'day', 'week', 'month']
+
+CALLS_PER_BUCKET = {
+    'hour': calculate_calls_per_hour,
+    'day': calculate_calls_per_day,
+    'week': calculate_calls_per_week,
+    'month': calculate_calls_per_month,
+}
+
+CONCURRENT_LINES_PER_BUCKET = {
+    'hour': calculate_concurrent_lines_per_hour,
+    'day': calculate_concurrent_lines,
+    'week': calculate_concurrent_lines_per_week,
+    'month': calculate_concurrent_lines_per_month,
+}
+
+# The range reports of the dashboard, in the same order as the buttons of the index page.
+RANGE_REPORTS = [
+    ('User Stats', calculate_user_stats),
+    ('Room Stats', calculate_room_stats),
+    ('Calls per day', calculate_calls_per_day),
+    ('Calls by country', calculate_calls_by_country),
+    ('Active partipants per call', calculate_participants_per_call),
+    ('Average meeting length', calculate_average_meeting_length),
+    ('Maximum concurrent lines', calculate_concurrent_lines),
+    ('Concurrent VidyoGateway ports', calculate_concurrent_gateway_ports),
+    ('Platform Stats', calculate_platform_stats),
+    ('OS Stats', calculate_os_stats),
+    ('Overview', calculate_overview),
+]
+
+
+def merge_top_counts(results, limit, count):
+    """
+    Merge exactly the top counts of several databases, given as a list of (database, top counts).
+
+    The top counts of a database are its candidates and, if it has more values than the limit, the lowest one
+    is the bound of the counts it left out. The candidates missing from a database are counted there by calling
+    count(database, values), and if a value outside all the candidates could still reach the top,
+    all the values are counted with count(database, None) instead.
+    """
+    totals = Counter()
+    for database, top in results:
+        totals.update(top)
+
+    threshold = 0
+    for database, top in results:
+        if len(top) < limit:
+            # All the values of this database are among its top counts.
+            continue
+
+        threshold += min(top.values())
+        missing = set(totals).difference(top)
+        if missing:
+            totals.update(count(database, missing))
+
+    top = top_counts(totals, limit)
+    if len(top) < limit or min(top.values()) >= threshold:
+        return top
+
+    totals = Counter()
+    for database, _ in results:
+        totals.update(count(database, None))
+
+    return top_counts(totals, limit)
+
+
+def merge_concurrent_lines(results, calls, granularity='day'):
+    """
+    Merge the maximum concurrent lines per day (or per hour, week or month) of several databases,
+    given as a list of (database, lines).
+
+    The buckets that have lines in more than one database are calculated again from the calls of all of them,
+    which calls(database, start_date, end_date) returns, so that a caller in both is still a single line.
+    """
+    lines = defaultdict(int)
+    databases_per_bucket = Counter()
+    for database, database_lines in results:
+        lines.update(database_lines)
+        databases_per_bucket.update(database_lines.keys())
+
+    # Group the shared buckets into runs of consecutive buckets, to query each run once.
+    shared_buckets = sorted(bucket for bucket, databases in databases_per_bucket.iteritems() if databases > 1)
+    runs = []
+    for bucket in shared_buckets:
+        if runs and next_bucket(runs[-1][-1], granularity) == bucket:
+            runs[-1].append(bucket)
+        else:
+            runs.append([bucket])
+
+    for run in runs:
+        first_day, last_day = bucket_days(run[0], granularity)[0], bucket_days(run[-1], granularity)[1]
+        run_calls = chain.from_iterable(calls(database, first_day, last_day) for database, _ in results)
+        if granularity == 'day':
+            run_lines = concurrent_lines_per_day(run_calls)
+        else:
+            run_lines = concurrent_lines_per_bucket(run_calls, granularity)
+        for bucket in run:
+            lines[bucket] = run_lines[bucket]
+
+    return lines
+
+
+def merge_reports(report, results, username, start_date, end_date):
+    """
+    Merge the results of the given calculate_* function for several databases,
+    given as a list of (database, result), into the result the report would have for all of them.
+
+    Values that are left out of the result of a database (e.g outside its top 10) or that cannot be added up
+    (e.g the concurrent lines of a day with calls in both databases) are queried again for just those values,
+    from the archive of a database if it has one.
+    """
+    if len(results) == 1:
+        return results[0][1]
+
+    if report == 'calculate_user_stats':
+        return merge_top_counts(results, 10, lambda database, values: count_tenant_values(
+            username, database, start_date, end_date, 'callername', values=values))
+
+    if report == 'calculate_room_stats':
+        return merge_top_counts(results, 10, lambda database, values: count_tenant_values(
+            username, database, start_date, end_date, 'conferencename', values=values, distinct='uniquecallid'))
+
+    if report == 'calculate_participants_per_call':
+        # Each call is in a single database, so the top 10 of all the calls is among the top 10 of each database.
+        participants = Counter()
+        for database, top in results:
+            participants.update(top)
+        return OrderedDict(heapq.nlargest(10, participants.items(), key=itemgetter(1)))
+
+    if report in ('calculate_concurrent_lines', 'calculate_concurrent_lines_per_hour',
+                  'calculate_concurrent_lines_per_week', 'calculate_concurrent_lines_per_month'):
+        granularity = report.rsplit('_', 1)[1] if '_per_' in report else 'day'
+        # The first and the last week or month can start before and end after the date range.
+        return merge_concurrent_lines(results, lambda database, first_day, last_day: archived(concurrent_line_calls)(
+            username, database, max(first_day, to_date(start_date)), min(last_day, to_date(end_date))),
+            granularity)
+
+    if report == 'calculate_concurrent_gateway_ports':
+        return merge_concurrent_lines(results, lambda database, first_day, last_day: archived(gateway_port_calls)(
+            username, database, first_day, last_day))
+
+    if report in ('calculate_platform_stats', 'calculate_os_stats'):
+        field = 'applicationname' if report == 'calculate_platform_stats' else 'applicationos'
+        counts = Counter()
+        for database, top in results:
+            if 'Other' in top:
+                # Some values were added up as 'Other', so count all the values of this database.
+                top = count_application_values(username, database, start_date, end_date, field)
+            counts.update(top)
+        return top_counts(counts, 10, other='Other')
+
+    if report == 'calculate_overview':
+        return dict((key, merge_reports(component.__name__, [(database, result[key]) for database, result in results],
+                                        username, start_date, end_date))
+                    for key, component in OVERVIEW_REPORTS)
+
+    if report == 'calculate_meeting_length_totals':
+        # The lengths are weighted by the calls of each database, by adding up the totals and the histograms.
+        return (sum(total for database, (total, count, histogram) in results),
+                sum(count for database, (total, count, histogram) in results),
+                [sum(counts) for counts in zip(*[histogram for database, (total, count, histogram) in results])])
+
+    # The calls of each day and of each country are disjoint between the databases, so they are added up.
+    counts = Counter()
+    for database, result in results:
+        counts.update(result)
+
+    if report in ('calculate_calls_per_day', 'calculate_calls_per_hour', 'calculate_calls_per_week',
+                  'calculate_calls_per_month'):
+        return OrderedDict(sorted(counts.items()))
+
+    return counts
+
+
+def run_report(report, databases, username, start_date, end_date, refresh=False, budget=None):
+    """
+    Run the given calculate_* function for the given databases in parallel and merge their results.
+    Return the merged result and the databases that did not respond in time and were left out of it.
+
+    With a budget, the whole report is given that many seconds and raises ReportOverBudget once past them.
+    """
+    deadline = deadline_after(budget)
+    results = fan_out(budgeted(instrumented_report(report), deadline), databases, username, start_date, end_date,
+                      refresh=refresh)
+
+    with within_deadline(deadline, databases):
+        result = merge_reports(report.__name__,
+                               [(database, results[database]) for database in databases if database in results],
+                               username, start_date, end_date)
+
+    return result, [database for database in databases if database not in results]
+
+
+def calculate_daily_stats(selected_db, start_date, end_date):
+    """
+    Return the DailyRollup fields of each Tenant and of 'All' for each day of the given date range.
+
+    The calls of the range are read in a single pass, applying the same filters as the equivalent reports.
+    The calls that joined before the range and left in or after it are also read, only for its concurrent lines,
+    like calculate_concurrent_lines() does, so that the peaks of the days at the edges of the batches of
+    roll_up_database() are the same as in a report of any range.
+    """
+    start = datetime.combine(start_date, time.min)
+
+    calls = Call.objects.using(call_database(selected_db)). \
+        values_list('tenantname', 'uniquecallid', 'callername', 'jointime', 'leavetime',
+                    'applicationname', 'applicationos', 'callstate'). \
+        filter(overlapping_range(start_date, end_date))
+
+    stats = defaultdict(lambda: {
+        'calls': 0,
+        'unique_calls': 0,
+        'total_minutes': 0.0,
+        'concurrent_lines': 0,
+        'gateway_ports': 0,
+        'platforms': Counter(),
+        'operating_systems': Counter(),
+    })
+    unique_calls = defaultdict(set)
+    line_calls = defaultdict(list)
+    gateway_calls = defaultdict(list)
+
+    for tenant, unique_call_id, caller_name, join_time, leave_time, platform, os, state in calls.iterator():
+        day = join_time.date()
+        call = {'callername': caller_name, 'jointime': join_time, 'leavetime': leave_time}
+        # The filters of calculate_concurrent_lines() and calculate_concurrent_gateway_ports()
+        concurrent = state == "COMPLETED" and leave_time is not None
+
+        for tenantname in (tenant, "All"):
+            if join_time >= start:
+                day_stats = stats[(tenantname, day)]
+                day_stats['calls'] += 1
+                unique_calls[(tenantname, day)].add(unique_call_id)
+
+                if leave_time is not None:
+                    day_stats['total_minutes'] += (leave_time - join_time).total_seconds() / 60
+                if platform:
+                    day_stats['platforms'][platform] += 1
+                if os:
+                    day_stats['operating_systems'][os] += 1
+
+            if concurrent and platform == "VidyoGateway":
+                gateway_calls[tenantname].append(call)
+            elif concurrent and platform != "VidyoReplay":
+                line_calls[tenantname].append(call)
+
+    for key, unique_call_ids in unique_calls.iteritems():
+        stats[key]['unique_calls'] = len(unique_call_ids)
+
+    for tenantname, tenant_calls in line_calls.iteritems():
+        for day, lines in in_date_range(concurrent_lines_per_day(tenant_calls), start_date, end_date).iteritems():
+            stats[(tenantname, day)]['concurrent_lines'] = lines
+
+    for tenantname, tenant_calls in gateway_calls.iteritems():
+        for day, ports in in_date_range(concurrent_lines_per_day(tenant_calls), start_date, end_date).iteritems():
+            stats[(tenantname, day)]['gateway_ports'] = ports
+
+    return stats
+
+
+def generate_cdr_report(selected_db, start_date, end_date, chunk_size=2000):
+    """
+    Yield the calls of the JISC and Gateway4 tenants in the given date range as tuples of CDR_FIELDS,
+    ordered by JoinTime and CallID.
+
+    The calls are read in chunks that start after the last row of the previous chunk, so that
+    the memory used stays the same whatever the size of the date range.
+    """
+    calls = Call.objects.using(call_database(selected_db)). \
+        values_list(*CDR_FIELDS). \
+        filter(date_range(start_date, end_date)). \
+        filter(Q(tenantname="JISC") | Q(tenantname="Gateway4")). \
+        order_by('jointime', 'callid')
+
+    jointime_index = CDR_FIELDS.index('jointime')
+    callid_index = CDR_FIELDS.index('callid')
+
+    chunk = list(calls[:chunk_size])
+    while chunk:
+        for row in chunk:
+            yield row
+
+        join_time, call_id = chunk[-1][jointime_index], chunk[-1][callid_index]
+        chunk = list(calls.filter(Q(jointime__gt=join_time) | Q(jointime=join_time, callid__gt=call_id))[:chunk_size])
+
+
+@archived
+def calculate_high_water_mark(username, selected_db, start_date, end_date):
+    """
+    Return what the results of the reports of the given Tenant and date range depend on: the number of calls
+    that joined in the range, how many of them have ended, and their last CallID, JoinTime and LeaveTime.
+    It changes whenever a call of the range is added or ends, so it identifies the version of the results.
+    """
+    calls = tenant_calls(username, selected_db, start_date, end_date)
+
+    return calls.aggregate(calls=Count('callid'), ended=Count('leavetime'), last_callid=Max('callid'),
+                           last_join=Max('jointime'), last_leave=Max('leavetime'))
 
 
 def calculate_current_calls(username):
     """Return the number of Vidyo calls that are currently in progress"""
-    calls = Call.objects.using('platformc').filter(callstate="IN PROGRESS")
+    calls = Call.objects.using(read_database('platformc')).filter(callstate="IN PROGRESS")
 
     if username != "All":
         calls = calls.filter(tenantname=username)
@@ -217,13 +829,15 @@ def calculate_current_calls(username):
 
 
 def get_tenants():
-    """Return all the available tenants in order to populate the Tenant drop-down menu."""
-    ajenta_tenants = list(Call.objects.using('ajenta.io').values_list('tenantname', flat=True).distinct())
-    oydiv_tenants = list(Call.objects.using('platformc').values_list('tenantname', flat=True).distinct())
-
-    tenants = ajenta_tenants + oydiv_tenants
-    tenants.append("All - ajenta.io")
-    tenants.append("All - platformc")
-    tenants_list = [(tenant, tenant) for tenant in set(tenants)]
+    """
+    Return all the available tenants in order to populate the Tenant drop-down menu.
+
+    The tenants are read from the Tenant table, which the refresh_tenants Celery task keeps up to date,
+    so that the index page does not query the whole ConferenceCall2 table of both databases.
+    """
+    tenants = set(Tenant.objects.values_list('tenantname', flat=True))
+    tenants.add("All - ajenta.io")
+    tenants.add("All - platformc")
+    tenants_list = [(tenant, tenant) for tenant in tenants]
 
     return sorted(tenants_list, key=lambda (a, b): (a.lower(), b))
@@ -0,0 +1,164 @@
+import time
+
+from django.conf import settings
+from django.db import connections, transaction, DatabaseError
+from django.db.models import Max
+
+from .models import Call
+
+# Calls copied or re-checked per query and transaction.
+BATCH_SIZE = 2000
+
+# A CallID is allocated when a call is inserted, but it may be committed after calls with higher CallIDs.
+# The CallIDs of this window below the high-water mark are compared with the replica, to copy the late ones.
+LATE_CALLS_WINDOW = 1000
+
+# Indexes of the replica for the filters of the reports, which the ConferenceCall2 table of Vidyo does not have.
+REPLICA_INDEXES = [
+    ('jointime',),
+    ('leavetime',),
+    ('tenantname', 'jointime'),
+    ('callstate',),
+]
+
+# The result of the last health check of each read replica, as (time, healthy), kept for REPLICA_CHECK_INTERVAL.
+replica_health = {}
+
+
+def replica_of(selected_db):
+    """Return the alias of the local replica of the given CDR database, or None if CALL_REPLICAS has none."""
+    return getattr(settings, 'CALL_REPLICAS', {}).get(selected_db)
+
+
+def call_database(selected_db):
+    """
+    Return the alias to read the calls of the given database from: its local replica if REPORTS_FROM_REPLICAS
+    is set, else one of its read replicas (see read_database()).
+    """
+    if getattr(settings, 'REPORTS_FROM_REPLICAS', False) and replica_of(selected_db):
+        return replica_of(selected_db)
+
+    return read_database(selected_db)
+
+
+def read_database(selected_db):
+    """
+    Return the alias to run the read-only queries of the given CDR database on: the first of its READ_REPLICAS
+    that is up and no more than REPLICA_MAX_LAG seconds behind it, or the database itself if there is none.
+    """
+    for alias in getattr(settings, 'READ_REPLICAS', {}).get(selected_db, []):
+        if replica_is_healthy(alias):
+            return alias
+
+    return selected_db
+
+
+def replica_lag(alias):
+    """
+    Return how many seconds the given read replica is behind its primary, or None if it is not replicating.
+    Only MySQL replicas report their lag, the others are just checked to be up.
+    """
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor != 'mysql':
+            cursor.execute('SELECT 1')
+            return 0
+
+        cursor.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        return dict(zip([column[0] for column in cursor.description], row))['Seconds_Behind_Master']
+
+
+def replica_is_healthy(alias):
+    """Check that the given read replica is up and not lagging, at most every REPLICA_CHECK_INTERVAL seconds."""
+    checked = replica_health.get(alias)
+    if checked is not None and time.time() - checked[0] < getattr(settings, 'REPLICA_CHECK_INTERVAL', 30):
+        return checked[1]
+
+    try:
+        lag = replica_lag(alias)
+        healthy = lag is not None and lag <= getattr(settings, 'REPLICA_MAX_LAG', 30)
+    except DatabaseError:
+        # Drop the persistent connection, so that the next check connects again.
+        connections[alias].close()
+        healthy = False
+
+    replica_health[alias] = (time.time(), healthy)
+    return healthy
+
+
+def create_replica_table(replica):
+    """Create the ConferenceCall2 table and its indexes in the replica database, if it does not exist yet."""
+    connection = connections[replica]
+    if Call._meta.db_table in connection.introspection.table_names():
+        return
+
+    with connection.schema_editor() as schema_editor:
+        schema_editor.create_model(Call)
+        for fields in REPLICA_INDEXES:
+            columns = [Call._meta.get_field(field).column for field in fields]
+            schema_editor.execute('CREATE INDEX %s ON %s (%s)' % (
+                schema_editor.quote_name('replica_%s' % '_'.join(fields)),
+                schema_editor.quote_name(Call._meta.db_table),
+                ', '.join(schema_editor.quote_name(column) for column in columns)))
+
+
+def replace_calls(source, replica, callids):
+    """
+    Copy the calls with the given CallIDs from the CDR database (or its read replica) over their rows in the replica.
+    A call missing from a read replica that is behind is left as it is.
+    """
+    calls = list(Call.objects.using(source).filter(callid__in=callids))
+
+    with transaction.atomic(using=replica):
+        Call.objects.using(replica).filter(callid__in=[call.callid for call in calls]).delete()
+        Call.objects.using(replica).bulk_create(calls)
+
+    return len(calls)
+
+
+def sync_replica(selected_db):
+    """
+    Copy the new and updated calls of the given CDR database into its replica.
+    Return the number of calls after the high-water mark and of calls copied again (in progress or late).
+
+    The CallID of the last call copied is the high-water mark: only the calls after it are new, read in batches
+    by primary key. The only calls that change afterwards are the ones in progress, so those are read again.
+    The calls are read from a read replica of the database if it has a healthy one: the calls it is behind on
+    are still in progress, or after the high-water mark, and are copied by the next sync.
+    """
+    replica = replica_of(selected_db)
+    source = read_database(selected_db)
+    create_replica_table(replica)
+
+    last_callid = Call.objects.using(replica).aggregate(last_callid=Max('callid'))['last_callid'] or 0
+
+    # The calls in progress and the late ones below the high-water mark.
+    in_progress = list(Call.objects.using(replica).
+                       filter(callstate="IN PROGRESS").
+                       values_list('callid', flat=True))
+    window = (max(last_callid - LATE_CALLS_WINDOW, 0), last_callid)
+    late = set(Call.objects.using(source).filter(callid__range=window).values_list('callid', flat=True))
+    late.difference_update(Call.objects.using(replica).filter(callid__range=window).values_list('callid', flat=True))
+
+    updated = 0
+    changed = sorted(set(in_progress) | late)
+    for start in range(0, len(changed), BATCH_SIZE):
+        updated += replace_calls(source, replica, changed[start:start + BATCH_SIZE])
+
+    copied = 0
+    while True:
+        calls = list(Call.objects.using(source).filter(callid__gt=last_callid).order_by('callid')[:BATCH_SIZE])
+        if not calls:
+            break
+
+        with transaction.atomic(using=replica):
+            Call.objects.using(replica).bulk_create(calls)
+
+        copied += len(calls)
+        last_callid = calls[-1].callid
+
+    return copied, updated
@@ -1,13 +1,30 @@
 import os
-from datetime import date, timedelta
+import json
+from datetime import date, datetime, time, timedelta
+from uuid import uuid4
 
 from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Max, Min
 
 from ajenta_dashboard.celery import app
-from .queries import calculate_concurrent_lines
+from . import queries
+from .cache import get_client, report_key
+from .live import update_current_calls
+from .metrics import instrumented_task
+from .models import Call, DailyRollup, RollupProgress, Tenant
+from .queries import calculate_concurrent_lines, calculate_daily_stats, run_report
+from .replica import call_database, replica_of, sync_replica
+
+# Seconds after which a report still marked as being calculated is sent again, in case its worker died.
+REPORT_JOB_TIMEOUT = 3600
+
+# Seconds after which the lock of a replica sync is released, in case its worker died during the sync.
+SYNC_LOCK_TIMEOUT = 3600
 
 
 @app.task
+@instrumented_task('ajenta.io', 'platformc')
 def send_email():
     """Send an automated email with the maximum number of concurrent lines per platform."""
     username = 'All'
@@ -27,3 +44,165 @@ def send_email():
     # The emails in the EMAIL_LIST environment variable should be separated by one space
     # (e.g EMAIL_LIST='email1@domain.com email2@domain.com')
     send_mail(subject, message, os.environ['EMAIL_HOST_USER'], os.environ['EMAIL_LIST'].split(), fail_silently=False)
+
+
+@app.task
+def roll_up_daily_stats():
+    """Roll up the closed days of both databases into the DailyRollup table."""
+    yesterday = date.today() - timedelta(1)
+
+    for selected_db in ('ajenta.io', 'platformc'):
+        roll_up_database(selected_db, yesterday)
+
+
+@app.task
+def refresh_tenants():
+    """Add the new Tenants of both databases to the Tenant table."""
+    for selected_db in ('ajenta.io', 'platformc'):
+        refresh_database_tenants(selected_db)
+
+
+def refresh_database_tenants(selected_db):
+    """
+    Add the Tenants of the calls after the last CallID seen in the given database to the Tenant table.
+    Only the first refresh scans the whole table, the next ones only read the new calls by their primary key.
+    """
+    last_callid = Tenant.objects.filter(database=selected_db).aggregate(last_callid=Max('last_callid'))['last_callid']
+
+    new_tenants = Call.objects.using(call_database(selected_db)). \
+        filter(callid__gt=last_callid or 0). \
+        values('tenantname'). \
+        annotate(last_callid=Max('callid'))
+
+    for tenant in new_tenants:
+        Tenant.objects.update_or_create(database=selected_db, tenantname=tenant['tenantname'],
+                                        defaults={'last_callid': tenant['last_callid']})
+
+
+def roll_up_database(selected_db, last_day):
+    """
+    Roll up the days of the given database until last_day, starting from the first day with calls
+    after the last rolled up CallID. The days are rolled up in batches of up to a month.
+    """
+    progress, _ = RollupProgress.objects.get_or_create(database=selected_db)
+
+    new_calls = Call.objects.using(call_database(selected_db)). \
+        filter(callid__gt=progress.last_callid,
+               jointime__lt=datetime.combine(last_day, time.min) + timedelta(1))
+    bounds = new_calls.aggregate(first_join=Min('jointime'), last_callid=Max('callid'))
+
+    if bounds['last_callid'] is not None:
+        start_date = bounds['first_join'].date()
+        # Roll up the previous last day again, as the calls that were still in progress have ended since.
+        if progress.last_day is not None:
+            start_date = min(start_date, progress.last_day)
+
+        while start_date <= last_day:
+            end_date = min(start_date + timedelta(30), last_day)
+            stats = calculate_daily_stats(selected_db, start_date, end_date)
+
+            with transaction.atomic():
+                DailyRollup.objects.filter(database=selected_db, day__range=(start_date, end_date)).delete()
+                DailyRollup.objects.bulk_create([
+                    DailyRollup(database=selected_db,
+                                tenantname=tenantname,
+                                day=day,
+                                calls=day_stats['calls'],
+                                unique_calls=day_stats['unique_calls'],
+                                total_minutes=day_stats['total_minutes'],
+                                concurrent_lines=day_stats['concurrent_lines'],
+                                gateway_ports=day_stats['gateway_ports'],
+                                platforms=json.dumps(day_stats['platforms']),
+                                operating_systems=json.dumps(day_stats['operating_systems']))
+                    for (tenantname, day), day_stats in stats.iteritems()
+                ])
+
+            start_date = end_date + timedelta(1)
+
+        progress.last_callid = bounds['last_callid']
+
+    progress.last_day = last_day
+    progress.save()
+
+
+def locked_sync(selected_db):
+    """
+    Sync the replica of the given database (see sync_replica()) and return its counts, or None if another sync
+    of the database is still running, e.g its first full copy, as both would copy the calls after the same
+    high-water mark. The syncs hold a lock in Redis, so they are not guarded without it.
+    """
+    client = get_client()
+    if client is None:
+        return sync_replica(selected_db)
+
+    key = b'sync:' + selected_db.encode('utf-8')
+    token = str(uuid4())
+    if not client.set(key, token, nx=True, ex=SYNC_LOCK_TIMEOUT):
+        return None
+
+    try:
+        return sync_replica(selected_db)
+    finally:
+        # The lock is only released if it is still this one, and not another sync's after it expired.
+        if client.get(key) == token:
+            client.delete(key)
+
+
+@app.task
+def sync_call_replicas():
+    """
+    Copy the new and updated calls of both databases into their local replicas, if CALL_REPLICAS has them.
+    A database still being synced by the previous run is skipped.
+    """
+    for selected_db in ('ajenta.io', 'platformc'):
+        if replica_of(selected_db) is not None:
+            locked_sync(selected_db)
+
+
+@app.task
+def poll_current_calls():
+    """Keep the number of calls in progress of each Tenant in Redis, for the Current Calls pages."""
+    if get_client() is not None:
+        update_current_calls()
+
+
+def report_job_key(report_name, databases, username, start_date, end_date):
+    return b'job:' + report_key(report_name, username, '+'.join(databases), start_date, end_date)
+
+
+@app.task
+def calculate_report_task(report_name, databases, username, start_date, end_date, refresh=False):
+    """
+    Calculate a report in the background for the computing page of the report views.
+    Return the merged result with the key of the report, so that a view only shows the report it asked for.
+    """
+    key = report_job_key(report_name, databases, username, start_date, end_date)
+    try:
+        result, missing = run_report(getattr(queries, report_name), databases, username, start_date, end_date,
+                                     refresh=refresh)
+    finally:
+        client = get_client()
+        if client is not None:
+            client.delete(key)
+
+    return {'key': key, 'result': result, 'missing': missing}
+
+
+def submit_report(report_name, databases, username, start_date, end_date, refresh=False):
+    """
+    Send a report to calculate_report_task and return the id of its task.
+    If the same report is already being calculated, return the id of that task instead.
+    """
+    client = get_client()
+    key = report_job_key(report_name, databases, username, start_date, end_date)
+
+    task_id = str(uuid4())
+    while not client.set(key, task_id, nx=True, ex=REPORT_JOB_TIMEOUT):
+        running_task_id = client.get(key)
+        # The running task may have finished between both commands.
+        if running_task_id is not None:
+            return running_task_id
+
+    calculate_report_task.apply_async((report_name, databases, username, start_date, end_date, refresh),
+                                      task_id=task_id)
+    return task_id
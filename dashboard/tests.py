@@ -1,10 +1,35 @@
-from datetime import date, timedelta
+import csv
+import json
+import pickle
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import skipIf
+from time import sleep
+from datetime import date, datetime, timedelta
 
-from django.test import TestCase
+import redis
+from celery.backends.cache import CacheBackend
+from django.core.management import call_command, CommandError
+from django.db import connections
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth.models import User, Permission
 from django.contrib import auth
 
 from .forms import UserForm
+from .models import Call, Tenant, UserCountry
+from .queries import *
+from . import cache, columnar, metrics
+from .budget import ReportOverBudget, check_budget, deadline_after, set_execution_time, within_deadline
+from .live import count_current_calls
+from . import replica
+from .replica import call_database, read_database, sync_replica
+from .benchmark import synthetic_calls, generate_calls, report_benchmarks, utils_benchmarks, benchmark_names, measure, \
+    compare_results
+from .tasks import calculate_report_task, refresh_database_tenants, report_job_key, roll_up_database
+from .utils import bucket_start, concurrent_lines_per_bucket, concurrent_lines_per_day, fan_out, rebucket, \
+    histogram_percentile, length_bucket, LENGTH_BUCKETS
 
 
 class TestUserWithoutPermission(TestCase):
@@ -137,6 +162,10 @@ class TestUserWithPermission(TestCase):
         response = self.client.post('/os-stats/')
         self.assertEqual(response.status_code, 200)
 
+    def test_overview(self):
+        response = self.client.post('/overview/')
+        self.assertEqual(response.status_code, 200)
+
     def test_calls_by_country(self):
         response = self.client.post('/calls-by-country/')
         self.assertRedirects(response, '/auth/login/?next=/calls-by-country/')
@@ -184,6 +213,52 @@ class TestUserSpecificReports(TestCase):
         self.assertEqual(response.status_code, 200)
 
 
+class TestReportParameters(TestCase):
+    """Test the report URLs with the Tenant, databases and date range as query parameters."""
+
+    def setUp(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        user = auth.get_user(self.client)
+        user.user_permissions.add(Permission.objects.get(codename='can_view_stats'))
+
+    def test_index_redirect(self):
+        response = self.client.post('/', {'start_date': '01/09/2016', 'end_date': '30/09/2016',
+                                          'report': 'User Stats'})
+        path, query = response['Location'].split('?')
+        self.assertEqual(path, '/user-stats')
+        self.assertEqual(dict(QueryDict(query).lists()), {'tenant': ['Jisc'], 'database': ['platformc', 'ajenta.io'],
+                                                          'start_date': ['2016-09-01'], 'end_date': ['2016-09-30']})
+
+    def test_parameters(self):
+        # Only staff can choose the Tenant.
+        response = self.client.get('/user-stats/', {'tenant': 'ActionAid', 'database': 'platformc',
+                                                    'start_date': '2016-10-01', 'end_date': '2016-10-31'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(QueryDict(response.context['query'])['tenant'], 'Jisc')
+
+        tomorrow = (date.today() + timedelta(1)).isoformat()
+        for database, start_date, end_date in [('other', '2016-10-01', '2016-10-31'),
+                                               ('platformc', '2016-10-31', '2016-10-01'),
+                                               ('platformc', '2016-10-01', tomorrow),
+                                               ('platformc', '01/10/2016', '31/10/2016')]:
+            response = self.client.get('/user-stats/', {'database': database, 'start_date': start_date,
+                                                        'end_date': end_date})
+            self.assertRedirects(response, '/')
+
+    @override_settings(REPORT_PAGE_MAX_AGE=3600)
+    def test_cache_control(self):
+        response = self.client.get('/user-stats/', {'start_date': '2016-10-01', 'end_date': '2016-10-31'})
+        self.assertIn('max-age=3600', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+
+        # The page of a range that includes today changes with the new calls.
+        today = date.today().isoformat()
+        response = self.client.get('/user-stats/', {'start_date': today, 'end_date': today})
+        self.assertNotIn('max-age', response.get('Cache-Control', ''))
+
+
 class TestForm(TestCase):
     """Test form validation."""
 
@@ -212,3 +287,1080 @@ class TestForm(TestCase):
         self.assertEqual(form.errors, {
             '__all__': ['End date must be after start date.']
         })
+
+
+class TestConcurrentLines(TestCase):
+    """Test the concurrent lines sweep used by the concurrent lines and gateway ports reports."""
+
+    def call(self, caller_name, join_time, leave_time):
+        return {'callername': caller_name, 'jointime': join_time, 'leavetime': leave_time}
+
+    def test_no_calls(self):
+        self.assertEqual(concurrent_lines_per_day([]), {})
+
+    def test_overlapping_calls(self):
+        calls = [
+            self.call('alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 11)),
+            self.call('bob', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 12)),
+            self.call('carol', datetime(2016, 10, 1, 13), datetime(2016, 10, 1, 14)),
+            self.call('alice', datetime(2016, 10, 2, 9), datetime(2016, 10, 2, 10)),
+        ]
+        self.assertEqual(concurrent_lines_per_day(calls), {date(2016, 10, 1): 2, date(2016, 10, 2): 1})
+
+    def test_same_caller_is_one_line(self):
+        calls = [
+            self.call('alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 11)),
+            self.call('alice', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 12)),
+        ]
+        self.assertEqual(concurrent_lines_per_day(calls), {date(2016, 10, 1): 1})
+
+    def test_touching_calls_are_concurrent(self):
+        calls = [
+            self.call('alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 10)),
+            self.call('bob', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 11)),
+        ]
+        self.assertEqual(concurrent_lines_per_day(calls), {date(2016, 10, 1): 2})
+
+    def test_hours_without_join_or_leave(self):
+        # Alice is on a call all the hours between her join and her leave, not only in those two.
+        calls = [
+            self.call('alice', datetime(2016, 10, 1, 9, 30), datetime(2016, 10, 1, 12, 15)),
+            self.call('bob', datetime(2016, 10, 1, 10, 45), datetime(2016, 10, 1, 10, 50)),
+        ]
+        self.assertEqual(dict(concurrent_lines_per_bucket(calls, 'hour')), {
+            datetime(2016, 10, 1, 9): 1,
+            datetime(2016, 10, 1, 10): 2,
+            datetime(2016, 10, 1, 11): 1,
+            datetime(2016, 10, 1, 12): 1,
+        })
+
+    def test_calls_across_weeks_and_months(self):
+        calls = [self.call('alice', datetime(2016, 9, 29, 23), datetime(2016, 10, 4, 1))]
+        self.assertEqual(dict(concurrent_lines_per_bucket(calls, 'week')),
+                         {date(2016, 9, 26): 1, date(2016, 10, 3): 1})
+        self.assertEqual(dict(concurrent_lines_per_bucket(calls, 'month')),
+                         {date(2016, 9, 1): 1, date(2016, 10, 1): 1})
+        self.assertEqual(dict(concurrent_lines_per_bucket(calls, 'day')),
+                         dict((date(2016, 9, 29) + timedelta(i), 1) for i in range(6)))
+
+
+class TestBuckets(TestCase):
+    """Test the hour, day, ISO week and month buckets of the time series reports."""
+
+    def test_bucket_start(self):
+        value = datetime(2016, 10, 1, 9, 30, 15)  # A Saturday.
+        self.assertEqual(bucket_start(value, 'hour'), datetime(2016, 10, 1, 9))
+        self.assertEqual(bucket_start(value, 'day'), date(2016, 10, 1))
+        self.assertEqual(bucket_start(value, 'week'), date(2016, 9, 26))
+        self.assertEqual(bucket_start(value, 'month'), date(2016, 10, 1))
+        self.assertEqual(bucket_start(date(2016, 12, 31), 'month'), date(2016, 12, 1))
+
+    def test_rebucket(self):
+        days = {date(2016, 9, 30): 3, date(2016, 10, 1): 1, date(2016, 10, 3): 2}
+        self.assertEqual(rebucket(days, 'week', max).items(), [(date(2016, 9, 26), 3), (date(2016, 10, 3), 2)])
+        self.assertEqual(rebucket(days, 'month', lambda a, b: a + b).items(),
+                         [(date(2016, 9, 1), 3), (date(2016, 10, 1), 3)])
+
+
+class TestLengthPercentiles(TestCase):
+    """Test the meeting length percentiles calculated from the histograms."""
+
+    def histogram(self, *lengths):
+        histogram = [0] * (len(LENGTH_BUCKETS) + 1)
+        for seconds in lengths:
+            histogram[length_bucket(seconds)] += 1
+        return histogram
+
+    def test_no_meetings(self):
+        self.assertEqual(length_percentiles(self.histogram()).values(), [0, 0, 0])
+
+    def test_percentiles(self):
+        # 90 meetings of up to 10 minutes and 10 of 1 to 2 hours.
+        histogram = self.histogram(*([500] * 90 + [5000] * 10))
+        self.assertEqual(histogram_percentile(histogram, 50), 300 + 300 * 50 / 90.0)
+        self.assertEqual(histogram_percentile(histogram, 90), 600)
+        self.assertEqual(histogram_percentile(histogram, 99), 3600 + 1800 * 0.9)
+
+    def test_longer_than_a_day(self):
+        self.assertEqual(histogram_percentile(self.histogram(2 * 86400), 50), 86400)
+
+
+class TestGranularity(TestCase):
+    """Test the time series reports at each granularity."""
+    multi_db = True
+
+    def setUp(self):
+        calls = [
+            ('1', 'alice', datetime(2016, 9, 30, 9), datetime(2016, 9, 30, 11)),
+            ('1', 'bob', datetime(2016, 9, 30, 10), datetime(2016, 9, 30, 12)),
+            ('2', 'alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 10)),
+            ('3', 'carol', datetime(2016, 10, 3, 10), datetime(2016, 10, 3, 11)),
+        ]
+        for unique_call_id, caller_name, join_time, leave_time in calls:
+            Call.objects.using('platformc').create(uniquecallid=unique_call_id, tenantname='Jisc',
+                                                   callername=caller_name, jointime=join_time,
+                                                   leavetime=leave_time, callstate='COMPLETED')
+
+    def report(self, reports, granularity):
+        return dict(reports[granularity]('Jisc', 'platformc', date(2016, 9, 30), date(2016, 10, 3)))
+
+    def test_calls(self):
+        self.assertEqual(self.report(CALLS_PER_BUCKET, 'hour'), {
+            datetime(2016, 9, 30, 9): 1,
+            datetime(2016, 9, 30, 10): 1,
+            datetime(2016, 10, 1, 9): 1,
+            datetime(2016, 10, 3, 10): 1,
+        })
+        self.assertEqual(self.report(CALLS_PER_BUCKET, 'day'),
+                         {date(2016, 9, 30): 1, date(2016, 10, 1): 1, date(2016, 10, 3): 1})
+        self.assertEqual(self.report(CALLS_PER_BUCKET, 'week'), {date(2016, 9, 26): 2, date(2016, 10, 3): 1})
+        self.assertEqual(self.report(CALLS_PER_BUCKET, 'month'), {date(2016, 9, 1): 1, date(2016, 10, 1): 2})
+
+    def test_concurrent_lines(self):
+        self.assertEqual(self.report(CONCURRENT_LINES_PER_BUCKET, 'hour'), {
+            datetime(2016, 9, 30, 9): 1,
+            datetime(2016, 9, 30, 10): 2,
+            datetime(2016, 9, 30, 11): 2,
+            datetime(2016, 9, 30, 12): 1,
+            datetime(2016, 10, 1, 9): 1,
+            datetime(2016, 10, 1, 10): 1,
+            datetime(2016, 10, 3, 10): 1,
+            datetime(2016, 10, 3, 11): 1,
+        })
+        self.assertEqual(self.report(CONCURRENT_LINES_PER_BUCKET, 'week'), {date(2016, 9, 26): 2, date(2016, 10, 3): 1})
+        self.assertEqual(self.report(CONCURRENT_LINES_PER_BUCKET, 'month'), {date(2016, 9, 1): 2, date(2016, 10, 1): 1})
+
+
+class TestParticipantsPerCall(TestCase):
+    """Test that the participants of each UniqueCallID are counted in a single pass."""
+    multi_db = True
+
+    def create_call(self, unique_call_id, caller_name, join_time, leave_time, application_name='VidyoDesktop'):
+        Call.objects.using('platformc').create(uniquecallid=unique_call_id, callername=caller_name,
+                                               tenantname='temp', jointime=join_time, leavetime=leave_time,
+                                               applicationname=application_name, callstate='COMPLETED')
+
+    def test_top_calls(self):
+        self.create_call('1', 'alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 11))
+        self.create_call('1', 'bob', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 12))
+        self.create_call('1', 'gateway', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 12), 'VidyoGateway')
+        self.create_call('2', 'carol', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 10))
+        self.create_call('2', 'dave', datetime(2016, 10, 1, 11), datetime(2016, 10, 1, 12))
+        self.create_call('3', 'erin', datetime(2016, 9, 1, 9), datetime(2016, 9, 1, 10))
+
+        parties = calculate_participants_per_call('temp', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(list(parties.items()), [('1', 2), ('2', 1)])
+
+
+class TestTopValues(TestCase):
+    """Test the reports that count the most common values of a column in the database."""
+    multi_db = True
+
+    def setUp(self):
+        platforms = ['VidyoDesktop'] * 3 + ['VidyoWeb'] * 2 + ['VidyoMobile', None, '']
+        for i, platform in enumerate(platforms):
+            Call.objects.using('platformc').create(callername='user%d' % (i % 3), tenantname='temp',
+                                                   jointime=datetime(2016, 10, 1, 9), applicationname=platform)
+
+    def test_user_stats(self):
+        users = calculate_user_stats('temp', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(list(users.items()), [('user0', 3), ('user1', 3), ('user2', 2)])
+
+    def test_platform_stats(self):
+        platforms = calculate_platform_stats('temp', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(list(platforms.items()), [('VidyoDesktop', 3), ('VidyoWeb', 2), ('VidyoMobile', 1)])
+
+    def test_other_platforms(self):
+        for i in range(11):
+            Call.objects.using('platformc').create(tenantname='temp', jointime=datetime(2016, 10, 1, 9),
+                                                   applicationname='Platform%d' % i)
+
+        platforms = calculate_platform_stats('temp', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(len(platforms), 11)
+        self.assertEqual(platforms['Other'], 4)
+
+
+class TestDateRange(TestCase):
+    """Test that the date range of the reports includes the whole of its first and last day."""
+    multi_db = True
+
+    def test_bounds(self):
+        for join_time in [datetime(2016, 9, 30, 23, 59), datetime(2016, 10, 1), datetime(2016, 10, 2, 23, 59, 59),
+                          datetime(2016, 10, 3)]:
+            Call.objects.using('platformc').create(callername=str(join_time), tenantname='temp', jointime=join_time)
+
+        users = calculate_user_stats('temp', 'platformc', date(2016, 10, 1), date(2016, 10, 2))
+        self.assertEqual(sorted(users.keys()), ['2016-10-01 00:00:00', '2016-10-02 23:59:59'])
+
+
+class TestCallsByCountry(TestCase):
+    """Test that the calls are counted per country of the UserCountry table."""
+    multi_db = True
+
+    def setUp(self):
+        UserCountry.objects.bulk_create([UserCountry(username='alice', country='Kenya'),
+                                         UserCountry(username='bob', country='Kenya'),
+                                         UserCountry(username='carol', country='Nepal')])
+
+        for caller_id in ['alice', 'bob', 'carol', 'dave', 'Guest']:
+            Call.objects.using('platformc').create(tenantname='ActionAid', callerid=caller_id,
+                                                   jointime=datetime(2016, 10, 1, 9),
+                                                   leavetime=datetime(2016, 10, 1, 10))
+
+    def test_counts(self):
+        countries = calculate_calls_by_country('ActionAid', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(dict(countries), {'Kenya': 2, 'Nepal': 1, None: 1})
+
+    def test_sync(self):
+        self.assertTrue(sync_user_countries(force=True))
+        self.assertFalse(sync_user_countries())
+        self.assertEqual(UserCountry.objects.get(username='aamir.fida').country, 'Pakistan')
+
+
+class TestTenants(TestCase):
+    """Test that the Tenant table only reads the calls after the last CallID seen."""
+    multi_db = True
+
+    def create_calls(self, *tenants):
+        for tenant in tenants:
+            Call.objects.using('platformc').create(tenantname=tenant, jointime=datetime(2016, 10, 1, 9))
+
+    def test_refresh(self):
+        self.create_calls('Jisc', 'ActionAid', 'Jisc')
+        refresh_database_tenants('platformc')
+        self.assertEqual(get_tenants(), [('ActionAid', 'ActionAid'), ('All - ajenta.io', 'All - ajenta.io'),
+                                         ('All - platformc', 'All - platformc'), ('Jisc', 'Jisc')])
+
+        self.create_calls('Ajenta')
+        with self.assertNumQueries(1, using='platformc'):
+            refresh_database_tenants('platformc')
+
+        self.assertEqual(Tenant.objects.get(tenantname='Ajenta').last_callid,
+                         Call.objects.using('platformc').latest('callid').callid)
+        self.assertEqual(len(get_tenants()), 5)
+
+
+@override_settings(CALL_REPLICAS={'platformc': 'ajenta.io'})
+class TestReplica(TestCase):
+    """Test the local replica of the calls, here the ajenta.io database standing in for the replica of platformc."""
+    multi_db = True
+
+    def create_call(self, tenant='Jisc', state='COMPLETED', **fields):
+        return Call.objects.using('platformc').create(tenantname=tenant, callername=tenant, callstate=state,
+                                                      jointime=datetime(2016, 10, 1, 9), **fields)
+
+    def replicated(self):
+        return [list(Call.objects.using(database).order_by('callid').values_list('callid', 'tenantname', 'callstate'))
+                for database in ('platformc', 'ajenta.io')]
+
+    def test_sync(self):
+        self.create_call()
+        self.create_call(tenant='ActionAid')
+        in_progress = self.create_call(state='IN PROGRESS')
+        self.assertEqual(sync_replica('platformc'), (3, 0))
+
+        in_progress.callstate = 'COMPLETED'
+        in_progress.save(using='platformc')
+        self.create_call()
+        self.assertEqual(sync_replica('platformc'), (1, 1))
+
+        replica, calls = self.replicated()
+        self.assertEqual(replica, calls)
+
+        # Without new calls or calls in progress, only the CallIDs near the high-water mark are read.
+        with self.assertNumQueries(2, using='platformc'):
+            self.assertEqual(sync_replica('platformc'), (0, 0))
+
+    def test_late_calls(self):
+        self.create_call(callid=1)
+        self.create_call(callid=3)
+        sync_replica('platformc')
+
+        # A call committed after the high-water mark passed its CallID.
+        self.create_call(callid=2)
+        self.assertEqual(sync_replica('platformc'), (0, 1))
+        replica, calls = self.replicated()
+        self.assertEqual(replica, calls)
+
+    def test_command(self):
+        self.create_call()
+        self.create_call(tenant='ActionAid')
+
+        # Without Redis, the syncs run without a lock.
+        out = StringIO()
+        call_command('sync_call_replicas', database=['platformc'], stdout=out)
+        self.assertIn('platformc: 2 new calls copied to "ajenta.io" and 0 calls updated.', out.getvalue())
+
+    def test_reports_from_replica(self):
+        self.create_call()
+        self.create_call(tenant='ActionAid')
+        sync_replica('platformc')
+        expected = calculate_user_stats('All', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+
+        with override_settings(REPORTS_FROM_REPLICAS=True), self.assertNumQueries(0, using='platformc'):
+            self.assertEqual(calculate_user_stats('All', 'platformc', date(2016, 10, 1), date(2016, 10, 1)), expected)
+
+
+@override_settings(READ_REPLICAS={'platformc': ['ajenta.io']})
+class TestReadReplicas(TestCase):
+    """Test the reads of platformc from a read replica, here the ajenta.io database standing in for it."""
+    multi_db = True
+
+    def setUp(self):
+        replica.replica_health.clear()
+
+    def tearDown(self):
+        replica.replica_health.clear()
+
+    def test_healthy(self):
+        self.assertEqual(read_database('platformc'), 'ajenta.io')
+        self.assertEqual(read_database('ajenta.io'), 'ajenta.io')
+        self.assertEqual(call_database('platformc'), 'ajenta.io')
+
+        # The health of the replica is only checked again after REPLICA_CHECK_INTERVAL.
+        with self.assertNumQueries(0, using='ajenta.io'):
+            self.assertEqual(read_database('platformc'), 'ajenta.io')
+
+    @override_settings(REPLICA_MAX_LAG=-1)
+    def test_lagging(self):
+        self.assertEqual(read_database('platformc'), 'platformc')
+
+    @override_settings(CALL_REPLICAS={'platformc': 'default'}, REPORTS_FROM_REPLICAS=True)
+    def test_local_replica_first(self):
+        self.assertEqual(call_database('platformc'), 'default')
+
+    def test_current_calls(self):
+        Call.objects.using('ajenta.io').create(tenantname='Jisc', callstate='IN PROGRESS', jointime=datetime.now())
+        self.assertEqual(calculate_current_calls('Jisc'), 1)
+        self.assertEqual(count_current_calls(), {'Jisc': 1, 'All': 1})
+
+
+class TestOverview(TestCase):
+    """Test that the overview has the same results as the reports it combines."""
+    multi_db = True
+
+    def setUp(self):
+        calls = [
+            ('1', 'Room A', 'alice', datetime(2016, 10, 1, 9), 'VidyoDesktop', 'Windows'),
+            ('1', 'Room A', 'bob', datetime(2016, 10, 1, 9), 'VidyoWeb', 'Linux'),
+            ('2', 'Room A', 'alice', datetime(2016, 10, 1, 14), 'VidyoDesktop', 'Windows'),
+            ('3', 'Room B', 'carol', datetime(2016, 10, 2, 10), 'VidyoMobile', 'iOS'),
+            ('4', 'Room C', 'alice', datetime(2016, 10, 3, 10), None, ''),
+        ]
+        for unique_call_id, conference_name, caller_name, join_time, platform, os in calls:
+            Call.objects.using('platformc').create(uniquecallid=unique_call_id, conferencename=conference_name,
+                                                   tenantname='Jisc', callername=caller_name, jointime=join_time,
+                                                   applicationname=platform, applicationos=os)
+
+    def test_overview(self):
+        start_date, end_date = date(2016, 10, 1), date(2016, 10, 3)
+        with self.assertNumQueries(1, using='platformc'):
+            overview = calculate_overview('Jisc', 'platformc', start_date, end_date)
+
+        for key, report in OVERVIEW_REPORTS:
+            self.assertEqual(dict(overview[key]), dict(report('Jisc', 'platformc', start_date, end_date)))
+        self.assertEqual(overview['users'].keys(), ['alice', 'bob', 'carol'])
+        self.assertEqual(overview['calls_per_day'].values(), [2, 1, 1])
+
+
+class TestDailyRollup(TestCase):
+    """Test that the reports read from the DailyRollup table return the same results as the calls."""
+    multi_db = True
+
+    def setUp(self):
+        calls = [
+            ('1', 'Jisc', 'alice', datetime(2016, 10, 1, 9), datetime(2016, 10, 1, 11), 'VidyoDesktop', 'Windows'),
+            ('1', 'Jisc', 'bob', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 12), 'VidyoWeb', 'Linux'),
+            ('2', 'ActionAid', 'carol', datetime(2016, 10, 1, 10), datetime(2016, 10, 1, 11), 'VidyoWeb', 'OS X'),
+            ('3', 'ActionAid', 'gateway', datetime(2016, 10, 2, 9), datetime(2016, 10, 2, 10), 'VidyoGateway', ''),
+            ('4', 'Jisc', 'alice', datetime(2016, 10, 3, 9), datetime(2016, 10, 3, 10), 'VidyoMobile', 'iOS'),
+        ]
+        for unique_call_id, tenant, caller_name, join_time, leave_time, platform, os in calls:
+            Call.objects.using('platformc').create(uniquecallid=unique_call_id, tenantname=tenant,
+                                                   callername=caller_name, jointime=join_time, leavetime=leave_time,
+                                                   applicationname=platform, applicationos=os,
+                                                   callstate='COMPLETED')
+
+    def reports(self, username):
+        start_date, end_date = date(2016, 10, 1), date(2016, 10, 3)
+        return [
+            dict(calculate_concurrent_lines(username, 'platformc', start_date, end_date)),
+            dict(calculate_concurrent_gateway_ports(username, 'platformc', start_date, end_date)),
+            calculate_platform_stats(username, 'platformc', start_date, end_date),
+            calculate_os_stats(username, 'platformc', start_date, end_date),
+            len(calculate_calls_per_day(username, 'platformc', start_date, end_date)),
+        ]
+
+    def test_rollup(self):
+        roll_up_database('platformc', date(2016, 10, 3))
+
+        rollup = DailyRollup.objects.get(database='platformc', tenantname='All', day=date(2016, 10, 1))
+        self.assertEqual((rollup.calls, rollup.unique_calls, rollup.concurrent_lines), (3, 2, 3))
+        self.assertEqual(rollup.total_minutes, 300)
+
+    def test_reports_match_calls(self):
+        for username in ['All', 'Jisc', 'ActionAid']:
+            calls_reports = self.reports(username)
+            roll_up_database('platformc', date(2016, 10, 2))
+            self.assertEqual(self.reports(username), calls_reports)
+            roll_up_database('platformc', date(2016, 10, 3))
+            self.assertEqual(self.reports(username), calls_reports)
+            RollupProgress.objects.all().delete()
+
+    def test_skip_rollups(self):
+        roll_up_database('platformc', date(2016, 10, 3))
+        Call.objects.using('platformc').filter(callername='gateway').delete()
+
+        start_date, end_date = date(2016, 10, 1), date(2016, 10, 3)
+        self.assertEqual(calculate_concurrent_gateway_ports('All', 'platformc', start_date, end_date).values(), [1])
+        with self.settings(READ_ROLLUPS=False):
+            self.assertEqual(calculate_concurrent_gateway_ports('All', 'platformc', start_date, end_date), {})
+
+    def create_midnight_calls(self):
+        # A line crosses midnight, while another joins at midnight.
+        for caller_name, join_time, leave_time in [('dave', datetime(2016, 10, 31, 23), datetime(2016, 11, 1, 1)),
+                                                   ('erin', datetime(2016, 11, 1), datetime(2016, 11, 1, 1))]:
+            Call.objects.using('platformc').create(uniquecallid='5', tenantname='Jisc', callername=caller_name,
+                                                   jointime=join_time, leavetime=leave_time,
+                                                   applicationname='VidyoDesktop', callstate='COMPLETED')
+
+    def test_batch_edge(self):
+        # The days are rolled up in batches from 01/10 to 31/10 and from 01/11.
+        self.create_midnight_calls()
+
+        start_date, end_date = date(2016, 10, 1), date(2016, 11, 1)
+        calls_lines = calculate_concurrent_lines('Jisc', 'platformc', start_date, end_date)
+        roll_up_database('platformc', end_date)
+        self.assertEqual(DailyRollup.objects.get(tenantname='Jisc', day=date(2016, 11, 1)).concurrent_lines, 2)
+        self.assertEqual(calculate_concurrent_lines('Jisc', 'platformc', start_date, end_date), calls_lines)
+
+    def test_midnight(self):
+        # The line that joined the day before counts on the first day of a report, as in the rollup of that day.
+        self.create_midnight_calls()
+
+        day = date(2016, 11, 1)
+        calls_lines = calculate_concurrent_lines('Jisc', 'platformc', day, day)
+        self.assertEqual(dict(calls_lines), {day: 2})
+        roll_up_database('platformc', day)
+        self.assertEqual(calculate_concurrent_lines('Jisc', 'platformc', day, day), calls_lines)
+        self.assertEqual(dict(calculate_concurrent_lines_per_hour('Jisc', 'platformc', day, day)),
+                         {datetime(2016, 11, 1, 0): 2, datetime(2016, 11, 1, 1): 2})
+
+
+class TestFanOut(TestCase):
+    """Test that the databases of a report are queried in parallel and that a slow one is left out."""
+
+    def report(self, username, selected_db, start_date, end_date):
+        if selected_db == 'ajenta.io':
+            sleep(1)
+        return selected_db
+
+    def test_both_databases(self):
+        results = fan_out(self.report, ['platformc', 'ajenta.io'], 'All', date.today(), date.today())
+        self.assertEqual(results, {'platformc': 'platformc', 'ajenta.io': 'ajenta.io'})
+
+    def test_timeout(self):
+        with self.settings(REPORT_DATABASE_TIMEOUT=0.2):
+            results = fan_out(self.report, ['platformc', 'ajenta.io'], 'All', date.today(), date.today())
+        self.assertEqual(results, {'platformc': 'platformc'})
+
+    def test_timeout_stops_report(self):
+        stopped = []
+
+        def report(username, selected_db, start_date, end_date):
+            try:
+                while selected_db == 'ajenta.io':
+                    check_budget()
+                    sleep(0.01)
+            except ReportOverBudget:
+                stopped.append(selected_db)
+                raise
+            return selected_db
+
+        # The late database does not keep its thread once left out of the report.
+        with self.settings(REPORT_DATABASE_TIMEOUT=0.2):
+            results = fan_out(report, ['platformc', 'ajenta.io'], 'All', date.today(), date.today())
+        self.assertEqual(results, {'platformc': 'platformc'})
+        sleep(0.1)
+        self.assertEqual(stopped, ['ajenta.io'])
+
+
+class TestReportTask(TransactionTestCase):
+    """
+    Test the Celery task that calculates the long reports in the background.
+    Its threads query the databases with their own connections, so the calls are committed.
+    """
+    multi_db = True
+
+    def test_result(self):
+        for database, tenant in [('platformc', 'Jisc'), ('platformc', 'Jisc'), ('ajenta.io', 'Jisc')]:
+            Call.objects.using(database).create(tenantname=tenant, callername='alice',
+                                                jointime=datetime(2016, 10, 1, 9))
+
+        databases = ['platformc', 'ajenta.io']
+        finished = calculate_report_task('calculate_user_stats', databases, 'Jisc',
+                                         date(2016, 10, 1), date(2016, 10, 31))
+
+        self.assertEqual(finished['result'], {'alice': 3})
+        self.assertEqual(finished['missing'], [])
+        self.assertEqual(finished['key'], report_job_key('calculate_user_stats', databases, 'Jisc',
+                                                         date(2016, 10, 1), date(2016, 10, 31)))
+        self.assertNotEqual(finished['key'], report_job_key('calculate_user_stats', ['platformc'], 'Jisc',
+                                                            date(2016, 10, 1), date(2016, 10, 31)))
+
+
+class TestReportTaskId(TestCase):
+    """Test the report URLs with the id of a Celery task, e.g bookmarked after the computing page reloaded them."""
+
+    def setUp(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        user = auth.get_user(self.client)
+        user.user_permissions.add(Permission.objects.get(codename='can_view_stats'))
+
+        self.backend = CacheBackend(app=calculate_report_task.app, backend='memory://')
+        calculate_report_task.backend = self.backend
+        self.query = {'start_date': '2016-10-01', 'end_date': '2016-10-31'}
+
+    def tearDown(self):
+        calculate_report_task.backend = None
+
+    def get(self, task_id):
+        return self.client.get('/user-stats/', dict(self.query, task=task_id))
+
+    def test_successful_task(self):
+        key = report_job_key('calculate_user_stats', ['platformc'], 'Jisc', date(2016, 10, 1), date(2016, 10, 31))
+        self.backend.mark_as_done('done', {'key': key, 'result': {'alice': 3}, 'missing': []})
+        self.assertIn('alice', self.get('done').content)
+
+        # The task of another report is ignored.
+        self.backend.mark_as_done('other', {'key': b'job:other', 'result': {'bob': 3}, 'missing': []})
+        self.assertNotIn('bob', self.get('other').content)
+
+    def test_unknown_task(self):
+        # Celery reports an unknown or expired id as pending forever, so the report is calculated again.
+        response = self.get('made-up')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'stats/user_stats.html')
+
+    def test_failed_task(self):
+        self.backend.mark_as_failure('failed', ValueError('The report failed.'))
+        response = self.get('failed')
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'stats/user_stats.html')
+
+    def test_cached_report(self):
+        key = cache.report_key('calculate_user_stats', 'Jisc', 'platformc', date(2016, 10, 1), date(2016, 10, 31))
+        values = {key: pickle.dumps({'alice': 3})}
+
+        class Cache(redis.StrictRedis):
+            """The commands of the report cache on a dict, as there is no Redis server while testing."""
+
+            def get(self, key):
+                return values.get(key)
+
+            def exists(self, key):
+                return key in values
+
+            def set(self, key, value, ex=None, nx=False):
+                values[key] = value
+
+        cache.client = Cache(port=1)
+        try:
+            # A long range whose result is cached is read from the cache instead of being sent to Celery.
+            with self.settings(ASYNC_REPORT_DAYS=7):
+                response = self.client.get('/user-stats/', self.query)
+        finally:
+            cache.client = None
+        self.assertTemplateUsed(response, 'stats/user_stats.html')
+        self.assertIn('alice', response.content)
+
+
+class TestTimeBudget(TransactionTestCase):
+    """
+    Test the time budgets of the reports, here already past so that the first check stops the report.
+    Its threads query the databases with their own connections, so the calls are committed.
+    """
+    multi_db = True
+
+    def setUp(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        user = auth.get_user(self.client)
+        user.user_permissions.add(Permission.objects.get(codename='can_view_stats'))
+
+        session = self.client.session
+        session['username'] = user.username
+        session['selected_db'] = 'platformc'
+        session['both_dbs'] = False
+        session['start_date'] = '01/10/2016'
+        session['end_date'] = '31/10/2016'
+        session.save()
+
+        for caller_name, join_hours, leave_hours in [('alice', 9, 11), ('bob', 10, 12)]:
+            Call.objects.using('platformc').create(tenantname='Jisc', callername=caller_name, callstate='COMPLETED',
+                                                   jointime=datetime(2016, 10, 1, join_hours),
+                                                   leavetime=datetime(2016, 10, 1, leave_hours))
+
+    def test_check_budget(self):
+        check_budget()
+        with within_deadline(None, ['platformc']):
+            check_budget()
+        with within_deadline(deadline_after(-1), ['platformc']):
+            self.assertRaises(ReportOverBudget, check_budget)
+            # A later deadline within it does not postpone it.
+            with within_deadline(deadline_after(60), ['platformc']):
+                self.assertRaises(ReportOverBudget, check_budget)
+        check_budget()
+
+    def test_without_execution_time(self):
+        # The SET fails as on a MySQL before 5.7.8, so the deadline is only checked in Python.
+        connection = connections['platformc']
+        connection.vendor = 'mysql'
+        try:
+            with within_deadline(deadline_after(-1), ['platformc']):
+                self.assertRaises(ReportOverBudget, check_budget)
+            self.assertEqual(connection.execution_time_variables, ())
+
+            with self.assertNumQueries(0, using='platformc'):
+                self.assertFalse(set_execution_time(connection, 1000))
+        finally:
+            del connection.vendor
+            del connection.execution_time_variables
+
+    def test_run_report(self):
+        self.assertRaises(ReportOverBudget, run_report, calculate_concurrent_lines, ['platformc'], 'Jisc',
+                          date(2016, 10, 1), date(2016, 10, 31), budget=-1)
+        result, missing = run_report(calculate_concurrent_lines, ['platformc'], 'Jisc',
+                                     date(2016, 10, 1), date(2016, 10, 31), budget=60)
+        self.assertEqual(dict(result), {date(2016, 10, 1): 2})
+
+    @override_settings(REPORT_TIME_BUDGET=60, REPORT_TIME_BUDGETS={'Maximum concurrent lines': -1})
+    def test_view(self):
+        response = self.client.get('/concurrent-lines/', {'granularity': 'hour'})
+        self.assertTemplateUsed(response, 'stats/over_budget.html')
+        self.assertEqual(QueryDict(response.context['query']).dict(), {'granularity': 'hour', 'background': '1'})
+
+        self.assertTemplateUsed(self.client.get('/user-stats/'), 'stats/user_stats.html')
+
+    @override_settings(REPORT_TIME_BUDGET=-1)
+    def test_api(self):
+        response = self.client.get('/api/concurrent-lines/', {'start_date': '2016-10-01', 'end_date': '2016-10-31'})
+        self.assertEqual(response.status_code, 503)
+
+
+class TestReportData(TransactionTestCase):
+    """Test the JSON API of the reports and its conditional responses."""
+    multi_db = True
+
+    def setUp(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        user = auth.get_user(self.client)
+        user.user_permissions.add(Permission.objects.get(codename='can_view_stats'))
+
+        for tenant, caller_name in [('Jisc', 'alice'), ('Jisc', 'alice'), ('Jisc', 'bob'), ('ActionAid', 'carol')]:
+            Call.objects.using('platformc').create(tenantname=tenant, callername=caller_name,
+                                                   jointime=datetime(2016, 10, 1, 9))
+
+    def get(self, **headers):
+        return self.client.get('/api/user-stats/', {'tenant': 'All', 'start_date': '2016-10-01',
+                                                    'end_date': '2016-10-31'}, **headers)
+
+    def test_series(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        # Only staff can choose the Tenant.
+        self.assertEqual(json.loads(response.content)['series'], [['alice', 2], ['bob', 1]])
+        self.assertEqual(response['Last-Modified'], 'Sat, 01 Oct 2016 08:00:00 GMT')
+
+    def test_not_modified(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Call.objects.using('platformc').create(tenantname='Jisc', callername='bob',
+                                               jointime=datetime(2016, 10, 2, 9))
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_granularity(self):
+        response = self.client.get('/api/calls-per-day/', {'start_date': '2016-10-01', 'end_date': '2016-10-31',
+                                                           'granularity': 'month'})
+        self.assertEqual(json.loads(response.content)['series'], [['2016-10-01', 1]])
+        self.assertEqual(self.client.get('/api/calls-per-day/', {'start_date': '2016-10-01', 'end_date': '2016-10-31',
+                                                                 'granularity': 'year'}).status_code, 400)
+
+    def test_bad_parameters(self):
+        self.assertEqual(self.client.get('/api/user-stats/').status_code, 400)
+        self.assertEqual(self.client.get('/api/cdr/', {'start_date': '2016-10-01',
+                                                       'end_date': '2016-10-31'}).status_code, 404)
+
+
+class TestCdrReport(TestCase):
+    """Test that the CDR report streams the calls of both databases in JoinTime order."""
+    multi_db = True
+
+    def setUp(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        calls = [
+            ('platformc', 'JISC', datetime(2016, 9, 14, 10)),
+            ('platformc', 'Gateway4', datetime(2016, 9, 14, 10)),
+            ('platformc', 'ActionAid', datetime(2016, 9, 14, 11)),
+            ('ajenta.io', 'JISC', datetime(2016, 9, 14, 9)),
+            ('ajenta.io', 'JISC', datetime(2016, 9, 14, 12)),
+        ]
+        for database, tenant, join_time in calls:
+            Call.objects.using(database).create(callername=tenant + join_time.strftime(' %H'), tenantname=tenant,
+                                                jointime=join_time)
+
+        session = self.client.session
+        session['selected_db'] = 'platformc'
+        session['both_dbs'] = True
+        session['start_date'] = '14/09/2016'
+        session['end_date'] = '14/09/2016'
+        session.save()
+
+    def test_both_databases(self):
+        response = self.client.get('/cdr/')
+        rows = list(csv.DictReader(''.join(response.streaming_content).splitlines()))
+        self.assertEqual([row['callername'] for row in rows], ['JISC 09', 'JISC 10', 'Gateway4 10', 'JISC 12'])
+
+    def test_chunks(self):
+        report = generate_cdr_report('platformc', date(2016, 9, 14), date(2016, 9, 14), chunk_size=1)
+        self.assertEqual(len(list(report)), 2)
+
+
+class TestMergeReports(TestCase):
+    """Test that merging the results of both databases gives the same results as a single database with all calls."""
+    multi_db = True
+
+    def create_call(self, database, caller_name, join_time, leave_time, room='room'):
+        # The 'default' database gets all the calls and is used as the expected result.
+        for alias in (database, 'default'):
+            Call.objects.using(alias).create(uniquecallid=database + caller_name + str(join_time),
+                                             conferencename=room, callername=caller_name, tenantname='temp',
+                                             jointime=join_time, leavetime=leave_time, callstate='COMPLETED')
+
+    def merged(self, report):
+        start_date, end_date = date(2016, 9, 14), date(2016, 9, 15)
+        results = [(database, report('temp', database, start_date, end_date))
+                   for database in ('platformc', 'ajenta.io')]
+        return merge_reports(report.__name__, results, 'temp', start_date, end_date)
+
+    def expected(self, report):
+        return report('temp', 'default', date(2016, 9, 14), date(2016, 9, 15))
+
+    def test_top_users(self):
+        # 'shared' is the 11th user of each database, but the most active one of both.
+        for database in ('platformc', 'ajenta.io'):
+            for i in range(10):
+                for hour in range(3):
+                    self.create_call(database, database + str(i), datetime(2016, 9, 14, hour),
+                                     datetime(2016, 9, 14, hour, 30), room=database + str(i))
+            for hour in range(2):
+                self.create_call(database, 'shared', datetime(2016, 9, 15, hour), datetime(2016, 9, 15, hour, 30))
+
+        users = self.merged(calculate_user_stats)
+        self.assertEqual(users.items()[0], ('shared', 4))
+        self.assertEqual(users, self.expected(calculate_user_stats))
+
+        # The rooms are only ordered by count, so the ones with the same count can come in any order.
+        rooms = self.merged(calculate_room_stats)
+        self.assertEqual(rooms.items()[0], ('room', 4))
+        self.assertEqual(rooms.values(), self.expected(calculate_room_stats).values())
+
+    def test_concurrent_lines(self):
+        self.create_call('ajenta.io', 'alice', datetime(2016, 9, 14, 9), datetime(2016, 9, 14, 11))
+        self.create_call('ajenta.io', 'bob', datetime(2016, 9, 15, 9), datetime(2016, 9, 15, 11))
+        self.create_call('platformc', 'bob', datetime(2016, 9, 15, 10), datetime(2016, 9, 15, 12))
+        self.create_call('platformc', 'carol', datetime(2016, 9, 15, 10), datetime(2016, 9, 15, 12))
+
+        lines = self.merged(calculate_concurrent_lines)
+        self.assertEqual(dict(lines), {date(2016, 9, 14): 1, date(2016, 9, 15): 2})
+        self.assertEqual(dict(lines), dict(self.expected(calculate_concurrent_lines)))
+
+        for report in (calculate_concurrent_lines_per_hour, calculate_concurrent_lines_per_week):
+            self.assertEqual(dict(self.merged(report)), dict(self.expected(report)))
+        self.assertEqual(dict(self.merged(calculate_concurrent_lines_per_hour))[datetime(2016, 9, 15, 10)], 2)
+
+    def test_meeting_length(self):
+        self.create_call('ajenta.io', 'alice', datetime(2016, 9, 14, 9), datetime(2016, 9, 14, 10))
+        self.create_call('platformc', 'bob', datetime(2016, 9, 15, 9), datetime(2016, 9, 15, 9, 30))
+        self.create_call('platformc', 'carol', datetime(2016, 9, 15, 10), datetime(2016, 9, 15, 10, 30))
+
+        total, count, histogram = self.merged(calculate_meeting_length_totals)
+        self.assertEqual((total, count), (7200, 3))
+        # Two meetings of 30 minutes (up to 1800 seconds) and one of an hour (up to 3600 seconds).
+        self.assertEqual(histogram[LENGTH_BUCKETS.index(1800)], 2)
+        self.assertEqual(histogram[LENGTH_BUCKETS.index(3600)], 1)
+        self.assertEqual(self.merged(calculate_meeting_length_totals),
+                         self.expected(calculate_meeting_length_totals))
+
+        with self.assertNumQueries(1, using='platformc'):
+            calculate_meeting_length_totals('temp', 'platformc', date(2016, 9, 14), date(2016, 9, 15))
+
+
+class TestBenchmark(TestCase):
+    """Test the synthetic calls and the measurements of the benchmarks."""
+    multi_db = True
+
+    def test_synthetic_calls(self):
+        calls = list(synthetic_calls(500, days=7))
+        self.assertEqual(len(calls), 500)
+        self.assertEqual([call.callerid for call in calls], [call.callerid for call in synthetic_calls(500, days=7)])
+
+        completed = [call for call in calls if call.callstate == 'COMPLETED']
+        self.assertTrue(all(call.jointime <= call.leavetime for call in completed))
+        self.assertTrue(any(call.applicationname == 'VidyoGateway' for call in calls))
+        self.assertTrue(all(date.today() - timedelta(7) <= call.jointime.date() < date.today() for call in calls))
+
+    def test_measure(self):
+        generate_calls('platformc', 300, days=7)
+        self.assertEqual(Call.objects.using('platformc').count(), 300)
+
+        functions = dict(report_benchmarks('All', 'platformc', date.today() - timedelta(7), date.today()))
+        result = measure(functions['queries.calculate_user_stats'], 'platformc', repeat=2)
+        self.assertEqual(result['queries'], 1)
+        self.assertGreaterEqual(result['seconds'], 0)
+
+    def test_names(self):
+        generate_calls('platformc', 300, days=7)
+        start_date, end_date = date.today() - timedelta(7), date.today()
+
+        # The benchmarks are listed without reading the calls, which only the process measuring them does.
+        with self.assertNumQueries(0, using='platformc'):
+            names = benchmark_names('All', 'platformc', start_date, end_date)
+        functions = report_benchmarks('All', 'platformc', start_date, end_date) + \
+            utils_benchmarks('All', 'platformc', start_date, end_date)
+        self.assertEqual(names, [name for name, _ in functions])
+
+    def test_compare_results(self):
+        previous = {'results': [{'name': 'a', 'seconds': 1.0}, {'name': 'b', 'seconds': 1.0}]}
+        current = {'results': [{'name': 'a', 'seconds': 1.1}, {'name': 'b', 'seconds': 1.5}, {'name': 'c', 'seconds': 1}]}
+        self.assertEqual(list(compare_results(previous, current)), [('a', 1.0, 1.1, False), ('b', 1.0, 1.5, True)])
+
+
+@skipIf(columnar.numpy is None, 'NumPy is not installed.')
+class TestColumnar(TestCase):
+    """Test that the NumPy engine gives the same results as processing the calls one by one."""
+    multi_db = True
+
+    def setUp(self):
+        generate_calls('platformc', 3000, days=10)
+        # A line with overlapping and touching calls, and a call that leaves before it joins.
+        yesterday = datetime.combine(date.today() - timedelta(1), datetime.min.time())
+        for join_hours, leave_hours in [(9, 11), (10, 12), (12, 13), (15, 14)]:
+            Call.objects.using('platformc').create(tenantname='Jisc', callername='alice', callstate='COMPLETED',
+                                                   jointime=yesterday + timedelta(hours=join_hours),
+                                                   leavetime=yesterday + timedelta(hours=leave_hours))
+
+    def assertSameResults(self, report, username='All'):
+        start_date, end_date = date.today() - timedelta(10), date.today()
+        with override_settings(COLUMNAR_ROW_THRESHOLD=0):
+            vectorised = report(username, 'platformc', start_date, end_date)
+        self.assertEqual(vectorised, report(username, 'platformc', start_date, end_date))
+
+    def test_overview(self):
+        self.assertSameResults(calculate_overview)
+        self.assertSameResults(calculate_overview, username='Jisc')
+
+    def test_concurrent_lines(self):
+        self.assertSameResults(calculate_concurrent_lines)
+        self.assertSameResults(calculate_concurrent_lines, username='Jisc')
+        self.assertSameResults(calculate_concurrent_gateway_ports)
+
+    def test_threshold(self):
+        # The rows are counted as they are read, without a COUNT(*) query.
+        calls = tenant_calls('All', 'platformc', date.today() - timedelta(10), date.today())
+        with self.assertNumQueries(1, using='platformc'):
+            self.assertEqual(len(list(columnar.read_calls(calls, ['callername']))), 3004)
+        with override_settings(COLUMNAR_ROW_THRESHOLD=3004), self.assertNumQueries(1, using='platformc'):
+            self.assertEqual(len(columnar.read_calls(calls, ['callername'])), 3004)
+        with override_settings(COLUMNAR_ROW_THRESHOLD=3003), self.assertNumQueries(1, using='platformc'):
+            columns = columnar.read_calls(calls, ['callername'])
+        self.assertEqual(len(columns.codes['callername']), 3004)
+
+
+@skipIf(columnar.numpy is None, 'NumPy is not installed.')
+class TestArchive(TestCase):
+    """Test that the reports read from an archive have the same results as the ones read from the database."""
+    multi_db = True
+
+    def setUp(self):
+        generate_calls('platformc', 2000, days=10)
+        # A call that leaves before it joins and one in progress.
+        yesterday = datetime.combine(date.today() - timedelta(1), datetime.min.time())
+        Call.objects.using('platformc').create(tenantname='Jisc', callername='alice', callstate='COMPLETED',
+                                               uniquecallid='wrapped', jointime=yesterday + timedelta(hours=15),
+                                               leavetime=yesterday + timedelta(hours=14))
+        Call.objects.using('platformc').create(tenantname='Jisc', callername='bob', callstate='IN PROGRESS',
+                                               jointime=yesterday + timedelta(hours=9))
+        # A call across midnight at the start of the reports.
+        Call.objects.using('platformc').create(tenantname='Jisc', callername='dave', callstate='COMPLETED',
+                                               jointime=yesterday - timedelta(7, hours=1),
+                                               leavetime=yesterday - timedelta(7, hours=-1))
+        UserCountry.objects.create(username='alice', country='United Kingdom')
+        # The meetings of a Tenant with whole seconds, as SQLite cannot subtract the times with microseconds.
+        for unique_call_id, join_hours, leave_hours in [('1', 9, 10), ('1', 9.5, 11), ('2', 13, 13.25)]:
+            Call.objects.using('platformc').create(tenantname='Gateway4', callername='carol', callstate='COMPLETED',
+                                                   uniquecallid=unique_call_id,
+                                                   jointime=yesterday + timedelta(hours=join_hours),
+                                                   leavetime=yesterday + timedelta(hours=leave_hours))
+
+        self.path = tempfile.mkdtemp()
+        self.archives = {'platformc': self.path + '/platformc'}
+        with override_settings(CALL_ARCHIVES=self.archives):
+            call_command('export_archive', database='platformc', stdout=StringIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertSameResults(self, report, username='All', compare=lambda result: result):
+        start_date, end_date = date.today() - timedelta(8), date.today() - timedelta(1)
+        with override_settings(CALL_ARCHIVES=self.archives), self.assertNumQueries(0, using='platformc'):
+            archived = report(username, 'platformc', start_date, end_date)
+        self.assertEqual(compare(archived), compare(report(username, 'platformc', start_date, end_date)))
+
+    def test_reports(self):
+        # Rooms with the same number of calls are in no particular order in the database.
+        room_counts = lambda rooms: sorted(rooms.values())
+        for username in ['All', 'Jisc']:
+            for _, report in RANGE_REPORTS:
+                if report is not calculate_average_meeting_length:
+                    self.assertSameResults(report, username, room_counts if report is calculate_room_stats else dict)
+            self.assertSameResults(calculate_calls_per_hour, username)
+            self.assertSameResults(calculate_concurrent_lines_per_week, username)
+            self.assertSameResults(calculate_high_water_mark, username)
+
+    def test_meeting_lengths(self):
+        self.assertSameResults(calculate_meeting_length_totals, 'Gateway4')
+        self.assertSameResults(calculate_average_meeting_length, 'Gateway4')
+
+    def test_merge_counts(self):
+        start_date, end_date = date.today() - timedelta(10), date.today()
+        for field, distinct in [('callername', None), ('conferencename', 'uniquecallid')]:
+            values = set(tenant_calls('All', 'platformc', start_date, end_date).values_list(field, flat=True)[:5])
+            for counted_values in (values, None):
+                with override_settings(CALL_ARCHIVES=self.archives):
+                    archived = count_tenant_values('All', 'platformc', start_date, end_date, field,
+                                                   values=counted_values, distinct=distinct)
+                self.assertEqual(archived, count_tenant_values('All', 'platformc', start_date, end_date, field,
+                                                               values=counted_values, distinct=distinct))
+
+    def test_verify(self):
+        with override_settings(CALL_ARCHIVES=self.archives):
+            call_command('export_archive', database='platformc', verify=True, stdout=StringIO())
+
+            Call.objects.using('platformc').create(tenantname='Jisc', callername='carol', jointime=datetime.now())
+            with self.assertRaises(CommandError):
+                call_command('export_archive', database='platformc', verify=True)
+            with self.assertRaises(CommandError):
+                call_command('export_archive', database='platformc')
+
+
+class TestMetrics(TestCase):
+    """Test the instrumentation of the reports and the /metrics endpoint."""
+    multi_db = True
+
+    def setUp(self):
+        metrics.local_metrics.clear()
+
+    def test_instrumented_report(self):
+        for tenant in ['Jisc', 'Jisc', 'ActionAid']:
+            Call.objects.using('platformc').create(tenantname=tenant, callername=tenant,
+                                                   jointime=datetime(2016, 10, 1, 9))
+
+        report = metrics.instrumented_report(calculate_user_stats)
+        self.assertEqual(report('All', 'platformc', date(2016, 10, 1), date(2016, 10, 1)),
+                         {'Jisc': 2, 'ActionAid': 1})
+
+        labels = (('database', 'platformc'), ('report', 'calculate_user_stats'))
+        self.assertEqual(metrics.read_metric('dashboard_report_queries')[labels, 'sum'], 1)
+        self.assertEqual(metrics.read_metric('dashboard_report_rows')[labels, 'sum'], 2)
+        self.assertEqual(metrics.read_metric('dashboard_report_seconds')[labels, 'count'], 1)
+
+        # The cursors are no longer measured afterwards.
+        calculate_user_stats('All', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+        self.assertEqual(metrics.read_metric('dashboard_report_queries')[labels, 'sum'], 1)
+
+    @override_settings(CALL_REPLICAS={'platformc': 'ajenta.io'}, REPORTS_FROM_REPLICAS=True)
+    def test_measured_databases(self):
+        # The calls are read from the replica and the rollups from the default database.
+        report = metrics.instrumented_report(calculate_concurrent_lines)
+        report('All', 'platformc', date(2016, 10, 1), date(2016, 10, 1))
+
+        labels = (('database', 'platformc'), ('report', 'calculate_concurrent_lines'))
+        self.assertEqual(metrics.read_metric('dashboard_report_queries')[labels, 'sum'], 2)
+
+        task = metrics.instrumented_task('platformc')(
+            lambda: calculate_concurrent_lines('All', 'platformc', date(2016, 10, 2), date(2016, 10, 2)))
+        task()
+        self.assertEqual(metrics.read_metric('dashboard_task_queries')[(('task', '<lambda>'),), 'sum'], 2)
+
+    def test_render(self):
+        for seconds in [0.01, 0.3, 1000]:
+            metrics.observe('dashboard_view_seconds', seconds, view='user_stats')
+
+        with override_settings(METRICS_ALLOWED_IPS=['127.0.0.1']):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+
+        lines = response.content.splitlines()
+        self.assertIn('# TYPE dashboard_view_seconds histogram', lines)
+        self.assertIn('dashboard_view_seconds_bucket{view="user_stats",le="0.05"} 1', lines)
+        self.assertIn('dashboard_view_seconds_bucket{view="user_stats",le="0.5"} 2', lines)
+        self.assertIn('dashboard_view_seconds_bucket{view="user_stats",le="+Inf"} 3', lines)
+        self.assertIn('dashboard_view_seconds_count{view="user_stats"} 3', lines)
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        with override_settings(METRICS_ALLOWED_IPS=['10.0.0.1']):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        User.objects.create_user(username='temp', password='temp')
+        self.client.login(username='temp', password='temp')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        User.objects.filter(username='temp').update(is_staff=True)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class TestCurrentCalls(TestCase):
+    """Test the counts of the calls in progress kept up to date on the Current Calls page."""
+    multi_db = True
+
+    def setUp(self):
+        for tenant, state in [('Jisc', 'IN PROGRESS'), ('Jisc', 'IN PROGRESS'), ('ActionAid', 'IN PROGRESS'),
+                              ('Jisc', 'COMPLETED')]:
+            Call.objects.using('platformc').create(tenantname=tenant, callstate=state, jointime=datetime.now())
+
+    def test_counts(self):
+        with self.assertNumQueries(1, using='platformc'):
+            counts = count_current_calls()
+        self.assertEqual(counts, {'Jisc': 2, 'ActionAid': 1, 'All': 3})
+
+    def test_live(self):
+        User.objects.create_user(username='Jisc', password='temp')
+        self.client.login(username='Jisc', password='temp')
+
+        session = self.client.session
+        session['username'] = 'Jisc'
+        session.save()
+
+        # Without Redis the calls are counted in the database.
+        response = self.client.get('/current-calls/live/')
+        self.assertEqual(json.loads(response.content), {'current_calls': 2})
+
+        # So are they while Redis is down.
+        cache.client = redis.StrictRedis(port=1)
+        try:
+            response = self.client.get('/current-calls/live/')
+        finally:
+            cache.client = None
+        self.assertEqual(json.loads(response.content), {'current_calls': 2})
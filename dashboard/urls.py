@@ -12,7 +12,12 @@ urlpatterns = [
     url(r'^concurrent-gateway-ports', views.concurrent_gateway_ports, name='concurrent_gateway_ports'),
     url(r'^platform-stats', views.platform_stats, name='platform_stats'),
     url(r'^os-stats', views.os_stats, name='os_stats'),
+    url(r'^overview', views.overview, name='overview'),
+    url(r'^current-calls/live/$', views.current_calls_live, name='current_calls_live'),
     url(r'^current-calls', views.current_calls, name='current_calls'),
     url(r'^calls-by-country', views.calls_by_country, name='calls_by_country'),
     url(r'^cdr', views.cdr_report, name='cdr_report'),
+    url(r'^report-status/(?P<task_id>[\w-]+)/$', views.report_status, name='report_status'),
+    url(r'^api/(?P<report>[\w-]+)/$', views.report_data, name='report_data'),
+    url(r'^metrics$', views.metrics, name='metrics'),
 ]
@@ -1,79 +1,314 @@
 import csv
+import heapq
+import os
+import time
+from bisect import bisect_left
 from collections import defaultdict, OrderedDict
-from itertools import chain
+from datetime import datetime, timedelta
+from itertools import groupby
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 
+from django.conf import settings
+from django.db import close_old_connections
 
-def merge_two_dicts(x, y):
-    """Given two dicts, merge them into a new dict and sort it by value."""
-    z = x.copy()
-    z.update(y)
-    return OrderedDict(sorted(z.items(), key=lambda x: x[1], reverse=True))
+from .budget import check_budget, within_deadline, ReportOverBudget, CHECK_INTERVAL
+
+# The users export of ActionAid, with the country of each user. It is loaded into the UserCountry table.
+USERS_CSV = os.path.join(settings.STATIC_PATH, 'UsersExport.csv')
+
+# The thread pool of fan_out() is created on first use in each process,
+# as the gunicorn and Celery workers are forked after the modules are imported.
+pool = None
+
+
+def top_counts(counts, limit, other=None):
+    """
+    Return the most common values of a Counter, ordered by count and then by value.
+
+    If 'other' is given, the counts of the values outside the top ones are added up under that label.
+    """
+    top = sorted(counts.items(), key=lambda (value, count): (-count, value))[:limit]
+    top_values = OrderedDict(top)
+
+    others = sum(counts.values()) - sum(top_values.values())
+    if other is not None and others:
+        top_values[other] = others
+
+    return top_values
+
+
+def to_date(value):
+    """Return the date of a date or a datetime, as the views pass datetimes and the Celery tasks pass dates."""
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def get_pool():
+    """Return the thread pool of fan_out(), bounded to REPORT_THREADS threads."""
+    global pool
+    if pool is None:
+        pool = ThreadPool(getattr(settings, 'REPORT_THREADS', 4))
+    return pool
+
+
+def run_with_own_connection(function, args, kwargs, deadline):
+    """
+    Run the function in a thread of the pool, with the database connections of the thread.
+    Like Django does around each request, the connections are closed once older than their CONN_MAX_AGE
+    or broken, so that the threads keep theirs open across reports with persistent connections.
+
+    The report stops at the deadline of fan_out() (see within_deadline()), so that a database that does not
+    respond in time does not keep the thread from the reports of the other databases.
+    """
+    close_old_connections()
+    try:
+        with within_deadline(deadline, [args[1]]):
+            return function(*args, **kwargs)
+    except ReportOverBudget:
+        # Past the deadline of fan_out(), the database is left out of the report like any late one.
+        if time.time() < deadline:
+            raise
+        raise TimeoutError()
+    finally:
+        close_old_connections()
+
+
+def fan_out(function, databases, username, start_date, end_date, **kwargs):
+    """
+    Run a calculate_* function for each of the given databases at the same time, each in its own thread and
+    with its own database connection. Return a dictionary with the result of each database that finished
+    within REPORT_DATABASE_TIMEOUT seconds, so that a slow database does not hold the whole report.
+    """
+    deadline = time.time() + getattr(settings, 'REPORT_DATABASE_TIMEOUT', 120)
+
+    pending = [(database, get_pool().apply_async(run_with_own_connection,
+                                                 (function, (username, database, start_date, end_date), kwargs,
+                                                  deadline)))
+               for database in databases]
+
+    results = {}
+    for database, result in pending:
+        try:
+            results[database] = result.get(max(deadline - time.time(), 0))
+        except TimeoutError:
+            pass
+
+    return results
+
+
+class Echo(object):
+    """A file-like object that returns what is written to it, so that a csv.writer can feed a streaming response."""
+
+    def write(self, value):
+        return value
+
+
+def keyed(iterable, key, index):
+    for item in iterable:
+        yield key(item), index, item
+
+
+def merge_sorted(iterables, key):
+    """Merge iterables that are already sorted by the given key into a single sorted iterator."""
+    keyed_iterables = [keyed(iterable, key, index) for index, iterable in enumerate(iterables)]
+
+    for _, _, item in heapq.merge(*keyed_iterables):
+        yield item
 
 
 def read_users_csv():
-    """Read the 'UsersExport.csv' file used in calculate_calls_by_country()."""
-    input_file = open('static/UsersExport.csv')
+    """Read the 'UsersExport.csv' file and return the Group (country) of each Username."""
     columns = 'Username,Group'.split(',')
 
-    reader = csv.DictReader(input_file)
-    desired_cols = (tuple(row[col] for col in columns) for row in reader)
-
-    return dict(desired_cols)
+    with open(USERS_CSV) as input_file:
+        reader = csv.DictReader(input_file)
+        return dict(tuple(row[col] for col in columns) for row in reader)
 
 
-def time_in_range(start, end, time):
-    if start <= end:
-        return start <= time <= end
-    else:
-        return start <= time or time <= end
+# Event kinds used by the concurrent lines sweep. Joins sort before leaves,
+# so a line leaving at the exact time another one joins is counted as concurrent.
+JOIN, LEAVE = 0, 1
 
 
 def concurrent_lines(calls):
-    """Concurrent lines calculation."""
-    calls_dict = defaultdict(list)
+    """
+    Yield (time, active lines) for every join/leave time of the given calls, in chronological order.
+
+    A line is a distinct caller name and it is active from its join time until its leave time (both inclusive).
+    The events are sorted once and swept in a single pass, keeping a count of the open calls of each line.
+    """
+    events = []
+    open_calls = defaultdict(int)
 
-    # Create a dictionary of caller names and join/leave times
     for call in calls:
         caller_name = call['callername']
         join_time = call['jointime']
         leave_time = call['leavetime']
-        calls_dict[caller_name] += (join_time, leave_time)
 
-    # Check if line was active at the given time
-    def line_active_at(call_id, time):
-        time_pairs = calls_dict.get(call_id)
-        for pair in xrange(0, len(time_pairs), 2):
-            if time_in_range(time_pairs[pair], time_pairs[pair + 1], time):
-                return True
+        # A call that leaves before it joins wraps around, so the line is active until
+        # its leave time and again after its join time.
+        if join_time > leave_time:
+            open_calls[caller_name] += 1
+
+        events.append((join_time, JOIN, caller_name))
+        events.append((leave_time, LEAVE, caller_name))
+
+    events.sort(key=itemgetter(0, 1))
+    active_lines = sum(1 for count in open_calls.itervalues() if count)
 
-    times_list = list(chain.from_iterable(calls_dict.values()))
+    for index, (time, group) in enumerate(groupby(events, key=itemgetter(0))):
+        if not index % CHECK_INTERVAL:
+            check_budget()
+        leaving = []
+        for _, event, caller_name in group:
+            if event == LEAVE:
+                leaving.append(caller_name)
+                continue
+            if not open_calls[caller_name]:
+                active_lines += 1
+            open_calls[caller_name] += 1
 
-    # Create a list with the active lines for each time
-    lines_by_time = defaultdict(list)
-    for time in times_list:
-        lines_by_time[time] = [call_id for call_id in calls_dict if line_active_at(call_id, time)]
+        yield time, active_lines
 
-    return lines_by_time
+        for caller_name in leaving:
+            open_calls[caller_name] -= 1
+            if not open_calls[caller_name]:
+                active_lines -= 1
 
 
 def concurrent_lines_per_day(calls):
     """Find the max concurrent lines number for each day"""
-    lines_by_time = concurrent_lines(calls)
-
     max_lines_by_day = defaultdict(int)
-    for time, call_id in lines_by_time.iteritems():
+    for time, active_lines in concurrent_lines(calls):
         day = time.date()
-        max_lines_by_day[day] = max(max_lines_by_day[day], len(set(call_id)))
+        max_lines_by_day[day] = max(max_lines_by_day[day], active_lines)
 
     return max_lines_by_day
 
 
-def participants_per_call(calls, unique_call_id):
-    """Find the max concurrent lines number for each UniqueCallID"""
-    lines_by_time = concurrent_lines(calls)
+def bucket_start(value, granularity):
+    """
+    Return the start of the hour, day, ISO week (from Monday) or month of a datetime or a date.
+    Hours are datetimes, while days, weeks and months are dates like the days of the daily reports.
+    """
+    if granularity == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+
+    day = to_date(value)
+    if granularity == 'week':
+        return day - timedelta(day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, granularity):
+    if granularity == 'hour':
+        return start + timedelta(hours=1)
+    if granularity == 'week':
+        return start + timedelta(7)
+    if granularity == 'month':
+        return (start + timedelta(32)).replace(day=1)
+    return start + timedelta(1)
+
+
+def bucket_days(start, granularity):
+    """Return the first and the last day of the given bucket."""
+    if granularity == 'hour':
+        return start.date(), start.date()
+    return start, next_bucket(start, granularity) - timedelta(1)
+
+
+def bucket_time(bucket):
+    """Return the datetime when the given bucket starts."""
+    if isinstance(bucket, datetime):
+        return bucket
+    return datetime.combine(bucket, datetime.min.time())
+
+
+def rebucket(days, granularity, combine):
+    """Combine the values of the days of a daily report for each bucket of the given granularity (e.g with max)."""
+    buckets = OrderedDict()
+    for day in sorted(days):
+        bucket = bucket_start(day, granularity)
+        buckets[bucket] = combine(buckets[bucket], days[day]) if bucket in buckets else days[day]
+
+    return buckets
+
+
+def with_bucket_boundaries(calls, granularity):
+    """
+    Yield the calls and, at each start of a bucket during a call, a call of the same line that joins and leaves
+    at that time, so that the sweep also counts the line in the buckets where it has no join or leave.
+    """
+    for call in calls:
+        yield call
+
+        bucket = next_bucket(bucket_start(call['jointime'], granularity), granularity)
+        while bucket_time(bucket) < call['leavetime']:
+            yield {'callername': call['callername'], 'jointime': bucket_time(bucket), 'leavetime': bucket_time(bucket)}
+            bucket = next_bucket(bucket, granularity)
+
+
+def concurrent_lines_per_bucket(calls, granularity):
+    """Find the max concurrent lines number for each hour, day, week or month."""
+    max_lines = defaultdict(int)
+    for time, active_lines in concurrent_lines(with_bucket_boundaries(calls, granularity)):
+        bucket = bucket_start(time, granularity)
+        max_lines[bucket] = max(max_lines[bucket], active_lines)
+
+    return max_lines
+
+
+def in_date_range(buckets, start_date, end_date):
+    """
+    Return the hours or days of a concurrent lines report that are in the given date range, as the calls across
+    the edges of the range also have lines on the days outside it.
+    """
+    start_date, end_date = to_date(start_date), to_date(end_date)
+
+    return defaultdict(int, ((bucket, lines) for bucket, lines in buckets.iteritems()
+                             if start_date <= to_date(bucket) <= end_date))
+
+
+def participants_per_call(calls):
+    """Find the max concurrent lines number of a single UniqueCallID, given its calls."""
+    max_lines = 0
+    for time, active_lines in concurrent_lines(calls):
+        max_lines = max(max_lines, active_lines)
+
+    return max_lines
+
+
+# Upper bounds in seconds of the buckets of the meeting length histograms, from a minute to a day.
+# The last bucket has the meetings longer than a day.
+LENGTH_BUCKETS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400, 28800, 86400)
+
+
+def length_bucket(seconds):
+    """Return the index of the histogram bucket of a meeting length."""
+    return bisect_left(LENGTH_BUCKETS, seconds)
+
+
+def histogram_percentile(histogram, percentile):
+    """
+    Return the given percentile (e.g 90) of the meeting lengths counted in a histogram, interpolating linearly
+    within its bucket. The lengths in the last bucket are taken as a day long.
+    """
+    count = sum(histogram)
+    if not count:
+        return 0
 
-    max_lines_by_call = defaultdict(int)
-    for time, caller_name in lines_by_time.iteritems():
-        max_lines_by_call[unique_call_id] = max(max_lines_by_call[unique_call_id], len(set(caller_name)))
+    rank = count * percentile / 100.0
+    cumulative = 0
+    for index, bucket_count in enumerate(histogram):
+        if bucket_count and cumulative + bucket_count >= rank:
+            lower = LENGTH_BUCKETS[index - 1] if index else 0
+            upper = LENGTH_BUCKETS[index] if index < len(LENGTH_BUCKETS) else LENGTH_BUCKETS[-1]
+            return lower + (upper - lower) * (rank - cumulative) / bucket_count
+        cumulative += bucket_count
 
-    return max_lines_by_call[unique_call_id]
+    return LENGTH_BUCKETS[-1]
@@ -1,14 +1,31 @@
 import csv
-from datetime import datetime
-
-from django.http import HttpResponse
+import hashlib
+import json
+from datetime import date, datetime
+from functools import wraps
+from itertools import chain
+from time import mktime
+
+from django.conf import settings
+from django.contrib import messages
+from django.http import HttpResponse, JsonResponse, QueryDict, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required, permission_required, user_passes_test
+from django.core.exceptions import PermissionDenied
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
 
+from .budget import ReportOverBudget
+from .cache import get_client, is_cached
 from .forms import UserForm, AdminForm
 from .queries import *
-from .graphs import generate_graph, generate_pie_chart
-from .utils import merge_two_dicts
+from .graphs import generate_graph, generate_pie_chart, generate_overview
+from .live import live_current_calls
+from .metrics import instrumented_view, render_metrics
+from .tasks import calculate_report_task, report_job_key, submit_report
+from .utils import merge_sorted, Echo
 
 # Dictionary of reports and the equivalent view functions.
 report_dict = {
@@ -22,11 +39,308 @@ report_dict = {
     'Calls by country': 'calls_by_country',
     'Platform Stats': 'platform_stats',
     'OS Stats': 'os_stats',
+    'Overview': 'overview',
     'Current Calls': 'current_calls',
     'Download CDR Report': 'cdr_report',
 }
 
 
+def requested_granularity(request):
+    """Return the hour, day, week or month buckets of a time series report, from ?granularity (a day by default)."""
+    granularity = request.GET.get('granularity', 'day')
+    return granularity if granularity in GRANULARITIES else 'day'
+
+
+def refresh_requested(request):
+    """Staff can bypass the report cache by adding ?refresh to the URL of a report."""
+    return request.user.is_staff and 'refresh' in request.GET
+
+
+# The cut-over from the ajenta.io database to platformc. The reports of a range starting before it query both.
+MIGRATION_DATE = date(2016, 9, 15)
+
+
+def report_query(username, databases, start_date, end_date):
+    """Return the query string of the report URLs for the given Tenant, databases and date range."""
+    query = QueryDict(mutable=True)
+    query['tenant'] = username
+    query.setlist('database', databases)
+    query['start_date'] = start_date.isoformat()
+    query['end_date'] = end_date.isoformat()
+
+    return query.urlencode()
+
+
+def requested_tenant(request):
+    """Return the Tenant of a report from ?tenant, or else from the session. Users other than staff get their own."""
+    if not request.user.is_staff:
+        return request.user.username
+
+    return request.GET.get('tenant') or request.session['username']
+
+
+def report_parameters(request):
+    """
+    Return the Tenant, the databases and the first and last day of a report, from the tenant, database (which can
+    be repeated) and ISO start_date and end_date query parameters, like the JSON API. Without them, the choices of
+    the index form are read from the session instead.
+    Raise KeyError if there are none and ValueError if they are not valid, with the same checks of the dates as
+    the index form, as the URLs can be edited.
+    """
+    username = requested_tenant(request)
+
+    if 'start_date' in request.GET:
+        databases = list(OrderedDict.fromkeys(request.GET.getlist('database') or ['platformc']))
+        start_date = datetime.strptime(request.GET['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.GET['end_date'], '%Y-%m-%d').date()
+    else:
+        databases = [request.session['selected_db']] + (['ajenta.io'] if request.session['both_dbs'] else [])
+        start_date = datetime.strptime(request.session['start_date'], '%d/%m/%Y').date()
+        end_date = datetime.strptime(request.session['end_date'], '%d/%m/%Y').date()
+
+    if not databases or not set(databases) <= {'ajenta.io', 'platformc'}:
+        raise ValueError('The database must be ajenta.io or platformc.')
+
+    form = UserForm({'start_date': start_date, 'end_date': end_date})
+    if not form.is_valid():
+        raise ValueError(' '.join(form.non_field_errors()))
+
+    return username, databases, start_date, end_date
+
+
+class ReportPending(Exception):
+    """Raised by calculate_report() when the report is calculated in the background by the given Celery task."""
+
+    def __init__(self, task_id):
+        super(ReportPending, self).__init__(task_id)
+        self.task_id = task_id
+
+
+def computing_page(view):
+    """
+    Show the computing page, which polls the task and reloads the report when it is ready, if it is pending.
+    If the report ran past its time budget, offer to calculate it in the background instead.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        # Keep the other parameters of the report, e.g its granularity, when it is loaded again.
+        query = request.GET.copy()
+        query.pop('refresh', None)
+        query.pop('task', None)
+
+        try:
+            response = view(request, *args, **kwargs)
+        except ReportPending as pending:
+            query['task'] = pending.task_id
+            return render(request, 'stats/computing.html', {'task_id': pending.task_id, 'query': query.urlencode()})
+        except ReportOverBudget:
+            query['background'] = 1
+            return render(request, 'stats/over_budget.html', {'query': query.urlencode(),
+                                                              'background': get_client() is not None})
+
+        # The page of a closed date range does not change, so the browser can keep it (see calculate_report()).
+        max_age = getattr(request, 'report_max_age', None)
+        if max_age:
+            patch_cache_control(response, private=True, max_age=max_age)
+
+        return response
+
+    return wrapper
+
+
+def report_budget(view_name):
+    """
+    Return the seconds that the report of the given view may take while the page waits for it,
+    from REPORT_TIME_BUDGETS by its name in report_dict, or else REPORT_TIME_BUDGET (None for no limit).
+    """
+    budgets = getattr(settings, 'REPORT_TIME_BUDGETS', {})
+    for report, view in report_dict.items():
+        if view == view_name and report in budgets:
+            return budgets[report]
+
+    return getattr(settings, 'REPORT_TIME_BUDGET', None)
+
+
+def in_background(start_date, end_date):
+    """Ranges of at least ASYNC_REPORT_DAYS days are calculated by Celery, if Redis is available to track them."""
+    days = getattr(settings, 'ASYNC_REPORT_DAYS', None)
+    return days is not None and get_client() is not None and (end_date - start_date).days + 1 >= days
+
+
+def finished_task(task_id, job_key):
+    """
+    Return the result of the Celery task of a report once it has succeeded, or raise ReportPending while it is
+    still the job of the report in Redis. Return None for a task that failed or belongs to another report, and
+    for an unknown or expired id (which Celery reports as pending forever), so that the report is asked again.
+    """
+    task = calculate_report_task.AsyncResult(task_id)
+    if task.successful():
+        finished = task.result
+        return finished if finished['key'] == job_key else None
+
+    client = get_client()
+    if client is not None and client.get(job_key) == task_id:
+        raise ReportPending(task_id)
+
+    return None
+
+
+def calculate_report(request, report, username, databases, start_date, end_date):
+    """
+    Calculate the report for the given databases, which are queried in parallel and whose results are merged.
+    A warning is shown for each database that did not respond in time, and its results are left out.
+    Otherwise, the page of a range that ended before today can be cached for REPORT_PAGE_MAX_AGE seconds.
+
+    Long ranges are calculated by a Celery task instead, raising ReportPending to show the computing page,
+    which comes back with the id of the task once its result is ready. So are the reports asked for with
+    ?background, once they ran past the time budget of their view and raised ReportOverBudget.
+    Either way, a report whose results are already in the report cache is read from it straight away.
+    """
+    refresh = refresh_requested(request)
+
+    finished = None
+    task_id = request.GET.get('task')
+    if task_id:
+        finished = finished_task(task_id, report_job_key(report.__name__, databases, username, start_date, end_date))
+
+    if finished is not None:
+        result, missing = finished['result'], finished['missing']
+    elif (in_background(start_date, end_date) or ('background' in request.GET and get_client() is not None)) and \
+            (refresh or not is_cached(report.__name__, username, databases, start_date, end_date)):
+        raise ReportPending(submit_report(report.__name__, databases, username, start_date, end_date, refresh))
+    else:
+        result, missing = run_report(report, databases, username, start_date, end_date, refresh=refresh,
+                                     budget=report_budget(request.resolver_match.url_name))
+
+    for database in missing:
+        messages.warning(request, 'The ' + database + ' database did not respond in time, '
+                                  'so its calls are missing from this report.')
+
+    if not missing and end_date < date.today():
+        request.report_max_age = getattr(settings, 'REPORT_PAGE_MAX_AGE', None)
+
+    return result
+
+
+@login_required
+def report_status(request, task_id):
+    """Tell the computing page whether the task of its report has finished."""
+    task = calculate_report_task.AsyncResult(task_id)
+    return JsonResponse({'ready': task.successful(), 'failed': task.failed()})
+
+
+# The reports of the JSON API, by the URL of their view. The time series ones take a granularity parameter.
+api_reports = {
+    'user-stats': calculate_user_stats,
+    'room-stats': calculate_room_stats,
+    'calls-per-day': calculate_calls_per_day,
+    'participants-per-call': calculate_participants_per_call,
+    'average-meeting-length': calculate_meeting_length_totals,
+    'concurrent-lines': calculate_concurrent_lines,
+    'concurrent-gateway-ports': calculate_concurrent_gateway_ports,
+    'platform-stats': calculate_platform_stats,
+    'os-stats': calculate_os_stats,
+    'overview': calculate_overview,
+}
+
+api_time_series = {
+    'calls-per-day': CALLS_PER_BUCKET,
+    'concurrent-lines': CONCURRENT_LINES_PER_BUCKET,
+}
+
+
+def report_series(result):
+    """Return the result of a report as JSON-friendly series of [value, count], in the order of the report."""
+    if isinstance(result, tuple):
+        total, count, histogram = result
+        return {'total_seconds': total, 'calls': count, 'average_seconds': average_length(total, count),
+                'percentile_seconds': length_percentiles(histogram),
+                'histogram': [[bound, calls] for bound, calls in zip(LENGTH_BUCKETS + (None,), histogram)]}
+
+    items = result.items()
+    if not isinstance(result, OrderedDict):
+        items.sort()
+
+    return [[key, value] for key, value in items]
+
+
+@login_required
+@permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+def report_data(request, report):
+    """
+    Return the series of a report as JSON, for the tenant, database (which can be repeated) and ISO start_date
+    and end_date query parameters, and the granularity of the time series reports (hour, day, week or month).
+    Users other than staff only get the reports of their own Tenant.
+
+    The ETag and Last-Modified headers are derived from the high-water mark of the calls of the range,
+    so a conditional request gets a 304 response, without calculating the report, if no call changed.
+    """
+    if report not in api_reports:
+        return JsonResponse({'error': 'Unknown report "%s".' % report}, status=404)
+
+    try:
+        username = request.GET.get('tenant', 'All') if request.user.is_staff else request.user.username
+        databases = request.GET.getlist('database') or ['platformc']
+        start_date = datetime.strptime(request.GET['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(request.GET['end_date'], '%Y-%m-%d').date()
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'The start_date and end_date parameters are required as YYYY-MM-DD.'},
+                            status=400)
+
+    if not set(databases) <= {'ajenta.io', 'platformc'} or start_date > end_date:
+        return JsonResponse({'error': 'The database must be ajenta.io or platformc and the dates a valid range.'},
+                            status=400)
+
+    function = api_reports[report]
+    granularity = None
+    if report in api_time_series:
+        granularity = request.GET.get('granularity', 'day')
+        if granularity not in GRANULARITIES:
+            return JsonResponse({'error': 'The granularity must be one of %s.' % ', '.join(GRANULARITIES)},
+                                status=400)
+        function = api_time_series[report][granularity]
+
+    marks = [calculate_high_water_mark(username, database, start_date, end_date) for database in databases]
+    etag = hashlib.sha1(json.dumps([report, granularity, username, databases, start_date, end_date, marks],
+                                   cls=DjangoJSONEncoder)).hexdigest()
+    last_changes = [change for mark in marks for change in (mark['last_join'], mark['last_leave']) if change]
+    last_modified = int(mktime(max(last_changes).timetuple())) if last_changes else None
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        # The cached results of ranges that include today may be older than the high-water mark.
+        try:
+            result, missing = run_report(function, databases, username, start_date, end_date,
+                                         refresh=end_date >= date.today(),
+                                         budget=getattr(settings, 'REPORT_TIME_BUDGET', None))
+        except ReportOverBudget:
+            return JsonResponse({'error': 'The report took longer than its time budget. Try a shorter date range.'},
+                                status=503)
+        if missing:
+            return JsonResponse({'error': 'The %s database did not respond in time.' % ' and '.join(missing)},
+                                status=503)
+
+        if report == 'overview':
+            series = dict((key, report_series(value)) for key, value in result.items())
+        else:
+            series = report_series(result)
+
+        data = {'report': report, 'tenant': username, 'databases': databases,
+                'start_date': start_date, 'end_date': end_date, 'series': series}
+        if granularity is not None:
+            data['granularity'] = granularity
+        response = JsonResponse(data)
+
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # The reports are only sent to logged in users, so they are not stored by shared caches.
+    patch_cache_control(response, private=True, no_cache=True)
+
+    return response
+
+
 @login_required
 def index(request):
     #  If this is a POST request, then process the form data.
@@ -41,14 +355,16 @@ def index(request):
             request.session['username'] = request.user.username
 
         if form.is_valid():
-            # Redirect to the right view function, based on the button pressed.
+            # Redirect to the right view function, based on the button pressed,
+            # with the Tenant, databases and date range in the URL of the report.
+            # They are kept in the session too, to fill in the form again.
             try:
                 requested_report = report_dict[request.POST['report']]
                 request.session['start_date'] = request.POST.get('start_date')
                 request.session['end_date'] = request.POST.get('end_date')
                 request.session['selected_db'] = 'platformc'
 
-                if datetime.strptime(request.session['start_date'], "%d/%m/%Y") < datetime(2016, 9, 15):
+                if form.cleaned_data['start_date'] < MIGRATION_DATE:
                     request.session['both_dbs'] = True
                 else:
                     request.session['both_dbs'] = False
@@ -65,7 +381,11 @@ def index(request):
                     request.session['username'] = "All"
                     request.session['both_dbs'] = False
 
-                return redirect(requested_report)
+                databases = [request.session['selected_db']] + (['ajenta.io'] if request.session['both_dbs'] else [])
+                query = report_query(request.session['username'], databases, form.cleaned_data['start_date'],
+                                     form.cleaned_data['end_date'])
+
+                return redirect(reverse(requested_report) + '?' + query)
             except Exception as exception:
                 print exception
 
@@ -92,399 +412,341 @@ def index(request):
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def user_stats(request):
-    # Session variables can be empty if the user types the 'user-stats' URL,
-    # without having sent a POST request from the form in the index page.
+    # The report parameters can be missing if the user types the 'user-stats' URL without them,
+    # without having sent a POST request from the form in the index page before.
     # In order to avoid this error, the user is redirected to the index page
     # until a proper POST request is sent.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    users = calculate_user_stats(username,
-                                 selected_db,
-                                 datetime.strptime(start_date, '%d/%m/%Y'),
-                                 datetime.strptime(end_date, '%d/%m/%Y')
-                                 )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_users = calculate_user_stats(username,
-                                         selected_db,
-                                         datetime.strptime(start_date, '%d/%m/%Y'),
-                                         datetime.strptime(end_date, '%d/%m/%Y')
-                                         )
-        users = merge_two_dicts(users, old_users)
+    # The links of the page, e.g to refresh it, keep the parameters of the report.
+    query = report_query(username, databases, start_date, end_date)
+
+    users = calculate_report(request, calculate_user_stats,
+                             username, databases, start_date, end_date)
 
     title = '10 most active users'
 
     (ids, graph_json) = generate_graph(users, title, username, start_date, end_date)
 
-    return render(request, 'stats/user_stats.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/user_stats.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def room_stats(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    rooms = calculate_room_stats(username,
-                                 selected_db,
-                                 datetime.strptime(start_date, '%d/%m/%Y'),
-                                 datetime.strptime(end_date, '%d/%m/%Y')
-                                 )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_rooms = calculate_room_stats(username,
-                                         selected_db,
-                                         datetime.strptime(start_date, '%d/%m/%Y'),
-                                         datetime.strptime(end_date, '%d/%m/%Y')
-                                         )
-        rooms = merge_two_dicts(rooms, old_rooms)
+    query = report_query(username, databases, start_date, end_date)
+
+    rooms = calculate_report(request, calculate_room_stats,
+                             username, databases, start_date, end_date)
 
     title = '10 most active rooms'
 
     (ids, graph_json) = generate_graph(rooms, title, username, start_date, end_date)
 
-    return render(request, 'stats/room_stats.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/room_stats.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def calls_per_day(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    calls = calculate_calls_per_day(username,
-                                    selected_db,
-                                    datetime.strptime(start_date, '%d/%m/%Y'),
-                                    datetime.strptime(end_date, '%d/%m/%Y')
-                                    )
+    query = report_query(username, databases, start_date, end_date)
 
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_calls = calculate_calls_per_day(username,
-                                            selected_db,
-                                            datetime.strptime(start_date, '%d/%m/%Y'),
-                                            datetime.strptime(end_date, '%d/%m/%Y')
-                                            )
-        calls = merge_two_dicts(calls, old_calls)
+    granularity = requested_granularity(request)
+    calls = calculate_report(request, CALLS_PER_BUCKET[granularity],
+                             username, databases, start_date, end_date)
 
-    title = 'Calls per day'
+    title = 'Calls per ' + granularity
 
     (ids, graph_json) = generate_graph(calls, title, username, start_date, end_date)
 
-    return render(request, 'stats/calls_per_day.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/calls_per_day.html', {'ids': ids, 'graph_json': graph_json, 'title': title,
+                                                        'granularity': granularity, 'granularities': GRANULARITIES,
+                                                        'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def average_meeting_length(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    length = calculate_average_meeting_length(username,
-                                              selected_db,
-                                              datetime.strptime(start_date, '%d/%m/%Y'),
-                                              datetime.strptime(end_date, '%d/%m/%Y')
-                                              )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_length = calculate_average_meeting_length(username,
-                                                      selected_db,
-                                                      datetime.strptime(start_date, '%d/%m/%Y'),
-                                                      datetime.strptime(end_date, '%d/%m/%Y')
-                                                      )
-        length = (length + old_length) / 2
-
-    if length > 60:
-        length /= 60
-        unit = 'minutes'
-    elif length > 3600:
-        length /= 3600
-        unit = 'hours'
-    else:
-        unit = 'seconds'
+    query = report_query(username, databases, start_date, end_date)
+
+    total, count, histogram = calculate_report(request, calculate_meeting_length_totals,
+                                               username, databases, start_date, end_date)
+    length, unit = length_with_unit(average_length(total, count))
 
-    title = 'The average meeting length for ' + username + ' between ' + start_date + ' and ' + end_date + ' was: '
+    title = 'The average meeting length for ' + username + ' between ' + str(start_date) + ' and ' + str(end_date) + \
+        ' was: '
+
+    percentiles = [(percentile,) + length_with_unit(seconds)
+                   for percentile, seconds in length_percentiles(histogram).items()]
 
     return render(request, 'stats/average_meeting_length.html',
-                  {'title': title, 'length': ("%.2f" % length), 'unit': unit})
+                  {'title': title, 'length': length, 'unit': unit, 'percentiles': percentiles, 'query': query})
+
+
+def length_with_unit(seconds):
+    """Return a meeting length formatted in hours, minutes or seconds, and its unit."""
+    if seconds > 3600:
+        return "%.2f" % (seconds / 3600), 'hours'
+    if seconds > 60:
+        return "%.2f" % (seconds / 60), 'minutes'
+    return "%.2f" % seconds, 'seconds'
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def concurrent_lines(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    lines = calculate_concurrent_lines(username,
-                                       selected_db,
-                                       datetime.strptime(start_date, '%d/%m/%Y'),
-                                       datetime.strptime(end_date, '%d/%m/%Y')
-                                       )
+    query = report_query(username, databases, start_date, end_date)
 
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_lines = calculate_concurrent_lines(username,
-                                               selected_db,
-                                               datetime.strptime(start_date, '%d/%m/%Y'),
-                                               datetime.strptime(end_date, '%d/%m/%Y')
-                                               )
-        lines = merge_two_dicts(lines, old_lines)
+    granularity = requested_granularity(request)
+    lines = calculate_report(request, CONCURRENT_LINES_PER_BUCKET[granularity],
+                             username, databases, start_date, end_date)
 
-    title = 'Maximum concurrent lines'
+    title = 'Maximum concurrent lines per ' + granularity
 
     (ids, graph_json) = generate_graph(lines, title, username, start_date, end_date)
 
-    return render(request, 'stats/concurrent_lines.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/concurrent_lines.html', {'ids': ids, 'graph_json': graph_json,
+                                                           'granularity': granularity,
+                                                           'granularities': GRANULARITIES,
+                                                           'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def platform_stats(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    platforms = calculate_platform_stats(username,
-                                         selected_db,
-                                         datetime.strptime(start_date, '%d/%m/%Y'),
-                                         datetime.strptime(end_date, '%d/%m/%Y')
-                                         )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_platforms = calculate_platform_stats(username,
-                                                 selected_db,
-                                                 datetime.strptime(start_date, '%d/%m/%Y'),
-                                                 datetime.strptime(end_date, '%d/%m/%Y')
-                                                 )
-        platforms = merge_two_dicts(platforms, old_platforms)
+    query = report_query(username, databases, start_date, end_date)
+
+    platforms = calculate_report(request, calculate_platform_stats,
+                                 username, databases, start_date, end_date)
 
     title = 'Vidyo Platform stats'
 
     (ids, graph_json) = generate_pie_chart(platforms, title, username, start_date, end_date)
 
-    return render(request, 'stats/platform_stats.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/platform_stats.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
 def os_stats(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    os = calculate_os_stats(username,
-                            selected_db,
-                            datetime.strptime(start_date, '%d/%m/%Y'),
-                            datetime.strptime(end_date, '%d/%m/%Y')
-                            )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_os = calculate_os_stats(username,
-                                    selected_db,
-                                    datetime.strptime(start_date, '%d/%m/%Y'),
-                                    datetime.strptime(end_date, '%d/%m/%Y')
-                                    )
-        os = merge_two_dicts(os, old_os)
+    query = report_query(username, databases, start_date, end_date)
+
+    os = calculate_report(request, calculate_os_stats,
+                          username, databases, start_date, end_date)
 
     title = 'OS stats'
 
     (ids, graph_json) = generate_pie_chart(os, title, username, start_date, end_date)
 
-    return render(request, 'stats/os_stats.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/os_stats.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
+
+
+@login_required
+@permission_required('authentication.can_view_stats', raise_exception=True)
+@instrumented_view
+@computing_page
+def overview(request):
+    # Similar as above. Please check the comment in user_stats() where the logic is explained.
+    try:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
+        return redirect(index)
+
+    query = report_query(username, databases, start_date, end_date)
+
+    # The user, room, calls per day, platform and OS stats, from a single scan of the calls.
+    stats = calculate_report(request, calculate_overview,
+                             username, databases, start_date, end_date)
+
+    (ids, graph_json) = generate_overview(stats, username, start_date, end_date)
+
+    return render(request, 'stats/overview.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
 @permission_required('authentication.can_view_stats', raise_exception=True)
 @user_passes_test(lambda u: u.username == 'ActionAid')
+@instrumented_view
+@computing_page
 def calls_by_country(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    countries = calculate_calls_by_country(username,
-                                           selected_db,
-                                           datetime.strptime(start_date, '%d/%m/%Y'),
-                                           datetime.strptime(end_date, '%d/%m/%Y')
-                                           )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_countries = calculate_calls_by_country(username,
-                                                   selected_db,
-                                                   datetime.strptime(start_date, '%d/%m/%Y'),
-                                                   datetime.strptime(end_date, '%d/%m/%Y')
-                                                   )
-        countries = merge_two_dicts(countries, old_countries)
+    query = report_query(username, databases, start_date, end_date)
+
+    # Reload the countries here rather than in the report threads, if 'UsersExport.csv' changed.
+    sync_user_countries()
+
+    countries = calculate_report(request, calculate_calls_by_country,
+                                 username, databases, start_date, end_date)
 
     title = 'Calls per country'
 
     (ids, graph_json) = generate_graph(countries, title, username, start_date, end_date)
 
-    return render(request, 'stats/calls_by_country.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/calls_by_country.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
+@instrumented_view
+@computing_page
 def concurrent_gateway_ports(request):
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    gateway_ports = calculate_concurrent_gateway_ports(username,
-                                                       selected_db,
-                                                       datetime.strptime(start_date, '%d/%m/%Y'),
-                                                       datetime.strptime(end_date, '%d/%m/%Y')
-                                                       )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_gateway_ports = calculate_concurrent_gateway_ports(username,
-                                                               selected_db,
-                                                               datetime.strptime(start_date, '%d/%m/%Y'),
-                                                               datetime.strptime(end_date, '%d/%m/%Y')
-                                                               )
-        gateway_ports = merge_two_dicts(gateway_ports, old_gateway_ports)
+    query = report_query(username, databases, start_date, end_date)
+
+    gateway_ports = calculate_report(request, calculate_concurrent_gateway_ports,
+                                     username, databases, start_date, end_date)
 
     title = 'Maximum concurrent VidyoGateway ports'
 
     (ids, graph_json) = generate_graph(gateway_ports, title, username, start_date, end_date)
 
-    return render(request, 'stats/concurrent_gateway_ports.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/concurrent_gateway_ports.html', {'ids': ids, 'graph_json': graph_json,
+                                                                   'query': query})
 
 
 @login_required
+@instrumented_view
+@computing_page
 def participants_per_call(request):
     try:
-        username = request.session['username']
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        username, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    parties = calculate_participants_per_call(username,
-                                              selected_db,
-                                              datetime.strptime(start_date, '%d/%m/%Y'),
-                                              datetime.strptime(end_date, '%d/%m/%Y')
-                                              )
-
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_parties = calculate_concurrent_gateway_ports(username,
-                                                         selected_db,
-                                                         datetime.strptime(start_date, '%d/%m/%Y'),
-                                                         datetime.strptime(end_date, '%d/%m/%Y')
-                                                         )
-        parties = merge_two_dicts(parties, old_parties)
+    query = report_query(username, databases, start_date, end_date)
+
+    parties = calculate_report(request, calculate_participants_per_call,
+                               username, databases, start_date, end_date)
 
     title = 'Active participants per call'
 
     (ids, graph_json) = generate_graph(parties, title, username, start_date, end_date)
 
-    return render(request, 'stats/participants_per_call.html', {'ids': ids, 'graph_json': graph_json})
+    return render(request, 'stats/participants_per_call.html', {'ids': ids, 'graph_json': graph_json, 'query': query})
 
 
 @login_required
+@instrumented_view
 def current_calls(request):
     try:
-        username = request.session['username']
+        username = requested_tenant(request)
     except KeyError:
         return redirect(index)
 
-    calls = calculate_current_calls(username)
+    return render(request, 'stats/current_calls.html', {'current_calls': live_current_calls(username),
+                                                        'username': username,
+                                                        'interval': getattr(settings, 'CURRENT_CALLS_INTERVAL', 10)})
+
+
+@login_required
+def current_calls_live(request):
+    """
+    Return the current calls of the Current Calls page as JSON, which it asks for every CURRENT_CALLS_INTERVAL
+    seconds. They are read from Redis, so the request does not hold a worker while the calls do not change.
+    """
+    try:
+        username = requested_tenant(request)
+    except KeyError:
+        return JsonResponse({'error': 'No Tenant selected.'}, status=400)
 
-    return render(request, 'stats/current_calls.html', {'current_calls': calls, 'username': username})
+    return JsonResponse({'current_calls': live_current_calls(username)})
 
 
 @login_required
 @user_passes_test(lambda u: u.username == 'Jisc')
+@instrumented_view
 def cdr_report(request):
     # Similar as above. Please check the comment in user_stats() where the logic is explained.
     try:
-        selected_db = request.session['selected_db']
-        start_date = request.session['start_date']
-        end_date = request.session['end_date']
-    except KeyError:
+        _, databases, start_date, end_date = report_parameters(request)
+    except (KeyError, ValueError):
         return redirect(index)
 
-    report = generate_cdr_report(selected_db,
-                                 datetime.strptime(start_date, '%d/%m/%Y'),
-                                 datetime.strptime(end_date, '%d/%m/%Y')
-                                 )
+    reports = [generate_cdr_report(database, start_date, end_date) for database in databases]
 
-    if request.session['both_dbs']:
-        selected_db = 'ajenta.io'
-        old_report = generate_cdr_report(selected_db,
-                                         datetime.strptime(start_date, '%d/%m/%Y'),
-                                         datetime.strptime(end_date, '%d/%m/%Y')
-                                         )
-        report = merge_two_dicts(report, old_report)
+    # The rows of both databases are merged in JoinTime order while they are streamed.
+    jointime_index = CDR_FIELDS.index('jointime')
+    rows = merge_sorted(reports, key=lambda row: row[jointime_index])
 
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment;filename=CDR.csv'
+    writer = csv.writer(Echo())
+    lines = (writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+             for row in chain([CDR_FIELDS], rows))
 
-    fields = report.model._meta.fields
+    response = StreamingHttpResponse(lines, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment;filename=CDR.csv'
 
-    writer = csv.writer(response)
-    column_names = [field.name for field in fields]
+    return response
 
-    writer.writerow(column_names)
 
-    for obj in report:
-        writer.writerow([getattr(obj, column) for column in column_names])
+def metrics(request):
+    """
+    Expose the timings of the reports and the Celery tasks in the Prometheus text format,
+    to the scrapers of METRICS_ALLOWED_IPS and to the staff.
+    """
+    if request.META.get('REMOTE_ADDR') not in getattr(settings, 'METRICS_ALLOWED_IPS', ()) and \
+            not request.user.is_staff:
+        raise PermissionDenied
 
-    return response
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')